@@ -1,13 +1,18 @@
 #import pyximport
 #pyximport.install()
 
-from . import io
-from . import utils
-from . import fdmt
-from . import _fdmt
-from . import sim
-from . import telescope
-from . import agilent
-from . import processing
-from . import database
+# Submodules are imported on first access (e.g. limbo.io) so that tools
+# which only need file I/O do not pay for telescope/processing setup.
+import importlib
+
+_SUBMODULES = ['io', 'utils', 'fdmt', '_fdmt', 'sim', 'telescope', 'agilent',
+               'processing', 'database', 'catalog', 'pipeline', 'candidates', 'coherent']
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES))
 # from . import agilent
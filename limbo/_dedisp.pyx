@@ -0,0 +1,65 @@
+import numpy as np
+cimport numpy as np
+import cython
+from cython.parallel import prange
+from libc.math cimport floor
+
+# Shift-and-add (time-domain) de-dispersion kernels for limbo.utils. Output
+# sample j of channel c is data[j / oversample + shifts[c], c], wrapping
+# around in time like FFT phase rotation does, with linear interpolation
+# between samples (or nearest sample if not interp).
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def shift(const cython.floating[:, ::1] data, const double[::1] shifts,
+          int oversample, bint interp, cython.floating[:, ::1] out):
+    '''Write each channel of data, shifted earlier by shifts [samples],
+    into out, which has oversample times as many rows as data.'''
+    cdef Py_ssize_t j, c, i0, i1, n = data.shape[0]
+    cdef double x, w
+    for j in prange(out.shape[0], nogil=True, schedule='static'):
+        for c in range(data.shape[1]):
+            x = <double> j / oversample + shifts[c]
+            if not interp:
+                x = floor(x + 0.5)
+            i0 = <Py_ssize_t> floor(x)
+            w = x - i0
+            i0 = i0 % n
+            if i0 < 0:
+                i0 = i0 + n
+            if w == 0:
+                out[j, c] = data[i0, c]
+            else:
+                i1 = i0 + 1
+                if i1 == n:
+                    i1 = 0
+                out[j, c] = <cython.floating> ((1 - w) * data[i0, c] + w * data[i1, c])
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def shift_sum(const cython.floating[:, ::1] data, const double[::1] shifts,
+              int oversample, bint interp, double[::1] out):
+    '''Sum over channels of data, each shifted earlier by shifts [samples],
+    into out, which has oversample times as many samples as data.'''
+    cdef Py_ssize_t j, c, i0, i1, n = data.shape[0]
+    cdef double x, w, acc
+    for j in prange(out.shape[0], nogil=True, schedule='static'):
+        acc = 0
+        for c in range(data.shape[1]):
+            x = <double> j / oversample + shifts[c]
+            if not interp:
+                x = floor(x + 0.5)
+            i0 = <Py_ssize_t> floor(x)
+            w = x - i0
+            i0 = i0 % n
+            if i0 < 0:
+                i0 = i0 + n
+            i1 = i0 + 1
+            if i1 == n:
+                i1 = 0
+            acc = acc + (1 - w) * data[i0, c] + w * data[i1, c]
+        out[j] = acc
+    return
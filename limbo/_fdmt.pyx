@@ -1,18 +1,131 @@
 import numpy as np
 cimport numpy as np
 import cython
+from cython.parallel import prange, parallel
+from libc.math cimport cos, sin, M_PI
+from libc.stdlib cimport malloc, free
+
+# FDMT butterflies on (nfft, ncols) Fourier-domain data. Rows (Fourier
+# frequencies) are independent, so they run in parallel with OpenMP and
+# without the GIL; set OMP_NUM_THREADS to limit.
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-@cython.cdivision(True) 
-def phs_sum(np.ndarray [np.complex64_t, ndim=2] d,
-            np.ndarray [np.complex64_t, ndim=2] p):
-    cdef int i, j
+@cython.cdivision(True)
+def phs_sum(float complex[:, :] d, const float complex[:, :] p):
+    '''Combine adjacent column pairs of d in place: even columns become the
+    plain sum, odd columns the sum phased by p.'''
+    cdef Py_ssize_t i, j
     cdef float complex buf1, buf2
-    for i in range(d.shape[0]):
+    for i in prange(d.shape[0], nogil=True, schedule='static'):
         for j in range(0, d.shape[1], 2):
             buf1 = d[i, j] + d[i, j + 1]
             buf2 = p[i, j] * d[i, j] + p[i, j + 1] * d[i, j + 1]
             d[i, j] = buf1
             d[i, j + 1] = buf2
     return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def fdmt_stage(const float complex[:, ::1] d, const float complex[:, ::1] p,
+               float complex[:, ::1] out):
+    '''One FDMT stage from d into out. Columns of d are consecutive groups
+    of p.shape[1] subbands; pairs of adjacent subbands in group g are summed
+    into group 2 * g of out (plainly) and group 2 * g + 1 (phased by p),
+    each of half the size, so out has the same layout for the next stage.'''
+    cdef Py_ssize_t i, g, k, j, m = p.shape[1], h = p.shape[1] // 2
+    cdef Py_ssize_t ngroup = d.shape[1] // m
+    for i in prange(d.shape[0], nogil=True, schedule='static'):
+        for g in range(ngroup):
+            for k in range(h):
+                j = g * m + 2 * k
+                out[i, g * m + k] = d[i, j] + d[i, j + 1]
+                out[i, g * m + h + k] = p[i, 2 * k] * d[i, j] + p[i, 2 * k + 1] * d[i, j + 1]
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def fdmt_stage_lean(const float complex[:, ::1] d, const double[::1] rate,
+                    Py_ssize_t nrow, float complex[:, ::1] out):
+    '''As fdmt_stage, but with phases p[i, j] = exp(2j * pi * i * rate[j])
+    generated on the fly instead of read from a stored matrix: exactly at
+    the start of each block of nrow rows, then by recurrence.'''
+    cdef Py_ssize_t b, i, i0, i1, g, k, j, m = rate.shape[0], h = rate.shape[0] // 2
+    cdef Py_ssize_t ngroup = d.shape[1] // m
+    cdef Py_ssize_t nblock = (d.shape[0] + nrow - 1) // nrow
+    cdef double complex *ph
+    cdef double complex *step = <double complex *> malloc(m * sizeof(double complex))
+    for j in range(m):
+        step[j] = cos(2 * M_PI * rate[j]) + 1j * sin(2 * M_PI * rate[j])
+    with nogil, parallel():
+        ph = <double complex *> malloc(m * sizeof(double complex))
+        for b in prange(nblock, schedule='static'):
+            i0 = b * nrow
+            i1 = min(i0 + nrow, d.shape[0])
+            for j in range(m):
+                ph[j] = cos(2 * M_PI * i0 * rate[j]) + 1j * sin(2 * M_PI * i0 * rate[j])
+            for i in range(i0, i1):
+                for g in range(ngroup):
+                    for k in range(h):
+                        j = g * m + 2 * k
+                        out[i, g * m + k] = d[i, j] + d[i, j + 1]
+                        out[i, g * m + h + k] = (<float complex> ph[2 * k]) * d[i, j] \
+                            + (<float complex> ph[2 * k + 1]) * d[i, j + 1]
+                for j in range(m):
+                    ph[j] = ph[j] * step[j]
+        free(ph)
+    free(step)
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def rotate_lean(float complex[:, ::1] d, const double[::1] rate, Py_ssize_t nrow):
+    '''Multiply d in place by exp(2j * pi * i * rate[j]), generated as in
+    fdmt_stage_lean.'''
+    cdef Py_ssize_t b, i, i0, i1, j, m = rate.shape[0]
+    cdef Py_ssize_t nblock = (d.shape[0] + nrow - 1) // nrow
+    cdef double complex *ph
+    cdef double complex *step = <double complex *> malloc(m * sizeof(double complex))
+    for j in range(m):
+        step[j] = cos(2 * M_PI * rate[j]) + 1j * sin(2 * M_PI * rate[j])
+    with nogil, parallel():
+        ph = <double complex *> malloc(m * sizeof(double complex))
+        for b in prange(nblock, schedule='static'):
+            i0 = b * nrow
+            i1 = min(i0 + nrow, d.shape[0])
+            for j in range(m):
+                ph[j] = cos(2 * M_PI * i0 * rate[j]) + 1j * sin(2 * M_PI * i0 * rate[j])
+            for i in range(i0, i1):
+                for j in range(m):
+                    d[i, j] = (<float complex> ph[j]) * d[i, j]
+                    ph[j] = ph[j] * step[j]
+        free(ph)
+    free(step)
+    return
+
+# Time-domain FDMT: each row of a level holds one (subband, delay) partial
+# sum over time, and is the sum of a row of the upper subband and a row of
+# the lower subband shifted earlier by the delay accrued above it.
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def fdmt_merge(const float[:, ::1] d, const Py_ssize_t[::1] iu, const Py_ssize_t[::1] il,
+               const Py_ssize_t[::1] shift, float[:, ::1] out):
+    '''out[r, t] = d[iu[r], t] + d[il[r], (t + shift[r]) % ntimes], or just
+    d[iu[r], t] where il[r] < 0 (unpaired subband).'''
+    cdef Py_ssize_t r, t, s, ntimes = d.shape[1]
+    for r in prange(out.shape[0], nogil=True, schedule='static'):
+        if il[r] < 0:
+            for t in range(ntimes):
+                out[r, t] = d[iu[r], t]
+        else:
+            s = shift[r] % ntimes
+            for t in range(ntimes - s):
+                out[r, t] = d[iu[r], t] + d[il[r], t + s]
+            for t in range(ntimes - s, ntimes):
+                out[r, t] = d[iu[r], t] + d[il[r], t + s - ntimes]
+    return
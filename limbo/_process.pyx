@@ -0,0 +1,123 @@
+import numpy as np
+cimport numpy as np
+import cython
+from cython.parallel import prange
+from libc.math cimport fabs
+
+# Fused, in-place kernels for limbo.processing.process_data. Rows (times)
+# are processed in parallel with OpenMP; set OMP_NUM_THREADS to limit.
+# Channel masks are passed as float weights (1 = keep, 0 = flagged) and
+# noise levels as their inverse so inner loops are branch- and divide-free.
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def fit_tmdl(const float[:, ::1] data, const float[::1] fmdl,
+             const float[::1] inos, const float[::1] fwgt,
+             int ch0, int ch1, float nsig, float[::1] tmdl):
+    '''Fit the power level vs. time of data to the fmdl spectral shape over
+    ch0:ch1, iterating once to reject outliers above nsig.'''
+    cdef Py_ssize_t i, c
+    cdef double fsum = 0, num, den
+    cdef float tm0, w
+    for c in range(ch0, ch1):
+        fsum += fwgt[c] * fmdl[c]
+    for i in prange(data.shape[0], nogil=True, schedule='static'):
+        num = 0
+        for c in range(ch0, ch1):
+            num = num + fwgt[c] * data[i, c]
+        tm0 = <float> (num / fsum)
+        num = 0
+        den = 0
+        for c in range(ch0, ch1):
+            w = fwgt[c] * ((data[i, c] - tm0 * fmdl[c]) * inos[c] <= nsig)
+            num = num + w * data[i, c]
+            den = den + w * fmdl[c]
+        tmdl[i] = <float> (num / den)
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def detrend_flag(float[:, ::1] data, const float[::1] tmdl,
+                 const float[::1] fmdl, const float[::1] inos,
+                 const float[::1] fwgt, int ch0, int ch1,
+                 int hch0, int hch1, float hsig2,
+                 unsigned char[::1] hmask, float[::1] tzsq):
+    '''Subtract the tmdl x fmdl power model from data in place, flag times
+    whose mean signed zscore**2 in hch0:hch1 exceeds hsig2 (hmask), and
+    compute the mean signed zscore**2 of unflagged data in ch0:ch1 (tzsq),
+    which excludes the part of hch0:hch1 within ch0:ch1 for flagged times.'''
+    cdef Py_ssize_t i, c
+    cdef Py_ssize_t o0 = max(hch0, ch0), o1 = min(hch1, ch1)  # hot zone within ch0:ch1
+    cdef float t, z
+    cdef double hsum, tsum, hwsum, cnt = 0, hcnt = 0
+    for c in range(ch0, ch1):
+        cnt += fwgt[c]
+    for c in range(o0, o1):
+        hcnt += fwgt[c]
+    for i in prange(data.shape[0], nogil=True, schedule='static'):
+        t = tmdl[i]
+        for c in range(data.shape[1]):
+            data[i, c] = data[i, c] - t * fmdl[c]
+        hsum = 0
+        for c in range(hch0, hch1):
+            z = data[i, c] * inos[c]
+            hsum = hsum + fabs(z) * z
+        hwsum = 0
+        for c in range(o0, o1):
+            z = data[i, c] * inos[c]
+            hwsum = hwsum + fwgt[c] * fabs(z) * z
+        tsum = 0
+        for c in range(ch0, ch1):
+            z = data[i, c] * inos[c]
+            tsum = tsum + fwgt[c] * fabs(z) * z
+        if hsum / (hch1 - hch0) > hsig2:
+            hmask[i] = 1
+            tzsq[i] = <float> ((tsum - hwsum) / (cnt - hcnt))
+        else:
+            hmask[i] = 0
+            tzsq[i] = <float> (tsum / cnt)
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def freq_zsq(const float[:, ::1] diff, const float[::1] inos,
+             const unsigned char[::1] tmask, const float[::1] fwgt,
+             const unsigned char[::1] hmask, int hch0, int hch1,
+             double[:, ::1] fnum, double[:, ::1] fden):
+    '''Accumulate the signed zscore**2 (fnum) and count (fden) of unflagged
+    residuals per frequency. Row k of fnum/fden holds the partial sums of
+    the k-th contiguous chunk of times; sum over axis 0 for totals.'''
+    cdef Py_ssize_t k, i, c, i0, i1, nchunk, nrow, nf
+    cdef float z, w
+    nchunk = fnum.shape[0]
+    nf = diff.shape[1]
+    nrow = (diff.shape[0] + nchunk - 1) // nchunk
+    for k in prange(nchunk, nogil=True, schedule='static'):
+        i0 = k * nrow
+        i1 = min(i0 + nrow, diff.shape[0])
+        for i in range(i0, i1):
+            if not tmask[i]:
+                continue
+            for c in range(nf):
+                w = fwgt[c] * (not hmask[i] or c < hch0 or c >= hch1)
+                z = diff[i, c] * inos[c]
+                fnum[k, c] += w * fabs(z) * z
+                fden[k, c] += w
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def apply_mask(float[:, ::1] diff, const unsigned char[::1] tmask,
+               const unsigned char[::1] fmask, const unsigned char[::1] hmask,
+               int hch0, int hch1):
+    '''Zero flagged entries of diff in place.'''
+    cdef Py_ssize_t i, c
+    for i in prange(diff.shape[0], nogil=True, schedule='static'):
+        for c in range(diff.shape[1]):
+            if tmask[i] and fmask[c] and not (hmask[i] and c >= hch0 and c < hch1):
+                continue
+            diff[i, c] = 0
+    return
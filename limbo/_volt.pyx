@@ -0,0 +1,134 @@
+import numpy as np
+cimport numpy as np
+import cython
+
+# Voltage files hold 4b real/imag pairs in 64b network words that were not
+# endian swapped, so byte k of each 8B word belongs at position 7 - k.
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def unpack_4b_complex(const unsigned char[:, ::1] raw, Py_ssize_t start,
+                      float complex[:, ::1] out):
+    '''Decode raw[:, start:] into complex64 out in one pass.'''
+    cdef Py_ssize_t i, j, k
+    cdef unsigned char b
+    cdef signed char re, im
+    with nogil:
+        for i in range(out.shape[0]):
+            for j in range(0, out.shape[1], 8):
+                for k in range(8):
+                    b = raw[i, start + j + 7 - k]
+                    re = (<signed char> (b & 0xf0)) >> 4
+                    im = (<signed char> (b << 4)) >> 4
+                    out[i, j + k] = re + 1j * im
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def unpack_4b_int8(const unsigned char[:, ::1] raw, Py_ssize_t start,
+                   signed char[:, :, ::1] out):
+    '''Decode raw[:, start:] into interleaved int8 (real, imag) pairs.'''
+    cdef Py_ssize_t i, j, k
+    cdef unsigned char b
+    with nogil:
+        for i in range(out.shape[0]):
+            for j in range(0, out.shape[1], 8):
+                for k in range(8):
+                    b = raw[i, start + j + 7 - k]
+                    out[i, j + k, 0] = (<signed char> (b & 0xf0)) >> 4
+                    out[i, j + k, 1] = (<signed char> (b << 4)) >> 4
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def power_4b(const unsigned char[:, ::1] raw, Py_ssize_t start, int npol,
+             Py_ssize_t nint, Py_ssize_t offset, bint sum_pols,
+             float[:, ::1] out):
+    '''Accumulate detected power of raw[:, start:] into out, adding spectrum
+    i to row (i + offset) // nint. If sum_pols, out has one column per
+    channel, otherwise one per (channel, pol). Spectra past the last row
+    of out are ignored.'''
+    cdef Py_ssize_t i, c, p, o, nsum
+    cdef float acc
+    cdef float pwr[256]
+    cdef signed char re, im
+    cdef Py_ssize_t[::1] pos
+    nsum = npol if sum_pols else 1
+    # power of every possible byte, and byte position of each (chan, pol)
+    for c in range(256):
+        re = (<signed char> (c & 0xf0)) >> 4
+        im = (<signed char> (c << 4)) >> 4
+        pwr[c] = re * re + im * im
+    idx = np.arange(out.shape[1] * nsum)
+    pos = (start + (idx & ~7) + 7 - (idx & 7)).astype(np.intp)
+    with nogil:
+        for i in range(raw.shape[0]):
+            o = (i + offset) // nint
+            if o >= out.shape[0]:
+                break
+            for c in range(out.shape[1]):
+                acc = 0
+                for p in range(nsum):
+                    acc = acc + pwr[raw[i, pos[c * nsum + p]]]
+                out[o, c] += acc
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def stokes_4b(const unsigned char[:, ::1] raw, Py_ssize_t start, Py_ssize_t nint,
+              Py_ssize_t nfint, Py_ssize_t offset, float[:, :, ::1] out):
+    '''Accumulate Stokes I, Q, U, V of dual-polarization raw[:, start:] into
+    out[..., 0:4], adding spectrum i to row (i + offset) // nint and channel
+    c to column c // nfint. Spectra past the last row of out are ignored.'''
+    cdef Py_ssize_t i, c, o
+    cdef unsigned char b0, b1
+    cdef float re0, im0, re1, im1
+    cdef Py_ssize_t[::1] pos
+    idx = np.arange(out.shape[1] * nfint * 2)
+    pos = (start + (idx & ~7) + 7 - (idx & 7)).astype(np.intp)
+    with nogil:
+        for i in range(raw.shape[0]):
+            o = (i + offset) // nint
+            if o >= out.shape[0]:
+                break
+            for c in range(out.shape[1] * nfint):
+                b0 = raw[i, pos[2 * c]]
+                b1 = raw[i, pos[2 * c + 1]]
+                re0 = (<signed char> (b0 & 0xf0)) >> 4
+                im0 = (<signed char> (b0 << 4)) >> 4
+                re1 = (<signed char> (b1 & 0xf0)) >> 4
+                im1 = (<signed char> (b1 << 4)) >> 4
+                out[o, c // nfint, 0] += re0 * re0 + im0 * im0 + re1 * re1 + im1 * im1
+                out[o, c // nfint, 1] += re0 * re0 + im0 * im0 - re1 * re1 - im1 * im1
+                out[o, c // nfint, 2] += 2 * (re0 * re1 + im0 * im1)
+                out[o, c // nfint, 3] += 2 * (re0 * im1 - im0 * re1)
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def stokes_int8(const signed char[:, :, :] re, const signed char[:, :, :] im,
+                Py_ssize_t nint, Py_ssize_t nfint, float[:, :, ::1] out):
+    '''Accumulate Stokes I, Q, U, V of (nspec, nchan, 2) int8 real/imag
+    voltages into out[..., 0:4] as in stokes_4b.'''
+    cdef Py_ssize_t i, c, o
+    cdef float re0, im0, re1, im1
+    with nogil:
+        for i in range(re.shape[0]):
+            o = i // nint
+            if o >= out.shape[0]:
+                break
+            for c in range(out.shape[1] * nfint):
+                re0 = re[i, c, 0]
+                im0 = im[i, c, 0]
+                re1 = re[i, c, 1]
+                im1 = im[i, c, 1]
+                out[o, c // nfint, 0] += re0 * re0 + im0 * im0 + re1 * re1 + im1 * im1
+                out[o, c // nfint, 1] += re0 * re0 + im0 * im0 - re1 * re1 - im1 * im1
+                out[o, c // nfint, 2] += 2 * (re0 * re1 + im0 * im1)
+                out[o, c // nfint, 3] += 2 * (re0 * im1 - im0 * re1)
+    return
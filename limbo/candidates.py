@@ -0,0 +1,143 @@
+'''Extraction, clustering, and sifting of candidate events in DM transforms.'''
+
+import numpy as np
+
+def _median(x):
+    '''Median along the last axis of x, which is partially sorted in place.'''
+    k = x.shape[-1] // 2
+    x.partition(k, axis=-1)
+    if x.shape[-1] % 2:
+        return x[..., k].copy()
+    return 0.5 * (x[..., k] + x[..., :k].max(axis=-1))
+
+def median_mad(x):
+    '''Return the median and median absolute deviation of each column of x.'''
+    xt = np.array(x.T, order='C')
+    avg = _median(xt)
+    np.abs(xt - avg[:, None], out=xt)
+    return avg, _median(xt)
+
+def robust_zscore(x):
+    '''Return (x - median) / MAD of each column of x.'''
+    avg, sig = median_mad(x)
+    return (x - avg) / sig
+
+def boxcar(dm_vs_t, width):
+    '''Return the sum of width consecutive times of dm_vs_t (ending at each
+    time) divided by sqrt(width).'''
+    if width == 1:
+        return dm_vs_t
+    csum = np.cumsum(dm_vs_t, axis=0, dtype='float64')
+    csum[width:] -= csum[:-width].copy()
+    return (csum / np.sqrt(width)).astype(dm_vs_t.dtype)
+
+def find_peaks(dm_vs_t, nsig, widths=(1,)):
+    '''Return tind, dind, width, snr of (time, DM) samples whose zscore
+    (per DM, from median and MAD) exceeds nsig after boxcar smoothing by
+    any of widths integrations. Only the best width of each sample is
+    kept. For widths > 1, tind is the last time in the boxcar.'''
+    tind, dind, width, snr = [], [], [], []
+    for w in widths:
+        x = boxcar(dm_vs_t, w)
+        avg, sig = median_mad(x)
+        t, d = np.nonzero(x > avg + nsig * sig)
+        tind.append(t)
+        dind.append(d)
+        width.append(np.full(t.size, w))
+        snr.append((x[t, d] - avg[d]) / sig[d])
+    tind, dind, width, snr = [np.concatenate(v) for v in (tind, dind, width, snr)]
+    if len(widths) > 1:
+        # sort by (time, DM, -snr) and keep the first of each (time, DM)
+        order = np.lexsort((-snr, dind, tind))
+        tind, dind, width, snr = tind[order], dind[order], width[order], snr[order]
+        first = np.ones(tind.size, dtype=bool)
+        first[1:] = (np.diff(tind) != 0) | (np.diff(dind) != 0)
+        tind, dind, width, snr = tind[first], dind[first], width[first], snr[first]
+    return tind, dind, width, snr
+
+def cluster(tind, dind, t_link=2, dm_link=2):
+    '''Group candidates by friends-of-friends: candidates within t_link
+    integrations and dm_link DM trials of each other are in the same
+    cluster. Runs in O(n log n) using ranges of the sorted (time, DM)
+    candidate indices.
+    Returns:
+        labels: Cluster number of each candidate.
+    '''
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    tind = np.asarray(tind, dtype=np.int64)
+    dind = np.asarray(dind, dtype=np.int64)
+    n = tind.size
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    stride = dind.max() + 1
+    key = tind * stride + dind
+    order = np.argsort(key, kind='stable')
+    skey = key[order]
+    rows, cols = [], []
+    # Each candidate is linked to the first candidate in the range of keys
+    # covering its DM window in each of the next t_link times (including
+    # its own), and consecutive candidates inside any such window are
+    # linked to each other; all are friends of the candidate, so this
+    # yields the same clusters as linking every pair of friends.
+    d_lo = np.maximum(dind - dm_link, 0)
+    d_hi = np.minimum(dind + dm_link, stride - 1) + 1
+    for dt in range(t_link + 1):
+        lo = np.searchsorted(skey, (tind + dt) * stride + d_lo)
+        hi = np.searchsorted(skey, (tind + dt) * stride + d_hi)
+        has = hi > lo
+        rows.append(np.nonzero(has)[0])
+        cols.append(order[lo[has]])
+        run = hi - lo > 1
+        cnt = np.bincount(lo[run], minlength=n + 1) - np.bincount(hi[run] - 1, minlength=n + 1)
+        k = np.nonzero(np.cumsum(cnt)[:n - 1] > 0)[0]
+        rows.append(order[k])
+        cols.append(order[k + 1])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    graph = coo_matrix((np.ones(rows.size, dtype=np.int8), (rows, cols)), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    return labels
+
+def sift(labels, snr):
+    '''Return the index of the highest-snr member of each cluster and the
+    number of members, ordered by cluster label.'''
+    order = np.lexsort((-snr, labels))
+    first = np.ones(order.size, dtype=bool)
+    first[1:] = labels[order][1:] != labels[order][:-1]
+    best = order[first]
+    count = np.bincount(labels)[labels[best]]
+    return best, count
+
+def find_candidates(dm_vs_t, dms, nsig, times=None, widths=(1,), t_link=2, dm_link=2):
+    '''Find clusters of above-threshold samples in a DM transform, keeping
+    the best member of each.
+    Arguments:
+        dm_vs_t: (ntimes, ndms) DM transform.
+        dms: (ndms,) DM of each column.
+        nsig: Threshold zscore (per DM, from median and MAD).
+        times: Optional (ntimes,) time of each row.
+        widths: Boxcar widths [integrations] to search.
+        t_link: Friends-of-friends linking length [integrations].
+        dm_link: Friends-of-friends linking length [DM trials].
+    Returns:
+        cands: Dictionary of arrays, sorted by descending snr, with keys
+            'tind', 'dind', 'dm', 'width', 'snr', 'count' (cluster members),
+            'tind_lo', 'tind_hi' (time span of members), and 'time' if times
+            is provided.
+    '''
+    tind, dind, width, snr = find_peaks(dm_vs_t, nsig, widths=widths)
+    labels = cluster(tind, dind, t_link=t_link, dm_link=dm_link)
+    best, count = sift(labels, snr)
+    nclust = best.size
+    tind_lo = np.full(nclust, dm_vs_t.shape[0])
+    tind_hi = np.zeros(nclust, dtype=tind.dtype)
+    np.minimum.at(tind_lo, labels, tind)
+    np.maximum.at(tind_hi, labels, tind)
+    order = np.argsort(-snr[best], kind='stable')
+    best = best[order]
+    cands = {'tind': tind[best], 'dind': dind[best], 'dm': np.asarray(dms)[dind[best]],
+             'width': width[best], 'snr': snr[best], 'count': count[order],
+             'tind_lo': tind_lo[order], 'tind_hi': tind_hi[order]}
+    if times is not None:
+        cands['time'] = np.asarray(times)[cands['tind']]
+    return cands
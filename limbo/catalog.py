@@ -0,0 +1,144 @@
+'''Persistent catalog of limbo file headers, for fast time-window lookups.'''
+
+import sqlite3
+import struct
+import json
+import glob
+import os
+
+from . import io
+from . import utils
+from .database import DATABASE_DIR
+
+CATALOG_FILE = os.path.join(DATABASE_DIR, 'header_catalog.sqlite')
+VOLT_PREFIX = 'Volt'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS headers (
+    filename TEXT PRIMARY KEY,
+    mtime REAL,
+    filesize INTEGER,
+    filetype TEXT,
+    start_time REAL,
+    end_time REAL,
+    nspec INTEGER,
+    inttime REAL,
+    source TEXT,
+    ra TEXT,
+    dec TEXT,
+    lo_hz REAL,
+    nchan INTEGER,
+    header TEXT
+);
+CREATE INDEX IF NOT EXISTS headers_start ON headers (start_time);
+CREATE INDEX IF NOT EXISTS headers_end ON headers (end_time);
+'''
+
+def file_type(filename):
+    '''Return 'volt' for voltage files and 'spectra' for power spectra.'''
+    if os.path.basename(filename).startswith(VOLT_PREFIX):
+        return 'volt'
+    return 'spectra'
+
+class HeaderCatalog:
+    '''SQLite catalog of limbo headers keyed by filename and mtime. Entries
+    are only re-read from disk when a file is new or has changed.'''
+
+    def __init__(self, dbfile=CATALOG_FILE, lo_hz=1350e6, nchan=io.NCHAN_DEFAULT):
+        self.dbfile = dbfile
+        self.lo_hz = lo_hz
+        self.nchan = nchan
+        self.conn = sqlite3.connect(dbfile, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM headers').fetchone()[0]
+
+    def _row(self, filename, st, filetype):
+        if filetype == 'volt':
+            hdr = io.read_volt_header(filename, lo_hz=self.lo_hz, nchan=self.nchan)
+        else:
+            hdr = io.read_header(filename, lo_hz=self.lo_hz, nchan=self.nchan)
+        hdr = {k: v for k, v in hdr.items() if k != 'freqs'}
+        hdr['nspec'] = int(hdr['nspec'])
+        return (filename, st.st_mtime, st.st_size, filetype, hdr['Time'],
+                hdr['Time'] + hdr['nspec'] * hdr['inttime'], hdr['nspec'],
+                hdr['inttime'], hdr.get('Source'), hdr.get('Target_RA_Deg'),
+                hdr.get('Target_DEC_Deg'), self.lo_hz, self.nchan,
+                json.dumps(hdr))
+
+    def update(self, filenames, filetype=None):
+        '''Add new or modified files to the catalog. Returns the number of
+        headers (re)read. File type is inferred from the name if None.'''
+        known = {r['filename']: (r['mtime'], r['filesize'])
+                 for r in self.conn.execute(
+                    'SELECT filename, mtime, filesize FROM headers')}
+        rows = []
+        for filename in filenames:
+            try:
+                st = os.stat(filename)
+            except(FileNotFoundError):
+                continue
+            if known.get(filename) == (st.st_mtime, st.st_size):
+                continue
+            try:
+                rows.append(self._row(filename, st, filetype or file_type(filename)))
+            except(ValueError, KeyError, struct.error, OSError):  # unreadable or truncated
+                continue
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO headers VALUES '
+                                  '(?,?,?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+        return len(rows)
+
+    def update_dir(self, dirname, pattern='*.dat', filetype=None):
+        '''Add new or modified files matching pattern in dirname.'''
+        return self.update(glob.glob(os.path.join(dirname, pattern)), filetype=filetype)
+
+    def prune(self):
+        '''Remove entries for files that no longer exist.'''
+        gone = [(r['filename'],) for r in self.conn.execute(
+                    'SELECT filename FROM headers')
+                if not os.path.exists(r['filename'])]
+        with self.conn:
+            self.conn.executemany('DELETE FROM headers WHERE filename=?', gone)
+        return len(gone)
+
+    def query(self, t0, t1, filetype=None, dirname=None):
+        '''Return filenames (sorted by start time) of files with data
+        overlapping unix times [t0, t1).'''
+        sql = 'SELECT filename FROM headers WHERE start_time < ? AND end_time > ?'
+        args = [t1, t0]
+        if filetype is not None:
+            sql += ' AND filetype = ?'
+            args.append(filetype)
+        if dirname is not None:
+            sql += ' AND filename LIKE ?'
+            args.append(os.path.join(dirname, '%'))
+        sql += ' ORDER BY start_time'
+        return [r['filename'] for r in self.conn.execute(sql, args)]
+
+    def get_header(self, filename):
+        '''Return the cataloged header for a file, matching io.read_header
+        (or io.read_volt_header for voltage files).'''
+        r = self.conn.execute('SELECT header, lo_hz, nchan FROM headers '
+                              'WHERE filename=?', (filename,)).fetchone()
+        if r is None:
+            raise KeyError(filename)
+        hdr = json.loads(r['header'])
+        hdr['freqs'] = utils.calc_freqs(hdr['sample_clock'], r['lo_hz'], r['nchan'])
+        return hdr
+
+    def get_headers(self, t0, t1, filetype=None, dirname=None):
+        '''Return headers of files overlapping unix times [t0, t1).'''
+        return [self.get_header(f) for f in self.query(t0, t1, filetype=filetype,
+                                                        dirname=dirname)]
@@ -0,0 +1,140 @@
+'''Coherent de-dispersion of channelized voltages.'''
+
+import numpy as np
+from .utils import DM_CONST, DM_delay
+
+_CHIRPS = {}  # (dm, channel layout, nfft) -> chirp kernels; see get_chirp
+MAX_CHIRPS = 16
+HALO_MARGIN = 16  # [samples] added to each side of the filter response
+
+def smear_samples(dm, freqs, inttime):
+    '''Return the largest dispersion delay [samples] across any one channel,
+    for critically sampled channels of width 1 / inttime.'''
+    bw = 1 / inttime
+    f0 = np.min(freqs)
+    return (DM_delay(dm, f0 - bw / 2) - DM_delay(dm, f0 + bw / 2)) / inttime
+
+def chirp(dm, freqs, inttime, nfft, dtype='complex64'):
+    '''Return (nfft, nchan) filters that remove dispersion within each
+    critically sampled channel (centered at freqs, width 1 / inttime),
+    excluding the delay of the channel center. Frequency within a channel
+    is assumed to increase with FFT frequency (upper sideband).'''
+    f = np.fft.fftfreq(nfft, inttime)[:, None]
+    f0 = np.asarray(freqs, dtype='float64')[None, :]
+    phs = -2 * np.pi * DM_CONST * dm * f**2 / (f0**2 * (f0 + f))
+    return np.exp(1j * phs).astype(dtype)
+
+def get_chirp(dm, freqs, inttime, nfft, dtype='complex64'):
+    '''Return chirp(...), cached per (dm, channel layout, nfft). At most
+    MAX_CHIRPS kernels are kept; the oldest is dropped first.'''
+    key = (float(dm), np.asarray(freqs, dtype='float64').tobytes(), float(inttime),
+           int(nfft), np.dtype(dtype).str)
+    if key not in _CHIRPS:
+        if len(_CHIRPS) >= MAX_CHIRPS:
+            del _CHIRPS[next(iter(_CHIRPS))]
+        _CHIRPS[key] = chirp(dm, freqs, inttime, nfft, dtype=dtype)
+    return _CHIRPS[key]
+
+class CoherentDedisperser:
+    '''Streaming coherent de-dispersion of (ntimes, nchan) complex voltages.
+    Dispersion within each channel is removed by its chirp filter, applied
+    with overlap-save FFTs of nfft samples, and delays between channels by
+    integer sample shifts aligning each channel with the highest frequency.
+    Output sample t is the de-dispersed voltage at input sample t (of the
+    highest channel); the stream is taken to be zero before its start, so
+    the first nhalo outputs are only partially de-dispersed. Memory use is
+    bounded by nfft and the delay across the band, not the stream length.'''
+
+    def __init__(self, dm, freqs, inttime, nfft=None, dtype='complex64'):
+        '''Arguments:
+            dm: Dispersion measure [pc / cm^3].
+            freqs: (nchan,) channel center frequencies [Hz].
+            inttime: Sample time [s] of each channel.
+            nfft: Overlap-save block length (default: a power of 2 at least
+                8 times the filter length, and at least 256).'''
+        self.dm = dm
+        self.freqs = np.asarray(freqs)
+        self.inttime = inttime
+        self.dtype = np.dtype(dtype)
+        # the filter response spans about +/- smear / 2, but its band-edge
+        # tails decay slowly, so keep a full smear plus a margin each side
+        self.nhalo = int(np.ceil(smear_samples(dm, freqs, inttime))) + HALO_MARGIN
+        if nfft is None:
+            nfft = max(256, 2**int(np.ceil(np.log2(16 * self.nhalo))))
+        assert nfft > 2 * self.nhalo
+        self.nfft = nfft
+        self.chirp = get_chirp(dm, freqs, inttime, nfft, dtype=dtype)
+        self._chirp = self.chirp.T[:, None, :]  # broadcast over (nchan, nblk, nfft)
+        delays = (DM_delay(dm, self.freqs) - DM_delay(dm, self.freqs.max())) / inttime
+        self.shifts = np.around(delays).astype(int)
+        self.reset()
+
+    def reset(self):
+        '''Start a new stream.'''
+        nchan = self.freqs.size
+        # buffers are (nchan, ntimes) so FFTs and shifts run on contiguous rows
+        # unfiltered input, starting nhalo samples before the next block
+        self._buf = np.zeros((nchan, self.nhalo), dtype=self.dtype)
+        # filtered voltages not yet emitted, starting at output sample _nout
+        self._filt = np.zeros((nchan, 0), dtype=self.dtype)
+        self._nout = 0
+
+    def _filter(self, flush=False):
+        '''Chirp-filter all complete overlap-save blocks in the buffer.'''
+        from scipy.fft import fft, ifft
+        nchan = self.freqs.size
+        step = self.nfft - 2 * self.nhalo
+        if flush:
+            # zero-pad so every buffered sample is filtered
+            npad = self.nhalo + (-(self._buf.shape[1] - self.nhalo)) % step
+            self._buf = np.concatenate([self._buf, np.zeros((nchan, npad), dtype=self.dtype)],
+                                       axis=1)
+        nblk = max(0, (self._buf.shape[1] - 2 * self.nhalo) // step)
+        if nblk == 0:
+            return
+        segs = np.lib.stride_tricks.sliding_window_view(self._buf, self.nfft, axis=1)
+        segs = fft(segs[:, ::step][:, :nblk], axis=-1)
+        segs *= self._chirp
+        segs = ifft(segs, axis=-1, overwrite_x=True)
+        segs = segs[..., self.nhalo:self.nfft - self.nhalo].reshape(nchan, nblk * step)
+        self._filt = np.concatenate([self._filt, segs.astype(self.dtype, copy=False)], axis=1)
+        self._buf = self._buf[:, nblk * step:]
+
+    def _emit(self, nvalid):
+        '''Return the de-dispersed output for which the first nvalid
+        filtered samples suffice.'''
+        nout = max(0, nvalid - self.shifts.max())
+        out = np.empty((self.freqs.size, nout), dtype=self.dtype)
+        for c, s in enumerate(self.shifts):
+            out[c] = self._filt[c, s:s + nout]
+        self._filt = self._filt[:, nout:]
+        self._nout += nout
+        return out.T
+
+    def process(self, volt):
+        '''Add (ntimes, nchan) voltages to the stream and return the
+        de-dispersed voltages that are now complete.'''
+        volt = np.asarray(volt, dtype=self.dtype).T
+        self._buf = np.concatenate([self._buf, volt], axis=1)
+        self._filter()
+        return self._emit(self._filt.shape[1])
+
+    def flush(self, nend):
+        '''Finish the stream, taken to be zero after its end, returning the
+        remaining output up to (but not including) output sample nend, which
+        should be at most the stream length minus the largest shift.'''
+        self._filter(flush=True)
+        nvalid = min(self._filt.shape[1], nend - self._nout + self.shifts.max())
+        out = self._emit(nvalid)
+        self.reset()
+        return out
+
+    def __call__(self, volt, block=None):
+        '''De-disperse a whole (ntimes, nchan) array, block samples at a time
+        (default 16 * nfft). Returns ntimes minus the largest shift samples.'''
+        block = 16 * self.nfft if block is None else block
+        self.reset()
+        nend = volt.shape[0] - self.shifts.max()
+        out = [self.process(volt[i:i + block]) for i in range(0, volt.shape[0], block)]
+        out.append(self.flush(nend))
+        return np.concatenate(out)[:nend]
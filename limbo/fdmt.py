@@ -1,33 +1,306 @@
 from .utils import DM_delay
-from ._fdmt import phs_sum
+from ._fdmt import phs_sum, fdmt_stage, fdmt_stage_lean, rotate_lean, fdmt_merge
+from collections import OrderedDict
+import hashlib
+import os
 import numpy as np
 
+# Directory for on-disk FDMT plans (see get_fdmt); None disables.
+CACHE_DIR = os.environ.get('LIMBO_FDMT_CACHE')
+MAX_PLANS = 4  # FDMT plans kept in memory
+_PLANS = OrderedDict()
+
+def _sampling(times):
+    '''Return ntimes and the sample time, robust to the rounding of
+    differences of large (e.g. unix) times.'''
+    return times.size, float(f'{(times[-1] - times[0]) / (times.size - 1):.9g}')
+
+def plan_key(freqs, times, maxDM=500, dtype='float32', cdtype='complex64', minDM=0,
+             ndm=None):
+    '''Return a hash identifying the FDMT plan for this configuration.'''
+    h = hashlib.sha1(np.asarray(freqs, dtype='float64').tobytes())
+    h.update(repr((_sampling(times), float(maxDM), np.dtype(dtype).str,
+                   np.dtype(cdtype).str, float(minDM), ndm)).encode())
+    return h.hexdigest()[:16]
+
+def get_fdmt(freqs, times, maxDM=500, dtype='float32', cdtype='complex64', cache_dir=None,
+             max_phase_mem=None, minDM=0, ndm=None, engine='fft'):
+    '''Return an FDMT for this configuration, reusing the plan of the
+    MAX_PLANS most recently used configurations, or one saved in cache_dir
+    (default CACHE_DIR), so plans are built once per observing setup.
+    engine is 'fft' (FDMT) or 'time' (TimeFDMT).'''
+    assert engine in ('fft', 'time')
+    key = (plan_key(freqs, times, maxDM, dtype, cdtype, minDM, ndm), max_phase_mem, engine)
+    if key in _PLANS:
+        _PLANS.move_to_end(key)
+        return _PLANS[key]
+    if engine == 'time':
+        fdmt = TimeFDMT(freqs, times, maxDM=maxDM, minDM=minDM, ndm=ndm)
+    else:
+        cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+        fdmt = FDMT(freqs, times, maxDM=maxDM, dtype=dtype, cdtype=cdtype, cache_dir=cache_dir,
+                    max_phase_mem=max_phase_mem, minDM=minDM, ndm=ndm)
+    _PLANS[key] = fdmt
+    if len(_PLANS) > MAX_PLANS:
+        _PLANS.popitem(last=False)
+    return fdmt
+
 class FDMT:
-    def __init__(self, freqs, times, maxDM=500, dtype='float32', cdtype='complex64'):
+    def __init__(self, freqs, times, maxDM=500, dtype='float32', cdtype='complex64',
+                 cache_dir=None, max_phase_mem=None, nrow=64, minDM=0, ndm=None):
+        '''Arguments:
+            freqs: Evenly spaced, increasing channel frequencies [Hz]. Any
+                number of channels; zero channels are added below the band
+                to reach a power of 2.
+            minDM, maxDM: DM range [pc / cm^3] searched.
+            ndm: Number of DM trials, evenly spaced from minDM with step
+                (maxDM - minDM) / ndm. Fewer trials run fewer stages. If None,
+                as many columns as (padded) channels are returned: each pair
+                holds the lower and upper half-band of one of nfreqs / 2
+                trials, labeled by dms as consecutive DMs.
+            cache_dir: If provided, per-stage phases are loaded from or saved
+                to .npy files there, named by plan_key.
+            max_phase_mem: Memory [bytes] for stored phase matrices. None
+                stores every stage; otherwise only the (smaller) later
+                stages that fit are stored, and the phases of the rest are
+                generated during apply, using little memory but more time.
+            nrow: Rows per block (exact phase restart) for generated phases.'''
         self.cache = {}
+        self.rates = {}
         self.dtype = dtype
         self.cdtype = cdtype
+        self.nchan = freqs.size
+        self.npad = 2**int(np.ceil(np.log2(self.nchan))) - self.nchan
+        if self.npad > 0:
+            df = freqs[1] - freqs[0]
+            freqs = np.concatenate([freqs[0] - df * np.arange(self.npad, 0, -1), freqs])
         self.nfreqs = freqs.size
         self.ntimes = times.size
+        self.minDM = minDM
         self.maxDM = maxDM
-        _ffreq = np.fft.rfftfreq(self.ntimes, times[1] - times[0]).astype(dtype)
+        self.ndm = ndm
+        self.nrow = nrow
         self.stages = int(np.log2(self.nfreqs))
-        self.dms = np.linspace(0, self.maxDM, 2**self.stages, endpoint=False)
-        chans = np.arange(self.nfreqs, dtype='uint32')
+        if ndm is None:
+            self.nstage = self.stages - 1
+            self.dms = np.linspace(minDM, maxDM, 2**self.stages, endpoint=False)
+            ddm = (maxDM - minDM) / 2**self.nstage
+        else:
+            self.nstage = int(np.ceil(np.log2(ndm)))
+            assert self.nstage <= self.stages  # at most one trial per channel
+            ddm = (maxDM - minDM) / ndm
+            self.dms = minDM + ddm * np.arange(ndm)
+        self.key = plan_key(freqs, times, maxDM, dtype, cdtype, minDM, ndm)
+        dt = _sampling(times)[1]
+        _ffreq = np.fft.rfftfreq(self.ntimes, dt).astype(dtype)
+        # store the smallest stages first, within max_phase_mem
+        stored, mem = [], 0
+        for i in range(self.nstage, 0, -1):
+            mem += _ffreq.size * (self.nfreqs >> (i - 1)) * np.dtype(cdtype).itemsize
+            if max_phase_mem is None or mem <= max_phase_mem:
+                stored.append(i)
         freqs = freqs.astype(dtype)
-        for i in range(1, self.stages):
-            delays = DM_delay(maxDM / 2**i, freqs) - DM_delay(maxDM / 2**i, freqs[-1])
-            phs = np.exp(2j * np.pi * np.outer(_ffreq, delays))
+        if minDM != 0:
+            # offset every channel to minDM before the stages (rates[0])
+            delays = DM_delay(minDM, freqs) - DM_delay(minDM, freqs[-1])
+            self.rates[0] = delays.astype('float64') / (self.ntimes * dt)
+        for i in range(1, self.nstage + 1):
+            # stage i adds the DM step of bit nstage - i of the trial index
+            dm = ddm * 2**(self.nstage - i)
+            delays = DM_delay(dm, freqs) - DM_delay(dm, freqs[-1])
+            if i not in stored:
+                # phase advance [cycles] per Fourier row
+                self.rates[i] = delays.astype('float64') / (self.ntimes * dt)
+            elif not (cache_dir is not None and self._load(cache_dir, i)):
+                phs = np.exp(2j * np.pi * np.outer(_ffreq, delays))
+                self.cache[i] = phs.astype(cdtype)
+                if cache_dir is not None:
+                    self._save(cache_dir, i)
             freqs = (freqs[0::2] + freqs[1::2]) / 2
-            self.cache[i] = phs.astype(cdtype)
-            
+
+    def _plan_file(self, cache_dir, i):
+        return os.path.join(cache_dir, f'fdmt_{self.key}_{i}.npy')
+
+    def _load(self, cache_dir, i):
+        filename = self._plan_file(cache_dir, i)
+        if not os.path.exists(filename):
+            return False
+        self.cache[i] = np.load(filename)
+        return True
+
+    def _save(self, cache_dir, i):
+        os.makedirs(cache_dir, exist_ok=True)
+        filename = self._plan_file(cache_dir, i)
+        # write then rename, so concurrent workers never see partial files
+        tmp = f'{filename}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, self.cache[i])
+        os.replace(tmp, filename)
+
     def phs_sum(self, d, phs):
         phs_sum(d, phs)
         return [d[:,0::2], d[:,1::2]]
             
     def apply(self, profile):
-        self._data = np.fft.rfft(profile, axis=0).astype(self.cdtype)
-        ans = [self._data]
-        for i in range(1, self.stages):
-            ans = sum([self.phs_sum(d, self.cache[i]) for d in ans], [])
-        return np.concatenate([np.fft.irfft(d, axis=0) for d in ans], axis=1)
+        '''Return the (ntimes, ndms) DM transform of (ntimes, nchan) profile.
+        Stages alternate between two contiguous buffers, each holding the
+        subband groups of every DM branch side by side.'''
+        from scipy.fft import rfft, irfft
+        _profile = rfft(profile, axis=0)
+        buf = np.zeros((_profile.shape[0], self.nfreqs), dtype=self.cdtype)
+        buf[:, self.npad:] = _profile
+        del _profile
+        if 0 in self.rates:
+            rotate_lean(buf, self.rates[0], self.nrow)
+        out = np.empty_like(buf)
+        for i in range(1, self.nstage + 1):
+            if i in self.cache:
+                fdmt_stage(buf, self.cache[i], out)
+            else:
+                fdmt_stage_lean(buf, self.rates[i], self.nrow, out)
+            buf, out = out, buf
+        del out
+        if self.ndm is not None:
+            # sum the subbands left in each DM branch
+            buf = buf.reshape(buf.shape[0], 2**self.nstage, -1).sum(axis=-1)[:, :self.ndm]
+        return irfft(buf, self.ntimes, axis=0)
+
+class TimeFDMT:
+    '''Time-domain FDMT (Zackay & Ofek 2017): adjacent subbands are merged
+    level by level with integer sample shifts, each level holding one row
+    per (subband, delay across the subband) pair. Cost scales with the
+    number of delay trials rather than channels, and each output sample
+    only depends on the following max_delay samples, so blocks of a long
+    series can be processed independently (see apply). Same interface as
+    FDMT; time wraps around at the end of the profile.'''
+
+    def __init__(self, freqs, times, maxDM=500, minDM=0, ndm=None, dtype='float32'):
+        '''Arguments:
+            freqs: Increasing channel frequencies [Hz]; any number.
+            times: Sample times [s], evenly spaced.
+            minDM, maxDM: DM range [pc / cm^3] searched.
+            ndm: Number of DM trials, evenly spaced from minDM with step
+                (maxDM - minDM) / ndm, each rounded to the nearest delay
+                trial; repeats are dropped, so there are fewer trials (dms)
+                when ndm exceeds the delay samples across the band. If None,
+                one trial per sample of delay across the band.'''
+        self.dtype = dtype
+        self.nchan = freqs.size
+        self.ntimes = times.size
+        self.minDM = minDM
+        self.maxDM = maxDM
+        self.ndm = ndm
+        dt = _sampling(times)[1]
+        freqs = np.asarray(freqs, dtype='float64')
+
+        def rate(lo, hi):
+            # delay [samples] per unit DM from frequency lo to hi
+            return (DM_delay(1., lo) - DM_delay(1., hi)) / dt
+
+        # each subband: (lo freq, hi freq, first delay, first row)
+        subs = [(f, f, 0, c) for c, f in enumerate(freqs)]
+        self.plan = []
+        while len(subs) > 1:
+            new, iu, il, shift = [], [], [], []
+            for k in range(0, len(subs), 2):
+                if k + 1 == len(subs):  # unpaired top subband passes through
+                    lo, hi, d0, r0 = subs[k]
+                    nd = int(np.floor(maxDM * rate(lo, hi))) + 1 - d0
+                    new.append((lo, hi, d0, len(iu)))
+                    iu += range(r0, r0 + nd)
+                    il += [-1] * nd
+                    shift += [0] * nd
+                    continue
+                (lo, mid0, d0l, r0l), (mid1, hi, d0u, r0u) = subs[k:k + 2]
+                ndl = int(np.floor(maxDM * rate(lo, mid0))) + 1 - d0l
+                ndu = int(np.floor(maxDM * rate(mid1, hi))) + 1 - d0u
+                r = rate(lo, hi)
+                d = np.arange(int(np.floor(minDM * r)), int(np.floor(maxDM * r)) + 1)
+                if len(subs) <= 2 and ndm is not None:
+                    # only the requested trials of the full band
+                    ddm = (maxDM - minDM) / ndm
+                    d = np.unique(np.around((minDM + ddm * np.arange(ndm)) * r).astype(int))
+                # split each delay between the subbands and the gap between them
+                du = np.clip(np.around(d * rate(mid1, hi) / r).astype(int), d0u, d0u + ndu - 1)
+                dg = np.around(d * rate(mid0, mid1) / r).astype(int)
+                dl = np.clip(d - du - dg, d0l, d0l + ndl - 1)
+                new.append((lo, hi, d[0], len(iu)))
+                iu += list(r0u + du - d0u)
+                il += list(r0l + dl - d0l)
+                shift += list(du + dg)
+            self.plan.append(tuple(np.array(a, dtype=np.intp) for a in (iu, il, shift)))
+            subs = new
+        lo, hi, d0, _ = subs[0]
+        r = rate(lo, hi)
+        if ndm is None:
+            nd = int(np.floor(maxDM * r)) + 1 - d0
+            self.delays = d0 + np.arange(nd)
+        else:
+            self.delays = np.unique(np.around((minDM + (maxDM - minDM) / ndm * np.arange(ndm)) * r))
+        self.dms = self.delays / r if r > 0 else np.zeros(self.delays.size)
+        self.max_delay = int(np.max(self.delays)) if self.delays.size else 0
+        # samples after t used by the output at t (max_delay, up to rounding)
+        reach = np.zeros(self.nchan, dtype=np.intp)
+        for iu, il, shift in self.plan:
+            r = reach[iu]
+            m = il >= 0
+            r[m] = np.maximum(r[m], reach[il[m]] + shift[m])
+            reach = r
+        self.reach = int(reach.max())
+
+    def apply(self, profile):
+        '''Return the (ntimes, ndms) DM transform of (ntimes, nchan) profile.'''
+        buf = np.ascontiguousarray(np.asarray(profile, dtype=self.dtype).T)
+        for iu, il, shift in self.plan:
+            out = np.empty((iu.size, buf.shape[1]), dtype=self.dtype)
+            fdmt_merge(buf, iu, il, shift, out)
+            buf = out
+        return buf.T
+
+class StreamingFDMT:
+    '''DM transform of a stream of (ntimes, nchan) blocks (e.g. consecutive
+    files) with TimeFDMT. The last overlap input samples are kept between
+    blocks, since the output at t needs the input up to t + overlap, so a
+    sweep straddling blocks is summed in full. Output sample t is at input
+    sample t of the top channel; it is emitted once t + overlap samples
+    have been added, so output lags input by overlap samples.'''
+
+    def __init__(self, freqs, inttime, maxDM=500, minDM=0, ndm=None, dtype='float32'):
+        '''Arguments as for TimeFDMT, with inttime the sample time [s].'''
+        self.fdmt = TimeFDMT(freqs, np.arange(2) * inttime, maxDM=maxDM, minDM=minDM,
+                             ndm=ndm, dtype=dtype)
+        self.dms = self.fdmt.dms
+        self.overlap = self.fdmt.reach
+        self.reset()
+
+    def reset(self):
+        '''Start a new stream.'''
+        self._buf = np.zeros((0, self.fdmt.nchan), dtype=self.fdmt.dtype)
+        self.nin = 0  # input samples added
+        self.nout = 0  # output samples emitted
+
+    def process(self, block):
+        '''Add (ntimes, nchan) block to the stream and return the (nout,
+        ndms) DM transform for the output samples now complete, starting at
+        output sample self.nout (before the call).'''
+        self._buf = np.concatenate([self._buf, np.asarray(block, dtype=self.fdmt.dtype)])
+        self.nin += block.shape[0]
+        return self._emit(self._buf.shape[0] - self.overlap)
+
+    def flush(self):
+        '''Finish the stream, taken to be zero after its end, returning the
+        DM transform of the remaining output samples.'''
+        nvalid = self._buf.shape[0]
+        self._buf = np.concatenate([self._buf, np.zeros((self.overlap, self.fdmt.nchan),
+                                                        dtype=self.fdmt.dtype)])
+        out = self._emit(nvalid)
+        self.reset()
+        return out
+
+    def _emit(self, nvalid):
+        if nvalid <= 0:
+            return np.zeros((0, self.dms.size), dtype=self.fdmt.dtype)
+        out = self.fdmt.apply(self._buf)[:nvalid]
+        self._buf = self._buf[nvalid:]
+        self.nout += nvalid
+        return out
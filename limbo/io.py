@@ -3,10 +3,10 @@
 import numpy as np
 import json
 import os
-from astropy.time import Time
 import struct
 
 from . import utils
+from . import _volt
 
 HEADER_SIZE = 1024
 NCHAN_DEFAULT = 2048
@@ -20,21 +20,25 @@ def _get_header_size(f):
         header_size = struct.unpack('I',f.read(4))[0]
     return header_size
 
+def _read_start_time(f, header_size, dtype=np.dtype('<u4')):
+    f.seek(header_size + 4, 0)  # add size of "header_size" 
+    # timestamp is 32b zeros, 32b sec, 32b zeros, 32b usec
+    sec, _, usec = np.frombuffer(f.read(12), dtype=dtype)
+    return float(sec) + float(usec) * 1e-6
+
 def read_start_time(filename, dtype=np.dtype('<u4')):
     '''Read sec, usec from first spectrum in file.'''
     with open(filename, 'rb') as f:
         header_size = _get_header_size(f)
-        f.seek(header_size + 4, 0)  # add size of "header_size" 
-        # timestamp is 32b zeros, 32b sec, 32b zeros, 32b usec
-        sec, _, usec = np.frombuffer(f.read(12), dtype=dtype)
-    return float(sec) + float(usec) * 1e-6
+        start_t = _read_start_time(f, header_size, dtype=dtype)
+    return start_t
 
 def read_raw_header(filename, lo_hz=1350e6, nchan=NCHAN_DEFAULT):
     '''Read header from a limbo file.'''
-    start_t = read_start_time(filename)
     with open(filename, 'rb') as f:
         header_size = _get_header_size(f)
         h = f.read(header_size)
+        start_t = _read_start_time(f, header_size)
     h = json.loads(h[:h.find(0x00)])
     h['filename'] = filename
     h['sample_clock'] = h.pop('SampleFreq') * 1e6
@@ -71,12 +75,27 @@ def calc_nspec_volt(hdr, infochan=24, dtype=np.dtype('>u1'), npol=2):
     return nspec
 
 
-def read_raw_data(filename, hdr, nspec, skip, nchan, infochan, dtype):
-    '''Read raw data from a limbo file.'''
+def read_raw_data(filename, hdr=None, nspec=-1, skip=0, nchan=NCHAN_DEFAULT,
+                  infochan=12, dtype=np.dtype('>u2'), mmap=False):
+    '''Read raw data from a limbo file.
+
+    If mmap is True, return a read-only np.memmap of the requested spectra
+    instead of copying the file into memory; pages are only read from disk
+    as they are accessed.'''
+    if hdr is None:
+        hdr = read_raw_header(filename, nchan=nchan)
+    dtype = np.dtype(dtype)
     spec_len = dtype.itemsize * (nchan + infochan)
+    start = hdr['data_start'] + skip * spec_len
+    if mmap:
+        navail = max((hdr['filesize'] - start) // spec_len, 0)
+        if nspec < 0 or nspec > navail:
+            nspec = navail
+        if nspec == 0:
+            return np.empty((0, infochan + nchan), dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode='r', offset=start,
+                         shape=(nspec, infochan + nchan))
     with open(filename, 'rb') as f:
-        start = hdr['data_start']
-        start += skip * spec_len
         f.seek(start, 0)
         if nspec < 0:
             data = np.frombuffer(f.read(), dtype=dtype)
@@ -87,33 +106,346 @@ def read_raw_data(filename, hdr, nspec, skip, nchan, infochan, dtype):
     return data
 
 def read_file(filename, nspec=-1, skip=0, lo_hz=1350e6, nchan=NCHAN_DEFAULT,
-              infochan=12, dtype=np.dtype('>u2')):
-    '''Read header and data from a limbo file.'''
+              infochan=12, dtype=np.dtype('>u2'), mmap=False):
+    '''Read header and data from a limbo file. If mmap is True, data is a
+    read-only, memory-mapped view with the info channels stripped.'''
     hdr = read_header(filename, lo_hz=lo_hz, nchan=nchan, infochan=infochan, dtype=dtype)
-    data = read_raw_data(filename, hdr, nspec, skip, nchan, infochan, dtype)
+    data = read_raw_data(filename, hdr, nspec, skip, nchan, infochan, dtype,
+                         mmap=mmap)
     assert data.shape[0] > 0  # make sure we read some data
-    data = data[:, infochan:]
+    data = data[:, infochan:]  # strided view, no copy
     hdr['times'] = hdr['Time'] + np.arange(skip, skip + data.shape[0]) * hdr['inttime']
+    from astropy.time import Time  # deferred: slow to import
     t = Time(hdr['times'], format='unix', scale='utc')
     hdr['jds'] = t.jd
-    hdr['date'] = t.strftime('%Y-%m-%d %H:%M:%S')[0]
+    hdr['date'] = t[0].strftime('%Y-%m-%d %H:%M:%S')
     return hdr, data
 
+def iter_spectra(filename, chunk_nspec, overlap=0, nspec=-1, skip=0,
+                 lo_hz=1350e6, nchan=NCHAN_DEFAULT, infochan=12,
+                 dtype=np.dtype('>u2')):
+    '''Iterate over a limbo file in blocks of up to chunk_nspec spectra.
+
+    Yields (times, data) for each block, where consecutive blocks share
+    their first/last overlap spectra. Data are read into one preallocated
+    buffer that is reused between blocks, so copy anything that must
+    outlive the next iteration.'''
+    assert 0 <= overlap < chunk_nspec
+    hdr = read_header(filename, lo_hz=lo_hz, nchan=nchan, infochan=infochan, dtype=dtype)
+    dtype = np.dtype(dtype)
+    spec_len = dtype.itemsize * (nchan + infochan)
+    nremain = hdr['nspec'] - skip
+    if nspec >= 0:
+        nremain = min(nremain, nspec)
+    raw = np.empty((chunk_nspec, infochan + nchan), dtype=dtype)
+    buf = np.empty((chunk_nspec, nchan), dtype=dtype)
+    ind = skip  # index of next spectrum to read from file
+    n = 0  # number of valid spectra in buf
+    with open(filename, 'rb') as f:
+        f.seek(hdr['data_start'] + skip * spec_len, 0)
+        while nremain > 0:
+            keep = min(overlap, n)
+            buf[:keep] = buf[n - keep:n]  # carry overlap to front of buffer
+            nread = min(chunk_nspec - keep, nremain)
+            nread = f.readinto(raw[:nread]) // spec_len
+            if nread == 0:
+                break
+            buf[keep:keep + nread] = raw[:nread, infochan:]
+            n = keep + nread
+            times = hdr['Time'] + np.arange(ind - keep, ind + nread) * hdr['inttime']
+            yield times, buf[:n]
+            ind += nread
+            nremain -= nread
+
+def decode_volt(raw, start=0, nchan=NCHAN_DEFAULT, npol=2, dtype='complex64', out=None):
+    '''Decode 4b voltages in a single pass.
+
+    Arguments:
+        raw: uint8 array (nspec, nbytes) of spectra as stored in file
+        start: Byte offset of voltage data in each spectrum (after info bytes)
+        dtype: 'complex64' for (nspec, nchan, npol) complex voltages, or
+            'int8' for (nspec, nchan, npol, 2) interleaved (real, imag) pairs
+        out: Optional C-contiguous output array of the above shape and dtype.
+    Returns:
+        out'''
+    raw = np.ascontiguousarray(raw).view(np.uint8)
+    nspec = raw.shape[0]
+    assert 0 <= start and start + nchan * npol <= raw.shape[1]  # kernels do not bounds check
+    shape = (nspec, nchan, npol)
+    dtype = np.dtype(dtype)
+    if dtype == np.int8:
+        shape += (2,)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    assert out.shape == shape and out.dtype == dtype and out.flags.c_contiguous
+    if dtype == np.complex64:
+        _volt.unpack_4b_complex(raw, start, out.reshape(nspec, nchan * npol))
+    elif dtype == np.int8:
+        _volt.unpack_4b_int8(raw, start, out.reshape(nspec, nchan * npol, 2))
+    else:
+        raise ValueError(f'Unsupported dtype {dtype}')
+    return out
+
+def detect_volt(raw, start=0, nchan=NCHAN_DEFAULT, npol=2, nint=1, sum_pols=True,
+                out=None, offset=0):
+    '''Detect power from 4b voltages without unpacking them, averaging every
+    nint spectra.
+
+    Arguments:
+        raw: uint8 array (nspec, nbytes) of spectra as stored in file
+        start: Byte offset of voltage data in each spectrum (after info bytes)
+        nint: Number of spectra to average into each output spectrum
+        sum_pols: If True, output (nspec // nint, nchan) power summed over
+            polarizations, else (nspec // nint, nchan, npol)
+        out: Optional float32 output to accumulate (sum, not average) into,
+            with spectrum i added to row (i + offset) // nint.
+    Returns:
+        out'''
+    raw = np.ascontiguousarray(raw).view(np.uint8)
+    shape = (nchan,) if sum_pols else (nchan, npol)
+    if out is None:
+        out = np.zeros((raw.shape[0] // nint,) + shape, dtype=np.float32)
+        _volt.power_4b(raw, start, npol, nint, offset, sum_pols,
+                       out.reshape(out.shape[0], -1))
+        out /= nint
+        return out
+    assert out.shape[1:] == shape and out.dtype == np.float32 and out.flags.c_contiguous
+    _volt.power_4b(raw, start, npol, nint, offset, sum_pols,
+                   out.reshape(out.shape[0], -1))
+    return out
+
+STOKES = ('I', 'Q', 'U', 'V')
+
+def stokes_volt(raw, start=0, nchan=NCHAN_DEFAULT, nint=1, nfint=1, out=None, offset=0):
+    '''Compute Stokes parameters from dual-polarization 4b voltages without
+    unpacking them, averaging every nint spectra and nfint channels. For
+    polarizations x, y: I = |x|^2 + |y|^2, Q = |x|^2 - |y|^2,
+    U = 2 Re(x* y), V = 2 Im(x* y).
+
+    Arguments:
+        raw: uint8 array (nspec, nbytes) of spectra as stored in file
+        start: Byte offset of voltage data in each spectrum (after info bytes)
+        nint: Number of spectra to average into each output spectrum
+        nfint: Number of channels to average into each output channel
+        out: Optional float32 output to accumulate (sum, not average) into,
+            with spectrum i added to row (i + offset) // nint.
+    Returns:
+        out: (nspec // nint, nchan // nfint, 4) Stokes I, Q, U, V'''
+    raw = np.ascontiguousarray(raw).view(np.uint8)
+    shape = (nchan // nfint, len(STOKES))
+    if out is None:
+        out = np.zeros((raw.shape[0] // nint,) + shape, dtype=np.float32)
+        _volt.stokes_4b(raw, start, nint, nfint, offset, out)
+        out /= nint * nfint
+        return out
+    assert out.shape[1:] == shape and out.dtype == np.float32 and out.flags.c_contiguous
+    _volt.stokes_4b(raw, start, nint, nfint, offset, out)
+    return out
+
+def read_volt_data(filename, hdr, nspec=-1, skip=0, nchan=NCHAN_DEFAULT,
+                   infochan=24, npol=2, mmap=False):
+    '''Read 4b voltage data from a limbo file, returning (data_real, data_imag)
+    with shape (nspec, nchan, npol).'''
+    # read data as longlong; decode_volt fixes a missed endian swap when
+    # voltage files are written from 64b network words
+    data = read_raw_data(filename, hdr, nspec, skip, npol*nchan//8,
+                         infochan//8, np.dtype('>u8'), mmap=mmap)
+    data = decode_volt(data, start=infochan, nchan=nchan, npol=npol, dtype='int8')
+    # polarization is the fastest array axis
+    return data[..., 0], data[..., 1]
+
+def read_volt_streams(filename, hdr, nspec=-1, skip=0, nchan=NCHAN_DEFAULT,
+                      infochan=24, npol=2, mmap=True, out=None):
+    '''Read 4b voltage data from a limbo file directly into complex64 with
+    shape (nspec, nchan, npol), optionally into a preallocated out.'''
+    data = read_raw_data(filename, hdr, nspec, skip, npol*nchan//8,
+                         infochan//8, np.dtype('>u8'), mmap=mmap)
+    return decode_volt(data, start=infochan, nchan=nchan, npol=npol, out=out)
+
 def read_volt_file(filename, nspec=-1, skip=0, lo_hz=1350e6, nchan=NCHAN_DEFAULT,
-                   infochan=24, npol=2):
-    '''Read header and data from a limbo file.'''
+                   infochan=24, npol=2, mmap=False):
+    '''Read header and data from a limbo file. If mmap is True, the file is
+    memory-mapped and only the requested spectra are read from disk.'''
     hdr = read_volt_header(filename, lo_hz=lo_hz, nchan=nchan, infochan=infochan, dtype=np.dtype('>u1'), npol=npol)
-    # read data as longlong and perform endian swap to fix a missed endian
-    # swap when voltage files are written from 64b network words
-    data = read_raw_data(filename, hdr, nspec, skip, npol*nchan//8,
-                         infochan//8, np.dtype('>u8'))
-    assert data.shape[0] > 0  # make sure we read some data
-    data = data[:, infochan//8:].byteswap().view('>u1')  # endian swap
-    data.shape = (-1, NCHAN_DEFAULT, npol)  # polarization is the fastest array axis
-    data_real = (data & 0xf0).view('>i1') >> 4
-    data_imag = ((data << 4) & 0xf0).view('>i1') >> 4
-    hdr['times'] = hdr['Time'] + np.arange(skip, skip + data.shape[0]) * hdr['inttime'] # VS 'Time' = start time of file
+    data_real, data_imag = read_volt_data(filename, hdr, nspec, skip, nchan,
+                                          infochan, npol, mmap=mmap)
+    assert data_real.shape[0] > 0  # make sure we read some data
+    hdr['times'] = hdr['Time'] + np.arange(skip, skip + data_real.shape[0]) * hdr['inttime'] # VS 'Time' = start time of file
+    from astropy.time import Time
     t = Time(hdr['times'], format='unix', scale='utc')
     hdr['jds'] = t.jd
-    hdr['date'] = t.strftime('%Y-%m-%d %H:%M:%S')[0]
+    hdr['date'] = t[0].strftime('%Y-%m-%d %H:%M:%S')
     return hdr, data_real, data_imag
+
+
+class FileSeries:
+    '''A time-sorted set of consecutive limbo files (power spectra or
+    voltages) indexed as one continuous array of spectra. Only the files
+    overlapping a requested range are opened.'''
+
+    def __init__(self, filenames, volt=False, lo_hz=1350e6, nchan=NCHAN_DEFAULT,
+                 infochan=None, npol=2, hdrs=None):
+        '''Arguments:
+            filenames: Files to include. Order does not matter.
+            volt: If True, files are voltage files, otherwise power spectra.
+            infochan: Info channels per spectrum (default 24 volt, 12 power).
+            hdrs: Optional pre-read headers matching filenames.'''
+        self.volt = volt
+        if infochan is None:
+            infochan = 24 if volt else 12
+        self.nchan = nchan
+        self.infochan = infochan
+        self.npol = npol
+        if hdrs is None:
+            if volt:
+                hdrs = [read_volt_header(f, lo_hz=lo_hz, nchan=nchan,
+                            infochan=infochan, npol=npol) for f in filenames]
+            else:
+                hdrs = [read_header(f, lo_hz=lo_hz, nchan=nchan,
+                            infochan=infochan) for f in filenames]
+        hdrs = sorted([h for h in hdrs if h['nspec'] > 0], key=lambda h: h['Time'])
+        assert len(hdrs) > 0  # make sure there is some data
+        self.hdrs = hdrs
+        self.filenames = [h['filename'] for h in hdrs]
+        self.freqs = hdrs[0]['freqs']
+        self.inttime = hdrs[0]['inttime']
+        assert np.allclose([h['inttime'] for h in hdrs], self.inttime)
+        self.start_times = np.array([h['Time'] for h in hdrs])
+        self.nspecs = np.array([h['nspec'] for h in hdrs])
+        self.offsets = np.concatenate([[0], np.cumsum(self.nspecs)])
+        self.nspec = int(self.offsets[-1])
+        # time between the end of each file and the start of the next
+        ends = self.start_times[:-1] + self.nspecs[:-1] * self.inttime
+        self.gaps = self.start_times[1:] - ends
+
+    @property
+    def times(self):
+        '''Unix time of every spectrum in the series.'''
+        return np.concatenate([t0 + np.arange(n) * self.inttime
+                               for t0, n in zip(self.start_times, self.nspecs)])
+
+    def find_gaps(self, tol=0.5):
+        '''Return indices i of files followed by a gap (or overlap) larger
+        than tol integrations before file i+1, and the gaps in seconds.'''
+        inds = np.where(np.abs(self.gaps) > tol * self.inttime)[0]
+        return inds, self.gaps[inds]
+
+    def time_to_index(self, t):
+        '''Convert unix time(s) to global spectrum index(es).'''
+        t = np.asarray(t)
+        i = np.clip(np.searchsorted(self.start_times, t, side='right') - 1,
+                    0, len(self.hdrs) - 1)
+        # allow 1 us (timestamp resolution) of slack so that times on a
+        # spectrum boundary map to that spectrum despite rounding
+        ind = np.floor((t - self.start_times[i] + 1e-6) / self.inttime).astype(int)
+        ind = np.clip(ind, 0, self.nspecs[i])
+        return self.offsets[i] + ind
+
+    def file_range(self, skip, end):
+        '''Return (i0, i1) such that files i0..i1-1 overlap spectra skip..end-1.'''
+        i0 = np.searchsorted(self.offsets, skip, side='right') - 1
+        i1 = np.searchsorted(self.offsets, end, side='left')
+        return int(i0), int(i1)
+
+    def _read(self, i, nspec, skip, mmap):
+        hdr = self.hdrs[i]
+        if self.volt:
+            return read_volt_data(hdr['filename'], hdr, nspec, skip, self.nchan,
+                                  self.infochan, self.npol, mmap=mmap)
+        data = read_raw_data(hdr['filename'], hdr, nspec, skip, self.nchan,
+                             self.infochan, np.dtype('>u2'), mmap=mmap)
+        return (data[:, self.infochan:],)
+
+    def read(self, skip=0, nspec=-1, mmap=False):
+        '''Read spectra skip..skip+nspec-1 of the series.
+
+        Returns (times, data) for power spectra or (times, data_real,
+        data_imag) for voltages. A range inside one file is returned
+        directly (a memory-mapped view if mmap is True); ranges spanning
+        files are copied once into a preallocated output.'''
+        end = self.nspec if nspec < 0 else min(skip + nspec, self.nspec)
+        assert 0 <= skip < end  # make sure we read some data
+        i0, i1 = self.file_range(skip, end)
+        times = np.empty(end - skip, dtype=float)
+        out = None
+        for i in range(i0, i1):
+            lskip = int(max(skip - self.offsets[i], 0))
+            lend = int(min(end - self.offsets[i], self.nspecs[i]))
+            o0 = self.offsets[i] + lskip - skip
+            o1 = o0 + lend - lskip
+            times[o0:o1] = self.start_times[i] + np.arange(lskip, lend) * self.inttime
+            pieces = self._read(i, lend - lskip, lskip, mmap)
+            if i1 - i0 == 1:
+                out = pieces
+                break
+            if out is None:
+                out = tuple(np.empty((end - skip,) + d.shape[1:], dtype=d.dtype)
+                            for d in pieces)
+            for o, d in zip(out, pieces):
+                o[o0:o1] = d
+        return (times,) + tuple(out)
+
+    def read_power(self, skip=0, nspec=-1, nint=1, sum_pols=True, mmap=True):
+        '''Read detected power of voltage spectra skip..skip+nspec-1,
+        averaged every nint spectra, without unpacking the voltages.
+        Returns (times, power), where times are the mean time of each
+        output spectrum.'''
+        assert self.volt
+        end = self.nspec if nspec < 0 else min(skip + nspec, self.nspec)
+        nout = (end - skip) // nint
+        assert nout > 0  # make sure we read some data
+        end = skip + nout * nint
+        i0, i1 = self.file_range(skip, end)
+        shape = (self.nchan,) if sum_pols else (self.nchan, self.npol)
+        power = np.zeros((nout,) + shape, dtype=np.float32)
+        times = np.zeros(nout, dtype=float)
+        for i in range(i0, i1):
+            lskip = int(max(skip - self.offsets[i], 0))
+            lend = int(min(end - self.offsets[i], self.nspecs[i]))
+            offset = int(self.offsets[i] + lskip - skip)
+            hdr = self.hdrs[i]
+            raw = read_raw_data(hdr['filename'], hdr, lend - lskip, lskip,
+                                self.npol * self.nchan // 8, self.infochan // 8,
+                                np.dtype('>u8'), mmap=mmap)
+            detect_volt(raw, start=self.infochan, nchan=self.nchan, npol=self.npol,
+                        nint=nint, sum_pols=sum_pols, out=power, offset=offset)
+            t = self.start_times[i] + np.arange(lskip, lend) * self.inttime
+            np.add.at(times, (offset + np.arange(t.size)) // nint, t)
+        power /= nint
+        times /= nint
+        return times, power
+
+    def read_stokes(self, skip=0, nspec=-1, nint=1, nfint=1, mmap=True):
+        '''Read Stokes I, Q, U, V of voltage spectra skip..skip+nspec-1,
+        averaged every nint spectra and nfint channels, without unpacking
+        the voltages (see stokes_volt). Returns (times, stokes), where times
+        are the mean time of each output spectrum and stokes has shape
+        (nout, nchan // nfint, 4).'''
+        assert self.volt and self.npol == 2
+        end = self.nspec if nspec < 0 else min(skip + nspec, self.nspec)
+        nout = (end - skip) // nint
+        assert nout > 0  # make sure we read some data
+        end = skip + nout * nint
+        i0, i1 = self.file_range(skip, end)
+        stokes = np.zeros((nout, self.nchan // nfint, len(STOKES)), dtype=np.float32)
+        times = np.zeros(nout, dtype=float)
+        for i in range(i0, i1):
+            lskip = int(max(skip - self.offsets[i], 0))
+            lend = int(min(end - self.offsets[i], self.nspecs[i]))
+            offset = int(self.offsets[i] + lskip - skip)
+            hdr = self.hdrs[i]
+            raw = read_raw_data(hdr['filename'], hdr, lend - lskip, lskip,
+                                self.npol * self.nchan // 8, self.infochan // 8,
+                                np.dtype('>u8'), mmap=mmap)
+            stokes_volt(raw, start=self.infochan, nchan=self.nchan, nint=nint, nfint=nfint,
+                        out=stokes, offset=offset)
+            t = self.start_times[i] + np.arange(lskip, lend) * self.inttime
+            np.add.at(times, (offset + np.arange(t.size)) // nint, t)
+        stokes /= nint * nfint
+        times /= nint
+        return times, stokes
+
+    def read_time(self, t0, t1, mmap=False):
+        '''Read all spectra with unix times in [t0, t1).'''
+        skip, end = self.time_to_index([t0, t1])
+        return self.read(skip, end - skip, mmap=mmap)
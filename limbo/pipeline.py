@@ -0,0 +1,470 @@
+'''Headless processing of LIMBO spectra files, following the stages of the
+limbo_*_processing_template notebooks without a notebook kernel.'''
+
+import numpy as np
+import shutil
+import glob
+import os
+
+from . import io
+from . import processing
+from . import candidates
+from .utils import DM_delay, dedisperse_events
+from .fdmt import StreamingFDMT
+from .catalog import HeaderCatalog
+from .database import HEADER, DATABASE_DIR
+
+DM_RANGES = [(0, 100), (100, 200), (200, 300), (300, 400), (400, 500),
+             (500, 1000), (1000, 2000), (2000, 3000), (3000, 4000)]
+
+DEFAULT_CONFIG = {
+    'nsig': 5.5,            # threshold [sigma] for stage 1 and 3 events
+    'max_dm': 500,          # max DM of the DM transform
+    'min_dm': 0,            # min DM of the DM transform
+    'ndm': None,            # DM trials (None: one per channel, see fdmt.FDMT)
+    'mask_dm': None,        # if set, veto events coincident with out_keys
+    'exclude_s': 0.05,      # [s] veto exclusion window (with mask_dm)
+    'ch0': 398,             # channels used in DM transform and stage 2
+    'ch1': 398 + 1024,
+    'dm_ranges': DM_RANGES,
+    'in_keys': [(300, 400)],
+    'out_keys': [(0, 100), (100, 200)],
+    'dm': 332.7,            # stage 2 de-dispersion DM
+    'resamp': 4,            # stage 2 over-sampling factor
+    'dedisp_mode': 'fft',   # stage 2 de-dispersion mode (see utils.dedisperse)
+    'event_pad_s': 0.02,    # stage 2 window padding around stage 1 events [s]
+    'seed': 0,              # seed for inpainting flagged data
+    'fdmt_cache_dir': None, # on-disk FDMT plans (default fdmt.CACHE_DIR)
+    'fdmt_phase_mem': None, # bytes of stored FDMT phases (None: all stages)
+    'fdmt_engine': 'fft',   # 'fft' or 'time' (see fdmt.TimeFDMT)
+    'save_dir': None,       # where to move files with events
+    'remove_dir': None,     # where to move files without events
+    'volt_dir': None,       # where to find voltage files
+    'volt_save_dir': None,  # where to move voltage files for saved events
+    'volt_window': (-1, 5), # [s] voltage start times to save, rel. to file
+    'catalog': None,        # header catalog file for voltage lookups (see catalog)
+    'update_database': False,
+    'database_dir': DATABASE_DIR,
+    'plot_dir': None,       # if set, save a summary plot here
+    'cand_widths': (1,),    # boxcar widths [integrations] for candidates
+    'cand_t_s': 0.01,       # [s] candidate clustering length in time
+    'cand_dm': 10,          # candidate clustering length in DM
+    'verbose': False,
+}
+
+SOURCE_CONFIGS = {
+    'sgr1935': {},
+    'crab': {
+        'max_dm': 100,
+        'dm_ranges': [(0, 20), (20, 40), (40, 60), (60, 80), (80, 100)],
+        'in_keys': [(40, 60)],
+        'out_keys': [(0, 20), (20, 40)],
+        'dm': 56.7,
+    },
+    'FRB20240114': {
+        'max_dm': 700,
+        'dm_ranges': [(0, 100), (100, 200), (200, 300), (300, 400), (400, 500),
+                      (500, 600), (600, 700), (700, 800), (800, 900), (900, 1000)],
+        'in_keys': [(500, 600)],
+        'out_keys': [(0, 100), (100, 200), (200, 300), (300, 400)],
+        'dm': 529,
+    },
+}
+
+def get_config(source=None, **kwargs):
+    '''Return the processing config for a source (None for the defaults),
+    with overrides. Raises ValueError for sources not in SOURCE_CONFIGS.'''
+    config = DEFAULT_CONFIG.copy()
+    if source is not None:
+        if source not in SOURCE_CONFIGS:
+            raise ValueError(f'No processing config for source {source!r} '
+                             f'(known: {", ".join(SOURCE_CONFIGS)})')
+        config.update(SOURCE_CONFIGS[source])
+    config.update(kwargs)
+    return config
+
+def get_source(hdr):
+    '''Return the name of the source observed, from a file header: its
+    'Source', or else one matching its pointing. None if not recognized.'''
+    try:
+        return hdr['Source']
+    except(KeyError):
+        from . import telescope
+        ra, dec = hdr['Target_RA_Deg'], hdr['Target_DEC_Deg']
+        if ra == telescope.SGR_RA and dec == telescope.SGR_DEC:
+            return 'sgr1935'
+        elif ra == telescope.CRAB_RA and dec == telescope.CRAB_DEC:
+            return 'crab'
+    return None
+
+def dm_range_max(dm_vs_t, dms, dm_ranges):
+    '''Return {(lo, hi): max of dm_vs_t over DMs in [lo, hi)} for each range
+    containing any dms, reducing over the DM axis in a single pass.
+    Arguments:
+        dm_vs_t: (ntimes, ndms) DM transform.
+        dms: (ndms,) DM of each column, sorted ascending.
+        dm_ranges: List of (lo, hi) DM ranges, or a sorted array of DM bin
+            edges.
+    '''
+    if np.ndim(dm_ranges) == 1:
+        dm_ranges = list(zip(dm_ranges[:-1], dm_ranges[1:]))
+    dm_ranges = [tuple(k) for k in dm_ranges]
+    lo = np.searchsorted(dms, [k[0] for k in dm_ranges])
+    hi = np.searchsorted(dms, [k[1] for k in dm_ranges])
+    keep = hi > lo
+    edges = np.unique(np.concatenate([lo[keep], hi[keep]]))
+    edges = edges[edges < dm_vs_t.shape[1]]
+    if edges.size == 0:
+        return {}
+    # column j of seg is the max over dms[edges[j]:edges[j + 1]]
+    seg = np.maximum.reduceat(dm_vs_t, edges, axis=1)
+    j0 = np.searchsorted(edges, lo)
+    j1 = np.searchsorted(edges, hi)
+    rv = {}
+    for k, i, j, ok in zip(dm_ranges, j0, j1, keep):
+        if ok:
+            rv[k] = seg[:, i] if j == i + 1 else seg[:, i:j].max(axis=1)
+    return rv
+
+def veto_threshold(out, nsig, ker, delta):
+    '''Return the event threshold vs. time: nsig, raised to the 'out' zscore
+    within ker + delta integrations (rolled by delta / 2 to follow the
+    dispersion sweep). If delta is None, a constant nsig.'''
+    if delta is None:
+        return np.ones_like(out) * nsig
+    from scipy.ndimage import maximum_filter1d
+    _roll_amt = -int(np.around(delta / 2))
+    return np.roll(maximum_filter1d(out, size=ker + delta, mode='nearest').clip(nsig, np.inf),
+                   _roll_amt)
+
+class Summary:
+    '''Peak DM transform response vs. time in ranges of DM, and the events
+    found from it.'''
+
+    def __init__(self, dm_ranges=DM_RANGES):
+        self.dm_ranges = dm_ranges
+        self.clear()
+
+    def clear(self):
+        self.dms = {tuple(k): [] for k in self.dm_ranges}
+
+    def add_summary(self, summary):
+        for k, v in dm_range_max(summary['dmt'], summary['dms'], list(self.dms)).items():
+            self.dms[k].append(v)
+
+    def get_summary(self):
+        rv = {}
+        for k, v in self.dms.items():
+            try:
+                rv[k] = np.concatenate(v)
+            except(ValueError):
+                pass
+        return rv
+
+    def get_events(self, ker, nsig, summary=None, in_keys=[(300,400)], out_keys=[(0,100),(100,200)],
+                   delta=None, verbose=False):
+        '''Return zscores (from median and MAD) of each DM range, and the
+        'in', 'out', 'thresh' (see veto_threshold), and 'interesting' time
+        series.'''
+        if summary is None:
+            summary = self.get_summary()
+        keys = [k for k in summary if type(k) != str]
+        v = np.array([summary[k] for k in keys])
+        avg = np.median(v, axis=1, keepdims=True)
+        sig = np.median(np.abs(v - avg), axis=1, keepdims=True)
+        zscore = (v - avg) / sig
+        events = dict(zip(keys, zscore))
+        if verbose:
+            for k, a, s in zip(keys, avg[:, 0], sig[:, 0]):
+                print(f'DM={k}: avg={a:7.2f} +/- {s:7.2f}')
+        events['out'] = np.array([events[k] for k in out_keys]).max(axis=0)
+        events['in'] = np.array([events[k] for k in in_keys]).max(axis=0)
+        events['thresh'] = veto_threshold(events['out'], nsig, ker, delta)
+        events['interesting'] = (events['in'] > events['thresh'])
+        return events
+
+def _move(filename, outdir, verbose=False):
+    outfile = os.path.join(outdir, os.path.basename(filename))
+    if verbose:
+        print(f'Moving {filename} -> {outfile}')
+    shutil.move(filename, outfile)
+    return outfile
+
+class Stream:
+    '''State carried between contiguous spectra files by process_files: the
+    streaming DM transform and the detrended data of times whose DM
+    transform is not yet complete. The DM transform is always the
+    time-domain fdmt.StreamingFDMT; config 'fdmt_engine', 'fdmt_cache_dir'
+    and 'fdmt_phase_mem' do not apply.'''
+
+    def __init__(self, hdr, config):
+        ch0, ch1 = config['ch0'], config['ch1']
+        self.fdmt = StreamingFDMT(hdr['freqs'][ch0:ch1], hdr['inttime'], maxDM=config['max_dm'],
+                                  minDM=config['min_dm'], ndm=config['ndm'])
+        self.freqs = hdr['freqs']
+        self.inttime = hdr['inttime']
+        self.diff = np.zeros((0, self.freqs.size), dtype='float32')
+        self.end = hdr['Time']  # expected start time of the next file
+
+    def follows(self, hdr):
+        '''Return whether a file with header hdr continues this stream.'''
+        return (hdr['inttime'] == self.inttime and np.array_equal(hdr['freqs'], self.freqs)
+                and abs(hdr['Time'] - self.end) < self.inttime / 2)
+
+def process_files(filenames, config=None):
+    '''Run process_file on spectra files in order, carrying the DM transform
+    across contiguous files (see Stream) so that sweeps straddling a file
+    boundary are found in full. Stage 1 of each file covers times from the
+    previous file's last Stream.fdmt.overlap samples to its own last
+    overlap samples, and the last file of a contiguous run flushes the
+    stream to cover its tail. Events at times before a file's start are
+    credited to the previous file, so each file is moved and recorded in
+    the database only once the next file has been processed. Returns a list
+    of process_file results.'''
+    if config is None:
+        config = get_config()
+    results, stream, pending = [], None, None
+    nxt = io.read_header(filenames[0]) if len(filenames) > 0 else None
+    for i, filename in enumerate(filenames):
+        hdr = nxt
+        if stream is None or not stream.follows(hdr):
+            if pending is not None:
+                _finish(pending, config)
+                pending = None
+            stream = Stream(hdr, config)
+        stream.end = hdr['Time'] + hdr['nspec'] * hdr['inttime']
+        # the last file of a contiguous run flushes the stream
+        nxt = io.read_header(filenames[i + 1]) if i + 1 < len(filenames) else None
+        flush = nxt is None or not stream.follows(nxt)
+        rv = process_file(filename, config, stream=stream, flush=flush)
+        if pending is not None:
+            _credit(pending, rv, config['resamp'])
+            _finish(pending, config)
+        pending = rv
+        results.append(rv)
+    if pending is not None:
+        _finish(pending, config)
+    return results
+
+def _credit(prev, rv, resamp):
+    '''Move stage 3 events of result rv at times before its file's start to
+    result prev of the preceding file.'''
+    dt = rv['hdr']['Time'] - prev['hdr']['Time']
+    dtind = resamp * prev['hdr']['times'].size
+    early = rv['t_events'] < 0
+    prev['t_events'] = np.concatenate([prev['t_events'], rv['t_events'][early] + dt])
+    prev['tind_events'] = np.concatenate([prev['tind_events'], rv['tind_events'][early] + dtind])
+    rv['t_events'] = rv['t_events'][~early]
+    rv['tind_events'] = rv['tind_events'][~early]
+    early = rv['pulses']['time'] < 0
+    moved = {k: v[early] for k, v in rv['pulses'].items()}
+    moved['time'] = moved['time'] + dt
+    moved['tind'] = moved['tind'] + dtind
+    prev['pulses'] = {k: np.concatenate([v, moved[k]]) for k, v in prev['pulses'].items()}
+    rv['pulses'] = {k: v[~early] for k, v in rv['pulses'].items()}
+    for r in (prev, rv):
+        r['save_file'] = r['tind_events'].size > 0
+        if r['save_file']:
+            r['zmax'] = np.max(r['pulses']['zscore'])
+        elif r is rv and np.any(early):
+            r['zmax'] = np.nan  # its peak was the credited event
+
+def process_file(filename, config=None, stream=None, flush=False):
+    '''Search a LIMBO spectra file for dispersed events.
+    Stage 1 flags times where the peak DM transform zscore in config
+    'in_keys' DM ranges exceeds the threshold. Stage 2 de-disperses windows
+    around these times to config 'dm' (see utils.dedisperse_events). Stage 3 keeps events whose de-dispersed zscore
+    exceeds the threshold. The file is then moved to 'save_dir' (with
+    nearby voltage files) or 'remove_dir', and a database entry written.
+    Arguments:
+        filename: LIMBO spectra file.
+        config: Dictionary of settings (see DEFAULT_CONFIG and get_config).
+        stream: Stream continued by this file (see process_files), or None
+            to process the file on its own. With a stream, the file is left
+            for process_files to move and record.
+        flush: Whether this file ends the stream, so that stream.fdmt is
+            flushed and the tail of the file searched too.
+    Returns:
+        result: Dictionary with keys 'filename', 'hdr', 'events',
+            'interesting', 'tind_events', 't_events', 'zmax', 'save_file',
+            'hist', 'bins', 'outfile', 'database' (the database entry),
+            'candidates' (clustered stage 1 peaks; see
+            candidates.find_candidates), and 'pulses' (stage 3 events
+            clustered in time, with keys 'tind', 'time', 'zscore', 'count').
+            Event times are relative to the file start, and tind in
+            samples of the over-sampled stage 2 profile from the file start.
+    '''
+    if config is None:
+        config = get_config()
+    verbose = config['verbose']
+    ch0, ch1 = config['ch0'], config['ch1']
+    hdr, data = io.read_file(filename)
+    if verbose:
+        print('Processing:', filename)
+
+    ### STAGE 1: Look for all events above threshold.
+    dmt = processing.process_data(hdr, data, maxdm=config['max_dm'], inpaint=True,
+                                  ch0=ch0, ch1=ch1, rng=config['seed'],
+                                  fdmt_cache_dir=config['fdmt_cache_dir'],
+                                  fdmt_phase_mem=config['fdmt_phase_mem'],
+                                  mindm=config['min_dm'], ndm=config['ndm'],
+                                  fdmt_engine=config['fdmt_engine'],
+                                  dedisperser=None if stream is None else stream.fdmt)
+    del data
+    # rows of the DM transform (and stage 2 data) start tind0 samples into the file
+    tind0 = dmt.get('dmt_tind0', 0)
+    diff, times = dmt['diff'], hdr['times']
+    if stream is not None:
+        if flush:
+            dmt['dmt'] = np.concatenate([dmt['dmt'], stream.fdmt.flush()])
+        diff = np.concatenate([stream.diff, diff])
+        times = hdr['Time'] + (tind0 + np.arange(diff.shape[0])) * hdr['inttime']
+        stream.diff = diff[dmt['dmt'].shape[0]:].copy()
+    summary = Summary(config['dm_ranges'])
+    summary.add_summary(dmt)
+    report = summary.get_summary()
+    ker = int(np.around(config['exclude_s'] / hdr['inttime']))
+    delta = None
+    if config['mask_dm'] is not None:
+        # use worst case scenarios to set the veto window
+        delay0 = DM_delay(0, hdr['freqs'][0])
+        delayf = DM_delay(config['mask_dm'], hdr['freqs'][0])
+        delta = int(np.around((delayf - delay0) / hdr['inttime']) / 2)
+    events = summary.get_events(ker, config['nsig'], summary=report,
+                                in_keys=config['in_keys'], out_keys=config['out_keys'],
+                                delta=delta, verbose=verbose)
+    interesting = np.any(events['interesting'])
+    t_link = int(np.around(config['cand_t_s'] / hdr['inttime']))
+    ddm = np.diff(dmt['dms'])
+    ddm = ddm[ddm > 0]
+    dm_link = int(np.around(config['cand_dm'] / ddm.min())) if ddm.size else 1
+    cands = candidates.find_candidates(dmt['dmt'], dmt['dms'], config['nsig'],
+                                       times=times[:dmt['dmt'].shape[0]],
+                                       widths=config['cand_widths'],
+                                       t_link=t_link, dm_link=dm_link)
+
+    ### STAGE 2: De-disperse files with events to the DM of the source.
+    hist, bins, zmax = np.nan, np.nan, np.nan
+    tind_events = np.array([], dtype=int)
+    t_events = np.array([])
+    pulses = {'tind': tind_events, 'time': t_events, 'zscore': np.array([]),
+              'count': np.array([], dtype=int)}
+    if interesting:
+        resamp = config['resamp']
+        cal_data = diff * processing.CALGAIN
+        pad = int(np.around(config['event_pad_s'] / hdr['inttime']))
+        windows, profiles, zscores = dedisperse_events(
+            cal_data, np.nonzero(events['interesting'])[0], config['dm'], hdr['freqs'],
+            hdr['inttime'], oversample=resamp, ch0=ch0, ch1=ch1, pad=pad,
+            mode=config['dedisp_mode'])
+        del cal_data
+        tind = np.concatenate([np.arange(t0, t1) for t0, t1 in windows])
+        avg_profile = np.concatenate(profiles)
+        zscore = np.concatenate(zscores)
+        thresh = np.pad(events['thresh'], (0, diff.shape[0] - events['thresh'].size),
+                        mode='edge')
+        thresh_interp = np.repeat(thresh, resamp)[tind]
+        _dts = np.linspace(times[0], times[-1], resamp * times.size, endpoint=False)
+        zeroed_dts = _dts - hdr['Time']
+        _bins = np.linspace(1, 7, 100)
+        hist, bins_edges = np.histogram(np.log10(avg_profile[avg_profile > 0]), bins=_bins)
+        bins = 0.5 * (bins_edges[1:] + bins_edges[:-1])
+
+        ### STAGE 3: Keep events whose de-dispersed zscores are above threshold.
+        above = np.nonzero(zscore > thresh_interp)[0]
+        t_events = zeroed_dts[tind[above]]
+        tind_events = tind[above] + resamp * tind0  # from the start of the file
+        if tind_events.size > 0:
+            zmax = np.max(zscore[above])
+            labels = candidates.cluster(tind_events, np.zeros_like(tind_events),
+                                        t_link=t_link * resamp, dm_link=0)
+            best, count = candidates.sift(labels, zscore[above])
+            pulses = {'tind': tind_events[best], 'time': t_events[best],
+                      'zscore': zscore[above][best], 'count': count}
+        else:
+            zmax = np.max(zscore)
+    save_file = tind_events.size > 0
+    if verbose:
+        print('Anything Interesting:', interesting)
+        print('Save file:', save_file)
+        if save_file:
+            print(f'De-dispersed Z-score: {zmax:4.1f}')
+            print(f"Time of events: {pulses['time']} ({tind_events.size} samples)")
+    if config['plot_dir'] is not None:
+        plot_summary(hdr, dmt, report, events,
+                     os.path.join(config['plot_dir'], os.path.basename(filename) + '.png'),
+                     times=times[:dmt['dmt'].shape[0]])
+
+    thresh_vals, thresh_cnts = np.unique(events['thresh'], return_counts=True)
+    tmask_vals, tmask_cnts = np.unique(dmt['tmask'], return_counts=True)
+    db = [filename, hdr['Time'], hdr.get('Target_RA_Deg'), hdr.get('Target_DEC_Deg'),
+          tind_events.size, zmax, hist, bins, thresh_vals, thresh_cnts,
+          tmask_vals, tmask_cnts]
+    rv = {'filename': filename, 'hdr': hdr, 'events': events,
+          'interesting': interesting, 'tind_events': tind_events,
+          't_events': t_events, 'zmax': zmax, 'save_file': save_file,
+          'hist': hist, 'bins': bins, 'outfile': filename,
+          'database': dict(zip(HEADER, db)), 'candidates': cands, 'pulses': pulses}
+    if stream is None:
+        _finish(rv, config)
+    return rv
+
+def _finish(rv, config):
+    '''Move the file of process_file result rv (and nearby voltage files)
+    according to rv['save_file'], and write its database entry.'''
+    verbose = config['verbose']
+    filename, hdr = rv['filename'], rv['hdr']
+    if rv['save_file']:
+        if config['save_dir'] is not None:
+            rv['outfile'] = _move(filename, config['save_dir'], verbose=verbose)
+        if config['volt_save_dir'] is not None and config['volt_dir'] is not None:
+            for vfile in _volt_files(hdr['Time'], config):
+                _move(vfile, config['volt_save_dir'], verbose=verbose)
+    elif config['remove_dir'] is not None:
+        # voltage data deletes automatically when ring buffer overwrites
+        rv['outfile'] = _move(filename, config['remove_dir'], verbose=verbose)
+    database = rv['database']
+    database['nevents'] = rv['tind_events'].size
+    database['zscore'] = rv['zmax']
+    if config['update_database']:
+        np.savez(os.path.join(config['database_dir'], os.path.basename(filename)), **database)
+
+def _volt_files(t, config):
+    '''Return voltage files in config 'volt_dir' starting within config
+    'volt_window' of unix time t. Uses the HeaderCatalog in config
+    'catalog' if set, else reads the start time of every file.'''
+    t0, t1 = config['volt_window']
+    volt_dir = config['volt_dir']
+    if config['catalog'] is None:
+        return [f for f in sorted(glob.glob(os.path.join(volt_dir, '*.dat')))
+                if t0 < io.read_start_time(f) - t < t1]
+    with HeaderCatalog(config['catalog']) as cat:
+        cat.update_dir(volt_dir, filetype='volt')  # only new or changed files are read
+        return [f for f in cat.query(t + t0, t + t1, filetype='volt', dirname=volt_dir)
+                if os.path.exists(f) and t0 < cat.get_header(f)['Time'] - t < t1]
+
+def plot_summary(hdr, dmt, report, events, outfile, nrows=512, times=None):
+    '''Save a plot of the DM transform (averaged down to at most nrows
+    times) and the DM range zscores vs. time. Times of the DM transform
+    rows default to hdr['times'].'''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    dts = (hdr['times'] if times is None else times) - hdr['Time']
+    dm_vs_t = dmt['dmt']
+    step = max(1, dm_vs_t.shape[0] // nrows)
+    n = dm_vs_t.shape[0] // step * step
+    dm_vs_t = dm_vs_t[:n].reshape(-1, step, dm_vs_t.shape[1]).max(axis=1)
+    fig, axes = plt.subplots(ncols=2, figsize=(12, 6), dpi=90)
+    axes[0].imshow(dm_vs_t, cmap='plasma', vmin=0, interpolation='nearest', aspect='auto',
+                   extent=(dmt['dms'][0], dmt['dms'][-1], dts[-1], dts[0]))
+    axes[0].set_xlabel('DM [pc / cm$^3$]')
+    axes[0].set_ylabel('Time [s]')
+    for k in report:
+        axes[1].plot(dts, events[k], label=k, alpha=0.5)
+    axes[1].plot(dts, events['thresh'], 'k', linestyle='dashed')
+    axes[1].set_xlabel('Time [s]')
+    axes[1].set_ylabel('Z-score')
+    axes[1].legend(ncol=3)
+    fig.savefig(outfile)
+    plt.close(fig)
@@ -1,10 +1,9 @@
 import numpy as np
 import os
-from .fdmt import FDMT
-from .io import read_volt_file, read_volt_header
-from .utils import DM_delay, dedisperse
-from tqdm import tqdm
-from scipy.special import erf
+from .fdmt import get_fdmt
+from .io import read_volt_file, read_volt_header, FileSeries
+from .utils import DM_delay, dm_search, get_noise
+from . import _process
 
 PRECISION = 1
 
@@ -16,24 +15,44 @@ else:
     DTYPE = 'float64'
     CDTYPE = 'complex128'
 
-# Load matrices used to remove baseline structure along time and frequency axes
+# Matrices used to remove baseline structure along time and frequency axes
+# are loaded on first access (e.g. processing.FMDL) rather than at import.
 
 BANDPASS_FILE = os.path.join(os.path.dirname(__file__),'data', 'bandpass_v002.npz')
-BANDPASS_NPZ = np.load(BANDPASS_FILE)
-FMDL = BANDPASS_NPZ['mdl']
-FMDL = np.roll(FMDL, shift=-2).astype(DTYPE)
-
 CAL_FILE = os.path.join(os.path.dirname(__file__),'data', 'calibration_v001.npz')
-CAL_NPZ = np.load(CAL_FILE)
-CALGAIN = CAL_NPZ['cnt2jy']
-CALGAIN = np.roll(CALGAIN, shift=-2).astype(DTYPE)
+FREQMASK_FILE = os.path.join(os.path.dirname(__file__),'data', 'freq_mask_v004.npz')
 
+def _load_bandpass():
+    fmdl = np.load(BANDPASS_FILE)['mdl']
+    return {'FMDL': np.roll(fmdl, shift=-2).astype(DTYPE)}
 
-FREQMASK_FILE = os.path.join(os.path.dirname(__file__),'data', 'freq_mask_v004.npz')
-FREQ_MASK_NPZ = np.load(FREQMASK_FILE)
-FREQ_MASK = FREQ_MASK_NPZ['mask']
-FREQ_AMAT = FREQ_MASK_NPZ['amat'].astype(CDTYPE)
-FREQ_FMAT = FREQ_MASK_NPZ['fmat'].astype(CDTYPE)
+def _load_cal():
+    calgain = np.load(CAL_FILE)['cnt2jy']
+    return {'CALGAIN': np.roll(calgain, shift=-2).astype(DTYPE)}
+
+def _load_freq_mask():
+    npz = np.load(FREQMASK_FILE)
+    return {'FREQ_MASK': npz['mask'],
+            'FREQ_AMAT': npz['amat'].astype(CDTYPE),
+            'FREQ_FMAT': npz['fmat'].astype(CDTYPE)}
+
+def _load_projector():
+    return {'FREQ_PROJECTOR': DPSSProjector.from_mask_file(FREQMASK_FILE)}
+
+_TABLES = {'FMDL': _load_bandpass, 'CALGAIN': _load_cal,
+           'FREQ_MASK': _load_freq_mask, 'FREQ_AMAT': _load_freq_mask,
+           'FREQ_FMAT': _load_freq_mask, 'FREQ_PROJECTOR': _load_projector}
+
+def _table(name):
+    '''Return module-level table name, loading it on first use.'''
+    if name not in globals():
+        globals().update(_TABLES[name]())
+    return globals()[name]
+
+def __getattr__(name):
+    if name in _TABLES:
+        return _table(name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 # FREQ_MASK = np.roll(FREQ_MASK, shift=-2) # Shift masks by 2 channels
 # FREQ_AMAT = np.roll(FREQ_AMAT, shift=-2, axis=[0, 1])
@@ -44,10 +63,124 @@ def dpss_filter(y, amat, fmat):
     model = amat @ (fmat @ y)
     return model.real
 
+class DPSSProjector:
+    '''Real-valued, low-rank form of the DPSS filter, real(amat @ fmat),
+    stored as left @ right. Applies to any number of spectra at once and
+    can be saved to/loaded from an npz file.'''
+
+    def __init__(self, amat, fmat, tol=None, dtype=DTYPE):
+        '''Arguments:
+            amat: (nfreqs, nmodes) filter design matrix (complex or real)
+            fmat: (nmodes, nfreqs) filter fitting matrix (complex or real)
+            tol: If provided, truncate singular values below tol times the
+                largest to further reduce the rank.'''
+        # real(A @ F) = Re(A) @ Re(F) - Im(A) @ Im(F) for real data
+        left, right = amat.real, fmat.real
+        if np.iscomplexobj(amat) and np.iscomplexobj(fmat) \
+                and np.any(amat.imag) and np.any(fmat.imag):
+            left = np.concatenate([amat.real, -amat.imag], axis=1)
+            right = np.concatenate([fmat.real, fmat.imag], axis=0)
+        if tol is not None:
+            q, r = np.linalg.qr(left)
+            u, sv, vt = np.linalg.svd(r @ right, full_matrices=False)
+            rank = np.sum(sv > tol * sv[0])
+            left = q @ (u[:, :rank] * sv[:rank])
+            right = vt[:rank]
+        self.left = np.ascontiguousarray(left, dtype=dtype)
+        self.right = np.ascontiguousarray(right, dtype=dtype)
+
+    @property
+    def rank(self):
+        return self.right.shape[0]
+
+    def __call__(self, y):
+        '''Return the smooth model of spectra y, with frequency along the
+        last axis (a single spectrum or e.g. one per time block).'''
+        y = np.asarray(y, dtype=self.right.dtype)
+        return (y @ self.right.T) @ self.left.T
+
+    def save(self, filename):
+        np.savez(filename, left=self.left, right=self.right)
+
+    @classmethod
+    def load(cls, filename):
+        npz = np.load(filename)
+        proj = cls.__new__(cls)
+        proj.left, proj.right = npz['left'], npz['right']
+        return proj
+
+    @classmethod
+    def from_mask_file(cls, filename=FREQMASK_FILE, **kwargs):
+        '''Build from the 'amat' and 'fmat' of a frequency mask npz file.'''
+        npz = np.load(filename)
+        return cls(npz['amat'], npz['fmat'], **kwargs)
+
+def _fit_fmdl(y, freq_amat, freq_fmat, projector):
+    '''Smooth bandpass model of masked spectrum y.'''
+    if projector is None and (freq_amat is None or freq_fmat is None):
+        projector = _table('FREQ_PROJECTOR')
+    if projector is not None:
+        return projector(y)
+    return dpss_filter(y, freq_amat, freq_fmat)
+
+def _detrend_flag_fused(data, fmdl, nos, fmask, ch0, ch1, gsig, hch0, hch1,
+                        hsig, nsig, inpaint, rng, do_zscore=False):
+    '''Detrend and flag float32 data (and fmask) in place with the compiled
+    kernels in limbo._process. Returns tmdl, diff, zscore (None unless do_zscore),
+    tmask, fmask, hmask as in process_data.'''
+    ntimes, nfreqs = data.shape
+    fwgt = fmask.astype(data.dtype)
+    inos = (1 / nos).astype(data.dtype)
+    tmdl = np.empty(ntimes, dtype=data.dtype)
+    _process.fit_tmdl(data, fmdl, inos, fwgt, ch0, ch1, nsig, tmdl)
+    hmask = np.empty(ntimes, dtype=bool)
+    tzsq = np.empty(ntimes, dtype=data.dtype)
+    _process.detrend_flag(data, tmdl, fmdl, inos, fwgt, ch0, ch1, hch0, hch1,
+                          hsig**2, hmask.view(np.uint8), tzsq)
+    diff_data = data
+    zscore = diff_data * inos if do_zscore else None
+    # remove outlying times by flagging for gsig outliers from in
+    # median log likelihood
+    tzsq -= np.median(tzsq)
+    tmask = np.ones(ntimes, dtype=fmask.dtype)
+    tmask[tzsq > gsig * np.median(np.abs(tzsq))] = 0
+    # finally, remove any remaining freqs that are persistently bad
+    nchunk = min(ntimes, 64)
+    fnum = np.zeros((nchunk, nfreqs), dtype='float64')
+    fden = np.zeros((nchunk, nfreqs), dtype='float64')
+    _process.freq_zsq(diff_data, inos, tmask.view(np.uint8), fwgt,
+                      hmask.view(np.uint8), hch0, hch1, fnum, fden)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fzsq = fnum.sum(axis=0) / fden.sum(axis=0)
+    fmask[np.abs(fzsq) > 0.5] = 0
+    if inpaint:  # inpaint diff data with gaussian noise
+        _inpaint_flagged(diff_data, tmask, fmask, hmask, hch0, hch1, np.abs(nos), rng)
+    else:
+        _process.apply_mask(diff_data, tmask.view(np.uint8), fmask.view(np.uint8),
+                            hmask.view(np.uint8), hch0, hch1)
+    return tmdl, diff_data, zscore, tmask, fmask, hmask
+
+def _inpaint_flagged(data, tmask, fmask, hmask, hch0, hch1, scale, rng):
+    '''Inpaint data in place where flagged by np.outer(tmask, fmask), with
+    hmask times also flagged in the "hot" zone, without forming the full
+    mask. Like rng.inpaint, draws only for flagged entries.'''
+    tmask, fmask = tmask.astype(bool), fmask.astype(bool)
+    hot = np.zeros_like(fmask)
+    hot[hch0:hch1] = fmask[hch0:hch1]
+    good = np.nonzero(tmask)[0]
+    for rows, cols in ((np.nonzero(~tmask)[0], np.arange(fmask.size)),
+                       (good, np.nonzero(~fmask)[0]),
+                       (good[hmask[good]], np.nonzero(hot)[0])):
+        noise = rng.standard_normal((rows.size, cols.size), dtype=data.dtype)
+        noise *= np.asarray(scale, dtype=data.dtype)[cols]
+        data[np.ix_(rows, cols)] = noise
+
 def process_data(hdr, data, ch0=400, ch1=1424, gsig=4, maxdm=500, hch0=1171, hch1=1308,
-    hsig=3, dtype='float32', fmask=FREQ_MASK, freq_amat=FREQ_AMAT,
-    freq_fmat=FREQ_FMAT, nsig=3,
-    do_dmt=True, inpaint=True):
+    hsig=3, dtype='float32', fmask=None, freq_amat=None,
+    freq_fmat=None, nsig=3,
+    do_dmt=True, inpaint=True, fused=True, rng=None, projector=None, fdmt_cache_dir=None,
+    fdmt_phase_mem=None, mindm=0, ndm=None, fdmt_engine='fft', dedisperser=None,
+    do_zscore=False):
     '''Process LIMBO data by detrending, flagging, and performing a DM transform.
     Arguments:
         hdr: Header from LIMBO file
@@ -59,63 +192,224 @@ def process_data(hdr, data, ch0=400, ch1=1424, gsig=4, maxdm=500, hch0=1171, hch
         hch0: Lower channel of "hot" RFI zone
         hch1: Upper channel of "hot" RFI zone
         hsig: Number of sigma for flagging "hot" zone excess power.
-        fmask: Frequency channel mask, derived from data/freq_mask_v002.npz
-        freq_amat: Frequency filtering design matrix, derived from data/freq_mask_v002.npz
-        freq_fmat: Frequency filtering matrix mask, derived from data/freq_mask_v002.npz    Returns:
-        dmt: Dictionary with keys 'dmt', 'dms', 'fmdl', 'tmdl', 'diff', 'tmask', 'fmask'.
+        fmask: Frequency channel mask (not modified). Default FREQ_MASK,
+            loaded from FREQMASK_FILE (data/freq_mask_v004.npz) on first use.
+        freq_amat: Frequency filtering design matrix (e.g. FREQ_AMAT).
+        freq_fmat: Frequency filtering fitting matrix (e.g. FREQ_FMAT). Unless
+            both are given, the smooth bandpass is fit with projector.
+        fused: Use compiled, multi-threaded kernels (float32 only) to detrend
+            and flag in place.
+        rng: Seed or utils.GaussianNoise used for inpainting. If None, seeded
+            from np.random. Pass a utils.GaussianNoise(seed, nthreads), reused
+            across calls and closed when done, to draw on several threads.
+        projector: DPSSProjector to use instead of freq_amat/freq_fmat.
+            Defaults to FREQ_PROJECTOR if freq_amat/freq_fmat are not given.
+        fdmt_cache_dir: Directory of on-disk FDMT plans (see fdmt.get_fdmt).
+        fdmt_phase_mem: Memory [bytes] for stored FDMT phases (see fdmt.FDMT).
+        mindm: Min DM in DM transform
+        ndm: Number of DM trials from mindm to maxdm (see fdmt.FDMT). If None,
+            one per channel in the (power-of-2 padded) window.
+        fdmt_engine: 'fft' (fdmt.FDMT) or 'time' (fdmt.TimeFDMT; faster when
+            the delay across the window is less than the number of channels).
+        dedisperser: fdmt.StreamingFDMT fed with consecutive data (overrides
+            the DM transform settings above). 'dmt' then holds the output
+            completed by this data, and 'dmt_tind0' the index of its first
+            row relative to the start of data (<= 0).
+        do_zscore: Also return 'zscore', the residuals in units of the noise
+            level before flagging (a full-size array).
+    Returns:
+        dmt: Dictionary with keys 'dmt', 'dms', 'fmdl', 'tmdl', 'diff', 'tmask',
+            'fmask', and 'hmask' (times flagged for "hot" zone excess power),
+            plus 'dmt_tind0' with a dedisperser and 'zscore' with do_zscore.
+            The full mask is np.outer(tmask, fmask) with hmask times zeroed in
+            the "hot" zone.
     '''
+    fmask = (_table('FREQ_MASK') if fmask is None else fmask).copy()
     data = data.astype(dtype)  # prevent datatype promotion
     # compute smooth, time-averaged fmdl: our model of stable spectrum
     spec = np.mean(data, axis=0)
-    fmdl = dpss_filter(spec * fmask.astype(dtype), freq_amat, freq_fmat)
+    fmdl = _fit_fmdl(spec * fmask.astype(dtype), freq_amat, freq_fmat, projector)
     fmdl = fmdl.astype(dtype)  # prevent datatype promotion
     # estimate thermal (rms) noise level for each chan from fmdl
     # assumes same gain for all t in file
     nos = fmdl / hdr['AccLen']**0.5
-    # estimate power level vs time tmdl, assuming fmdl spectral shape
-    # moves # up and down with each integration
+    if inpaint:
+        rng = get_noise(rng)
+    if fused and np.dtype(dtype) == np.float32:
+        tmdl, diff_data, zscore, tmask, fmask, hmask = _detrend_flag_fused(
+            data, fmdl, nos, fmask, ch0, ch1, gsig, hch0, hch1, hsig, nsig, inpaint, rng,
+            do_zscore=do_zscore)
+    else:
+        # estimate power level vs time tmdl, assuming fmdl spectral shape
+        # moves # up and down with each integration
+        tmdl = np.sum(data[:,ch0:ch1][:,fmask[ch0:ch1]], axis=1) / np.sum(fmdl[ch0:ch1][fmask[ch0:ch1]])
+        tmdl = tmdl.astype(dtype)  # prevent datatype promotion
+        mdl = np.outer(tmdl, fmdl)  # 1st smoothed, time-variable power model
+        # iterate tmdl fit once to reject outliers that skew power level est
+        zscore = (data - mdl) / nos
+        reject = np.where(zscore > nsig, 0, fmask[np.newaxis,:])
+        tmdl = np.sum(data[:,ch0:ch1] * reject[:,ch0:ch1], axis=1) / np.sum(reject[:,ch0:ch1] * fmdl[ch0:ch1], axis=1)
+        tmdl = tmdl.astype(dtype)  # prevent datatype promotion
+        mdl = np.outer(tmdl, fmdl)  # 2nd smoothed, time-variable power model
+        # compute a signed zscore**2 (tzsq) proportional to log likelihood of
+        # high outliers
+        diff_data = data - mdl
+        zscore = diff_data / nos
+        zsq = np.abs(zscore) * zscore
+        tmask = np.ones(tmdl.size, dtype=fmask.dtype)
+        full_mask = np.outer(tmask, fmask)
+        # compute power in 'hot' region and flag separately
+        hmask = np.mean(zsq[:,hch0:hch1], axis=1) > hsig**2
+        full_mask[hmask, hch0:hch1] = 0
+        # remove outlying times by flagging for gsig outliers from in
+        # median log likelihood
+        tzsq = np.sum(full_mask[:,ch0:ch1] * zsq[:,ch0:ch1], axis=1) / np.sum(full_mask[:,ch0:ch1], axis=1)
+        tzsq -= np.median(tzsq)
+        tmask[tzsq > gsig * np.median(np.abs(tzsq))] = 0
+        full_mask[~tmask, :] = 0
+        # finally, remove any remaining freqs that are persistently bad
+        fzsq = np.sum(full_mask * zsq, axis=0) / np.sum(full_mask, axis=0)
+        fmask[np.abs(fzsq) > 0.5] = 0
+        full_mask[:, ~fmask] = 0
+
+        if inpaint:  # inpaint diff data with gaussian noise
+            rng.inpaint(diff_data, full_mask, np.abs(nos))
+        else:
+            diff_data *= full_mask
+
+    dmt = {'fmdl': fmdl, 'tmdl': tmdl, 'diff': diff_data,
+           'tmask': tmask, 'fmask': fmask, 'hmask': hmask}
+    if do_zscore:
+        dmt['zscore'] = zscore
+    if do_dmt and dedisperser is not None:
+        dmt['dmt_tind0'] = dedisperser.nout - dedisperser.nin
+        dmt['dmt'] = dedisperser.process(diff_data[:,ch0:ch1])
+        dmt['dms'] = dedisperser.dms
+    elif do_dmt:
+        fdmt = get_fdmt(hdr['freqs'][ch0:ch1], hdr['times'], maxDM=maxdm,
+                        cache_dir=fdmt_cache_dir, max_phase_mem=fdmt_phase_mem,
+                        minDM=mindm, ndm=ndm, engine=fdmt_engine)
+        dm_vs_t = fdmt.apply(diff_data[:,ch0:ch1])
+        dmt['dmt'] = dm_vs_t
+        dmt['dms'] = fdmt.dms
+    return dmt
+
+def _fit_tmdl(data, fmdl, nos, fmask, ch0, ch1, nsig, dtype):
+    '''Fit the power level vs. time of data to the fmdl spectral shape,
+    iterating once to reject outliers above nsig.'''
     tmdl = np.sum(data[:,ch0:ch1][:,fmask[ch0:ch1]], axis=1) / np.sum(fmdl[ch0:ch1][fmask[ch0:ch1]])
     tmdl = tmdl.astype(dtype)  # prevent datatype promotion
-    mdl = np.outer(tmdl, fmdl)  # 1st smoothed, time-variable power model
-    # iterate tmdl fit once to reject outliers that skew power level est
-    zscore = (data - mdl) / nos
-    reject = np.where(zscore > nsig, 0, fmask[np.newaxis,:])
-    tmdl = np.sum(data[:,ch0:ch1] * reject[:,ch0:ch1], axis=1) / np.sum(reject[:,ch0:ch1] * fmdl[ch0:ch1], axis=1)
-    tmdl = tmdl.astype(dtype)  # prevent datatype promotion
-    mdl = np.outer(tmdl, fmdl)  # 2nd smoothed, time-variable power model
-    # compute a signed zscore**2 (tzsq) proportional to log likelihood of
-    # high outliers
-    diff_data = data - mdl
-    zscore = diff_data / nos
-    zsq = np.abs(zscore) * zscore
-    tmask = np.ones(tmdl.size, dtype=fmask.dtype)
+    zscore = (data[:,ch0:ch1] - np.outer(tmdl, fmdl[ch0:ch1])) / nos[ch0:ch1]
+    reject = np.where(zscore > nsig, 0, fmask[np.newaxis,ch0:ch1])
+    tmdl = np.sum(data[:,ch0:ch1] * reject, axis=1) / np.sum(reject * fmdl[ch0:ch1], axis=1)
+    return tmdl.astype(dtype)  # prevent datatype promotion
+
+def _block_zsq(data, tmdl, fmdl, nos):
+    '''Return residuals from the tmdl x fmdl power model and their signed zscore**2.'''
+    diff_data = data - np.outer(tmdl, fmdl)
+    zsq = diff_data / nos
+    zsq *= np.abs(zsq)
+    return diff_data, zsq
+
+def _block_mask(tmask, fmask, hmask, hch0, hch1):
+    '''Return the flagging mask for a block of times.'''
     full_mask = np.outer(tmask, fmask)
-    # compute power in 'hot' region and flag separately
-    hzsq = np.mean(zsq[:,hch0:hch1], axis=1)
-    full_mask[hzsq > hsig**2, hch0:hch1] = 0
+    full_mask[hmask, hch0:hch1] = 0
+    return full_mask
+
+def process_data_blockwise(hdr, data, ch0=400, ch1=1424, gsig=4, maxdm=500, hch0=1171, hch1=1308,
+    hsig=3, dtype='float32', fmask=None, freq_amat=None,
+    freq_fmat=None, nsig=3,
+    do_dmt=True, inpaint=True, max_mem=2**28, out=None, rng=None, projector=None,
+    fdmt_cache_dir=None, fdmt_phase_mem=None, mindm=0, ndm=None, fdmt_engine='fft',
+    dedisperser=None):
+    '''Process LIMBO data like process_data, but in blocks of time with
+    bounded memory. Data may be a read-only (e.g. memory-mapped) array; it
+    is read three times. Masks and statistics match process_data to within
+    floating-point rounding.
+    Arguments:
+        (as for process_data)
+        max_mem: Approximate memory ceiling [bytes] for block temporaries.
+        out: Optional (ntimes, nfreqs) array to hold the 'diff' output.
+        rng: Seed or utils.GaussianNoise used for inpainting.
+        projector: DPSSProjector to use instead of freq_amat/freq_fmat.
+            Defaults to FREQ_PROJECTOR if freq_amat/freq_fmat are not given.
+    Returns:
+        dmt: Dictionary with keys 'dmt', 'dms', 'fmdl', 'tmdl', 'diff', 'tmask',
+            'fmask', and 'hmask' (times flagged for "hot" zone excess power).
+            The full mask is np.outer(tmask, fmask) with hmask times zeroed in
+            the "hot" zone.
+    '''
+    ntimes, nfreqs = data.shape
+    fmask = (_table('FREQ_MASK') if fmask is None else fmask).copy()
+    # roughly a dozen float32-sized temporaries per spectrum in a block
+    block = max(1, int(max_mem // (12 * 4 * nfreqs)))
+    blocks = [(i, min(i + block, ntimes)) for i in range(0, ntimes, block)]
+    # pass 1: compute smooth, time-averaged fmdl: our model of stable spectrum
+    spec = np.zeros(nfreqs, dtype='float64')
+    for i, j in blocks:
+        spec += np.sum(data[i:j], axis=0, dtype='float64')
+    spec = (spec / ntimes).astype(dtype)
+    fmdl = _fit_fmdl(spec * fmask.astype(dtype), freq_amat, freq_fmat, projector)
+    fmdl = fmdl.astype(dtype)  # prevent datatype promotion
+    nos = fmdl / hdr['AccLen']**0.5
+    # pass 2: fit power level vs time, flag "hot" zone, and compute a
+    # signed zscore**2 (tzsq) proportional to log likelihood of high outliers
+    tmdl = np.empty(ntimes, dtype=dtype)
+    hmask = np.empty(ntimes, dtype=bool)
+    tzsq = np.empty(ntimes, dtype=dtype)
+    ones = np.ones(ntimes, dtype=fmask.dtype)
+    for i, j in blocks:
+        d = data[i:j].astype(dtype)  # prevent datatype promotion
+        tmdl[i:j] = _fit_tmdl(d, fmdl, nos, fmask, ch0, ch1, nsig, dtype)
+        _, zsq = _block_zsq(d, tmdl[i:j], fmdl, nos)
+        hmask[i:j] = np.mean(zsq[:,hch0:hch1], axis=1) > hsig**2
+        m = _block_mask(ones[i:j], fmask, hmask[i:j], hch0, hch1)
+        tzsq[i:j] = np.sum(m[:,ch0:ch1] * zsq[:,ch0:ch1], axis=1) / np.sum(m[:,ch0:ch1], axis=1)
     # remove outlying times by flagging for gsig outliers from in
     # median log likelihood
-    tzsq = np.sum(full_mask[:,ch0:ch1] * zsq[:,ch0:ch1], axis=1) / np.sum(full_mask[:,ch0:ch1], axis=1)
     tzsq -= np.median(tzsq)
+    tmask = np.ones(ntimes, dtype=fmask.dtype)
     tmask[tzsq > gsig * np.median(np.abs(tzsq))] = 0
-    full_mask[~tmask, :] = 0
-    # finally, remove any remaining freqs that are persistently bad
-    fzsq = np.sum(full_mask * zsq, axis=0) / np.sum(full_mask, axis=0)
-    fmask[np.abs(fzsq) > 0.5] = 0
-    full_mask[:, ~fmask] = 0
+    # pass 3: write residuals and find remaining freqs that are persistently bad
+    if out is None:
+        out = np.empty((ntimes, nfreqs), dtype=dtype)
+    fnum = np.zeros(nfreqs, dtype='float64')
+    fden = np.zeros(nfreqs, dtype='float64')
+    if inpaint:
+        rng = get_noise(rng)
+    for i, j in blocks:
+        d = data[i:j].astype(dtype)  # prevent datatype promotion
+        diff_data, zsq = _block_zsq(d, tmdl[i:j], fmdl, nos)
+        m = _block_mask(tmask[i:j], fmask, hmask[i:j], hch0, hch1)
+        fnum += np.sum(m * zsq, axis=0)
+        fden += np.sum(m, axis=0)
+        if inpaint:  # inpaint diff data with gaussian noise
+            out[i:j] = rng.inpaint(diff_data, m, np.abs(nos))
+        else:
+            out[i:j] = diff_data * m
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fzsq = fnum / fden
+    bad = np.abs(fzsq) > 0.5
+    fmask[bad] = 0
+    if np.any(bad):
+        if inpaint:
+            noise = rng.standard_normal((ntimes, bad.sum()), dtype=dtype)
+            out[:, bad] = noise * np.abs(nos[bad])
+        else:
+            out[:, bad] = 0
 
-    if inpaint:  # inpaint diff data with gaussian noise
-        noise = np.random.normal(loc=0, scale=np.abs(nos), size=diff_data.shape).astype(dtype)  # XXX this is a bit slow
-        diff_data = np.where(full_mask, diff_data, noise)
-    else:
-        diff_data *= full_mask
-
-    dmt = {'fmdl': fmdl, 'tmdl': tmdl,
-           'diff': diff_data, 'zscore': zscore, 'mask': full_mask,
-           'tmask': tmask, 'fmask': fmask}
-    if do_dmt:
-        fdmt = FDMT(hdr['freqs'][ch0:ch1], hdr['times'], maxDM=maxdm)
-        dm_vs_t = fdmt.apply(diff_data[:,ch0:ch1])
+    dmt = {'fmdl': fmdl, 'tmdl': tmdl, 'diff': out,
+           'tmask': tmask, 'fmask': fmask, 'hmask': hmask}
+    if do_dmt and dedisperser is not None:
+        dmt['dmt_tind0'] = dedisperser.nout - dedisperser.nin
+        dmt['dmt'] = dedisperser.process(out[:,ch0:ch1])
+        dmt['dms'] = dedisperser.dms
+    elif do_dmt:
+        fdmt = get_fdmt(hdr['freqs'][ch0:ch1], hdr['times'], maxDM=maxdm,
+                        cache_dir=fdmt_cache_dir, max_phase_mem=fdmt_phase_mem,
+                        minDM=mindm, ndm=ndm, engine=fdmt_engine)
+        dm_vs_t = fdmt.apply(out[:,ch0:ch1])
         dmt['dmt'] = dm_vs_t
         dmt['dms'] = fdmt.dms
     return dmt
@@ -203,22 +497,23 @@ class ProcessVoltage:
         Return the complex spectra that contains the length of the pulse.
         """
         window, skip = self._get_volt_analysis_params(t_events=t_events, pad=pad)
-        vnspec = self.vhdr['nspec']
-        volt_files = sorted(self.volt_files)
-        for i, file in enumerate(volt_files):
-            if skip > vnspec * (i+1):
-                continue
-            else:
-                _skip = skip - (vnspec * i)
-                if window < vnspec - _skip: # read to end of window
-                    _, data_real, data_imag = read_volt_file(file, skip=_skip, nspec=window)
-                elif window > vnspec - _skip: # if pulse stradles two files
-                    _, dr0, di0 = read_volt_file(file, skip=_skip, nspec=-1) # read to end of file
-                    _, dr1, di1 = read_volt_file(volt_files[i+1], skip=0, nspec=window - dr0.shape[0]) # read remaining amount from next file
-                    data_real = np.concatenate((dr0, dr1), axis=0)
-                    data_imag = np.concatenate((di0, di1), axis=0)
-                break
+        volt_series = FileSeries(self.volt_files, volt=True)
+        # skip is counted from the start of the first voltage file
+        skip += volt_series.time_to_index(self.vhdr['Time'])
+        _, data_real, data_imag = volt_series.read(skip=skip, nspec=window)
         return data_real, data_imag, window, skip
+
+    def find_volt_power(self, t_events, pad=2000, sum_int=1):
+        """
+        Return polarization-summed power over the window containing the
+        pulse, averaged every sum_int spectra, detected directly from the
+        4b voltages without unpacking them.
+        """
+        window, skip = self._get_volt_analysis_params(t_events=t_events, pad=pad)
+        volt_series = FileSeries(self.volt_files, volt=True)
+        skip += volt_series.time_to_index(self.vhdr['Time'])
+        _, vdata = volt_series.read_power(skip=skip, nspec=window, nint=sum_int)
+        return vdata, window, skip
     
     def sum_pols(self, data_real, data_imag):
         """ Sum polarizations """
@@ -228,15 +523,55 @@ class ProcessVoltage:
 
     def get_volt_streams(self, data_real, data_imag, dtype='complex64'):
         """ Get indiviual voltage streams """
-        v0 = data_real[:, :, 0] + np.asarray(1j).astype(dtype) * data_imag[:, :, 0]
-        v1 = data_real[:, :, 1] + np.asarray(1j).astype(dtype) * data_imag[:, :, 1]
+        v0 = np.empty(data_real.shape[:2], dtype=dtype)
+        v0.real, v0.imag = data_real[:, :, 0], data_imag[:, :, 0]
+        v1 = np.empty(data_real.shape[:2], dtype=dtype)
+        v1.real, v1.imag = data_real[:, :, 1], data_imag[:, :, 1]
         return v0, v1
     
+    def coherent_dedisperse(self, data_real, data_imag, nfft=None):
+        """ Coherently de-disperse both voltage streams to self.DM (see
+        coherent.CoherentDedisperser). Returns v0, v1, each shorter than the
+        input by the dispersion delay across the band. """
+        from .coherent import CoherentDedisperser
+        cd = CoherentDedisperser(self.DM, self.vhdr['freqs'], self.vhdr['inttime'], nfft=nfft)
+        return tuple(cd(v) for v in self.get_volt_streams(data_real, data_imag))
+
+    def coherent_power(self, t_events, pad=2000, sum_int=1, block=2**14, nfft=None):
+        """
+        Return polarization-summed power of the coherently de-dispersed
+        voltages over the window containing the pulse, averaged every
+        sum_int spectra. Voltages are read and de-dispersed block spectra at
+        a time, so memory use does not grow with the window.
+        """
+        from .coherent import CoherentDedisperser
+        window, skip = self._get_volt_analysis_params(t_events=t_events, pad=pad)
+        volt_series = FileSeries(self.volt_files, volt=True)
+        skip += volt_series.time_to_index(self.vhdr['Time'])
+        end = min(skip + window, volt_series.nspec)
+        cds = [CoherentDedisperser(self.DM, self.vhdr['freqs'], self.vhdr['inttime'], nfft=nfft)
+               for pol in range(2)]
+        nend = end - skip - cds[0].shifts.max()
+        power, rest = [], None
+        for i in range(skip, end + block, block):
+            if i < end:
+                _, data_real, data_imag = volt_series.read(skip=i, nspec=min(block, end - i))
+                v = [cd.process(s) for cd, s in zip(cds, self.get_volt_streams(data_real, data_imag))]
+            else:
+                v = [cd.flush(nend) for cd in cds]
+            p = np.abs(v[0])**2 + np.abs(v[1])**2
+            if rest is not None:
+                p = np.concatenate([rest, p])
+            n = p.shape[0] - p.shape[0] % sum_int
+            power.append(self.sum_down(p[:n], sum_int=sum_int))
+            rest = p[n:]
+        return np.concatenate(power), window, skip
+
     def sum_down(self, vdata, sum_int=128):
         """ Sum voltage data along time axis. """
         if vdata.shape[0] % sum_int != 0:
             vdata = vdata[:-(vdata.shape[0] % sum_int)]
-        vdata.shape = (-1, sum_int, vdata.shape[1])
+        vdata = vdata.reshape(-1, sum_int, vdata.shape[1])
         vdata = np.mean(vdata, axis=1)
         return vdata
     
@@ -249,29 +584,73 @@ class ProcessVoltage:
             times.append(ts)
         return np.concatenate(times, axis=0)
     
-    def snr_dedispersion(self, vdmt, pmDM=10, ntrials=128, sum_int=1, resamp_factor=1, ch0=398, ch1=398+1024):
-        """ Dedisperse in a way that maximizes the SNR. Returns zscore and DM. """
+    def snr_vs_dm(self, vdmt, pmDM=10, ntrials=128, sum_int=1, resamp_factor=1, ch0=398, ch1=398+1024,
+                  nblock=16, nthreads=1):
+        """ Peak zscore of the de-dispersed, channel-averaged profile vs. DM
+        (see utils.dm_search). Returns dms, zscore, and the index of each
+        peak in the (over-sampled) profile. """
         dms = np.linspace(self.DM - pmDM, self.DM + pmDM, ntrials, endpoint=False)
-        vcal_data = vdmt['diff'] * CALGAIN * np.sqrt(self.hdr['inttime'] / self.vhdr['inttime'])
+        vcal_data = vdmt['diff'] * _table('CALGAIN') * np.sqrt(self.hdr['inttime'] / self.vhdr['inttime'])
         vdata_summed = self.sum_down(vcal_data, sum_int=sum_int)
-        maxz = 0
-        maxz_dm = 0
-        for dm in tqdm(dms):
-            vprofile = dedisperse(vdata_summed, dm, self.vhdr['freqs'], sum_int * self.vhdr['inttime'], resamp_factor)
-            avg_vprofile = np.mean(vprofile[:, ch0:ch1], axis=-1)
-            vzscore = (avg_vprofile - np.mean(avg_vprofile)) / np.std(avg_vprofile)
-            maxz0 = np.max(vzscore)
-            if maxz0 > maxz:
-                maxz = maxz0
-                maxz_dm = dm
-            else:
-                continue
-        return maxz, maxz_dm
-
-    # XXX Figure out best way to compute Stoke params:
-    # def compute_stokes_params(volt0, volt1):
-    #     I = np.abs(volt0)**2 + np.abs(volt1)**2
-    #     Q = np.abs(volt0)**2 - np.abs(volt1)**2
-    #     U = volt0 * volt1.conj() + volt1 * volt0.conj()
-    #     V = volt0 * volt1.conj() - volt1 * volt0.conj()
-    #     return {'I':I, 'Q':Q, 'U':U, 'V':V}
+        zscore, tind = dm_search(vdata_summed, dms, self.vhdr['freqs'], sum_int * self.vhdr['inttime'],
+                                 oversample=resamp_factor, ch0=ch0, ch1=ch1, nblock=nblock,
+                                 nthreads=nthreads)
+        return dms, zscore, tind
+
+    def snr_dedispersion(self, vdmt, pmDM=10, ntrials=128, sum_int=1, resamp_factor=1, ch0=398, ch1=398+1024,
+                         nthreads=1):
+        """ Dedisperse in a way that maximizes the SNR. Returns zscore and DM. """
+        dms, zscore, _ = self.snr_vs_dm(vdmt, pmDM=pmDM, ntrials=ntrials, sum_int=sum_int,
+                                        resamp_factor=resamp_factor, ch0=ch0, ch1=ch1,
+                                        nthreads=nthreads)
+        i = np.argmax(zscore)
+        if zscore[i] <= 0:
+            return 0, 0
+        return zscore[i], dms[i]
+
+    def compute_stokes_params(self, data_real, data_imag, nint=1, nfint=1, block=4096):
+        """
+        Return Stokes I, Q, U, V (see io.stokes_volt) of the (nspec, nchan, 2)
+        real/imag voltages, averaged every nint spectra and nfint channels,
+        with shape (nspec // nint, nchan // nfint, 4). Cross products are
+        formed in float32 without complex temporaries: int8 voltages (as
+        from read_volt_file) by a compiled kernel, others about block
+        spectra at a time, so memory use is set by the output resolution.
+        """
+        nout = data_real.shape[0] // nint
+        nchan = data_real.shape[1] // nfint * nfint
+        if data_real.dtype == np.int8 and data_imag.dtype == np.int8:
+            from ._volt import stokes_int8
+            stokes = np.zeros((nout, nchan // nfint, 4), dtype=np.float32)
+            stokes_int8(data_real, data_imag, nint, nfint, stokes)
+            stokes /= nint * nfint
+            return stokes
+        stokes = np.empty((nout, nchan // nfint, 4), dtype=np.float32)
+        step = max(1, block // nint)
+        for o0 in range(0, nout, step):
+            o1 = min(o0 + step, nout)
+            re = data_real[o0 * nint:o1 * nint, :nchan].astype(np.float32)
+            im = data_imag[o0 * nint:o1 * nint, :nchan].astype(np.float32)
+            xx = re[..., 0]**2 + im[..., 0]**2
+            yy = re[..., 1]**2 + im[..., 1]**2
+            params = (xx + yy, xx - yy,
+                      2 * (re[..., 0] * re[..., 1] + im[..., 0] * im[..., 1]),
+                      2 * (re[..., 0] * im[..., 1] - im[..., 0] * re[..., 1]))
+            for k, p in enumerate(params):
+                p = p.reshape(o1 - o0, nint, nchan // nfint, nfint)
+                stokes[o0:o1, :, k] = p.mean(axis=(1, 3))
+        return stokes
+
+    def find_volt_stokes(self, t_events, pad=2000, sum_int=1, sum_chan=1):
+        """
+        Return Stokes I, Q, U, V over the window containing the pulse,
+        averaged every sum_int spectra and sum_chan channels, computed
+        directly from the 4b voltages without unpacking them (see
+        io.FileSeries.read_stokes).
+        """
+        window, skip = self._get_volt_analysis_params(t_events=t_events, pad=pad)
+        volt_series = FileSeries(self.volt_files, volt=True)
+        skip += volt_series.time_to_index(self.vhdr['Time'])
+        _, stokes = volt_series.read_stokes(skip=skip, nspec=window, nint=sum_int,
+                                            nfint=sum_chan)
+        return stokes, window, skip
@@ -19,7 +19,19 @@ REDIS_KEYS = [
         'Record'
         ]
 
-r = redis.Redis(REDISHOST, decode_responses=True)
+_REDIS = None
+
+def get_redis():
+    '''Return the shared Redis client, creating it on first use.'''
+    global _REDIS
+    if _REDIS is None:
+        _REDIS = redis.Redis(REDISHOST, decode_responses=True)
+    return _REDIS
+
+def __getattr__(name):
+    if name == 'r':  # module-level client used by older scripts
+        return get_redis()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 # Coordinates of Leuschner Educational Observatory
 LAT = 37.9183 # deg
@@ -285,9 +297,9 @@ class Telescope:
                     t0 = time.time()
                     vals = [ra, dec, alt, az, t0, 1]
                     for key, val in zip(REDIS_KEYS, vals):
-                        r.hset('limbo', key, val)
+                        get_redis().hset('limbo', key, val)
                 except(AssertionError):
-                    r.hset('limbo', 'Record', 0)
+                    get_redis().hset('limbo', 'Record', 0)
             time.sleep(flag_time)
 
     def stop(self):
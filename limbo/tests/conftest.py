@@ -0,0 +1,23 @@
+'''Shared fixtures for limbo tests'''
+import pytest
+import numpy as np
+
+from limbo import processing
+
+@pytest.fixture(autouse=True, scope='session')
+def freq_mask_file(tmp_path_factory):
+    '''Point processing.FREQMASK_FILE at a generated frequency mask (band
+    edges flagged, 24 cosine modes) in place of the observatory product.'''
+    nfreqs, nmodes = 2048, 24
+    mask = np.ones(nfreqs, dtype=bool)
+    mask[:100] = mask[-100:] = False
+    x = np.arange(nfreqs)
+    amat = np.array([np.cos(np.pi * i * x / nfreqs) for i in range(nmodes)]).T
+    fmat = np.linalg.pinv(amat * mask[:, None])
+    filename = str(tmp_path_factory.mktemp('data') / 'freq_mask.npz')
+    np.savez(filename, mask=mask, amat=amat, fmat=fmat)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(processing, 'FREQMASK_FILE', filename)
+        for name in ('FREQ_MASK', 'FREQ_AMAT', 'FREQ_FMAT', 'FREQ_PROJECTOR'):
+            mp.delitem(vars(processing), name, raising=False)
+        yield filename
@@ -0,0 +1,56 @@
+'''Tests for limbo.candidates'''
+import pytest
+import numpy as np
+from scipy.sparse.csgraph import connected_components
+
+from limbo import candidates
+
+def same_cluster(labels):
+    return labels[:, None] == labels[None, :]
+
+class TestCandidates(object):
+    def test_median_mad(self):
+        rng = np.random.default_rng(0)
+        for n in (100, 101):
+            x = rng.standard_normal((n, 7)).astype('float32')
+            avg, sig = candidates.median_mad(x)
+            np.testing.assert_allclose(avg, np.median(x, axis=0))
+            np.testing.assert_allclose(sig, np.median(np.abs(x - avg), axis=0))
+
+    def test_cluster(self):
+        rng = np.random.default_rng(0)
+        tind = rng.integers(0, 200, 600)
+        dind = rng.integers(0, 100, 600)
+        labels = candidates.cluster(tind, dind, t_link=3, dm_link=4)
+        friends = (np.abs(tind[:, None] - tind[None, :]) <= 3) & \
+                  (np.abs(dind[:, None] - dind[None, :]) <= 4)
+        nclust, ans = connected_components(friends, directed=False)
+        assert labels.max() + 1 == nclust
+        np.testing.assert_equal(same_cluster(labels), same_cluster(ans))
+        assert candidates.cluster([], []).size == 0
+
+    def test_find_candidates(self):
+        rng = np.random.default_rng(0)
+        dmt = rng.standard_normal((1024, 128)).astype('float32')
+        dmt[500:503, 40:50] += 20  # bright pulse
+        dmt[500, 45] += 10
+        dmt[800, 100:110] += 20  # second pulse
+        cands = candidates.find_candidates(dmt, np.arange(128) * 2., 8,
+                                           times=np.arange(1024) * 1e-3)
+        assert cands['snr'].size == 2
+        assert cands['tind'][0] == 500 and cands['dind'][0] == 45
+        assert cands['dm'][0] == 90.
+        assert cands['time'][0] == 0.5
+        np.testing.assert_equal(cands['count'], [30, 10])
+        np.testing.assert_equal(cands['tind_lo'], [500, 800])
+        np.testing.assert_equal(cands['tind_hi'], [502, 800])
+
+    def test_widths(self):
+        rng = np.random.default_rng(1)
+        dmt = rng.standard_normal((1024, 16)).astype('float32')
+        dmt[300:308, 5] += 3  # wide, weak pulse
+        cands = candidates.find_candidates(dmt, np.arange(16), 7, widths=(1,))
+        assert cands['snr'].size == 0
+        cands = candidates.find_candidates(dmt, np.arange(16), 7, widths=(1, 2, 4, 8))
+        assert cands['width'][0] == 8
+        assert cands['tind'][0] == 307
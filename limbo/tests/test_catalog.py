@@ -0,0 +1,70 @@
+'''Tests for limbo.catalog'''
+import pytest
+import os
+import numpy as np
+
+from limbo import catalog, io
+from test_io import write_test_file
+
+INTTIME = 2e-9 * 4096 * 128
+
+class TestHeaderCatalog(object):
+    def setup_method(self):
+        self.t0 = 1700000000.
+
+    def write_files(self, dirname, nfiles=4, nspec=10):
+        filenames = []
+        for i in range(nfiles):
+            filename = os.path.join(dirname, f'Spectra_{i}.dat')
+            write_test_file(filename, nspec, start_time=self.t0 + i * nspec * INTTIME,
+                            Source='sgr1935')
+            filenames.append(filename)
+        vfilename = os.path.join(dirname, 'VoltageV2_0.dat')
+        write_test_file(vfilename, 4, nchan=2 * 2048, infochan=24, dtype='>u1',
+                        start_time=self.t0 + 0.02, AccLen=1)
+        return filenames, vfilename
+
+    def test_update(self, tmp_path):
+        filenames, vfilename = self.write_files(str(tmp_path))
+        with catalog.HeaderCatalog(str(tmp_path / 'cat.sqlite')) as cat:
+            assert cat.update_dir(str(tmp_path)) == 5
+            assert len(cat) == 5
+            assert cat.update_dir(str(tmp_path)) == 0  # nothing changed
+            os.utime(filenames[0], (0, 0))
+            assert cat.update(filenames) == 1
+            os.remove(filenames[-1])
+            assert cat.prune() == 1
+            assert len(cat) == 4
+            # truncated files are skipped
+            with open(str(tmp_path / 'Spectra_short.dat'), 'wb') as f:
+                f.write(b'\x00\x01')
+            assert cat.update_dir(str(tmp_path)) == 0
+            assert len(cat) == 4
+
+    def test_query(self, tmp_path):
+        filenames, vfilename = self.write_files(str(tmp_path))
+        with catalog.HeaderCatalog(str(tmp_path / 'cat.sqlite')) as cat:
+            cat.update(filenames + [vfilename])
+            t = self.t0 + 15 * INTTIME
+            assert cat.query(t, t + 10 * INTTIME) == [filenames[1], vfilename, filenames[2]]
+            assert cat.query(t, t + 10 * INTTIME, filetype='volt') == [vfilename]
+            assert cat.query(t, t + 10 * INTTIME, filetype='spectra') == filenames[1:3]
+            assert cat.query(self.t0 - 1, self.t0) == []
+
+    def test_get_header(self, tmp_path):
+        filenames, vfilename = self.write_files(str(tmp_path))
+        with catalog.HeaderCatalog(str(tmp_path / 'cat.sqlite')) as cat:
+            cat.update(filenames + [vfilename])
+            for filename, read_hdr in ((filenames[0], io.read_header),
+                                       (vfilename, io.read_volt_header)):
+                hdr = cat.get_header(filename)
+                true_hdr = read_hdr(filename)
+                assert hdr.keys() == true_hdr.keys()
+                np.testing.assert_equal(hdr['freqs'], true_hdr['freqs'])
+                for k in ('Time', 'nspec', 'inttime', 'data_start', 'Source'):
+                    assert hdr.get(k) == true_hdr.get(k)
+            with pytest.raises(KeyError):
+                cat.get_header('missing.dat')
+            series = io.FileSeries(filenames, hdrs=cat.get_headers(self.t0, self.t0 + 1,
+                                                                   filetype='spectra'))
+            assert series.nspec == 40
@@ -0,0 +1,82 @@
+'''Tests for limbo.coherent'''
+import pytest
+import numpy as np
+
+from limbo import coherent, utils, io, processing
+from test_io import write_test_file
+
+FREQS = utils.calc_freqs(500e6, 1350e6, 2048)[398:430]
+INTTIME = utils.calc_inttime(500e6, 1, 2048)
+
+def disperse(volt, dm, freqs, inttime, shifts):
+    '''Apply dispersion within each channel (inverse chirp) and delay each
+    channel by shifts, wrapping around in time.'''
+    n = volt.shape[0]
+    _volt = np.fft.fft(volt, axis=0) * np.conj(coherent.chirp(dm, freqs, inttime, n))
+    volt = np.fft.ifft(_volt, axis=0)
+    return np.array([np.roll(volt[:, c], s) for c, s in enumerate(shifts)]).T
+
+class TestCoherent(object):
+    def test_chirp(self):
+        ch = coherent.chirp(332.7, FREQS, INTTIME, 512)
+        assert ch.shape == (512, FREQS.size)
+        np.testing.assert_allclose(np.abs(ch), 1, rtol=1e-6)
+        # no delay at the channel center
+        np.testing.assert_allclose(ch[0], 1)
+        # removes a group delay that is larger at lower frequencies
+        phs = np.unwrap(np.angle(np.fft.fftshift(ch[:, 0])))
+        delay = np.diff(phs) / (2 * np.pi) * 512
+        assert delay[0] > 0 > delay[-1]
+        np.testing.assert_allclose(delay[0] - delay[-1],
+                                   coherent.smear_samples(332.7, FREQS[:1], INTTIME), rtol=0.05)
+
+    def test_get_chirp(self):
+        coherent._CHIRPS.clear()
+        ch = coherent.get_chirp(332.7, FREQS, INTTIME, 512)
+        assert coherent.get_chirp(332.7, FREQS, INTTIME, 512) is ch
+        assert coherent.get_chirp(332.7, FREQS[1:], INTTIME, 512) is not ch
+        for dm in range(coherent.MAX_CHIRPS):
+            coherent.get_chirp(dm, FREQS, INTTIME, 512)
+        assert len(coherent._CHIRPS) == coherent.MAX_CHIRPS
+        assert coherent.get_chirp(332.7, FREQS, INTTIME, 512) is not ch
+
+    def test_dedisperse(self):
+        cd = coherent.CoherentDedisperser(332.7, FREQS, INTTIME)
+        assert cd.nfft > 2 * cd.nhalo
+        rng = np.random.default_rng(0)
+        volt = np.zeros((8000, FREQS.size), dtype='complex64')
+        volt[1000] = np.exp(2j * np.pi * rng.uniform(size=FREQS.size))
+        ans = volt[:volt.shape[0] - cd.shifts.max()]
+        dvolt = disperse(volt, 332.7, FREQS, INTTIME, cd.shifts)
+        for block in (None, 1000, 777):
+            out = cd(dvolt, block=block)
+            np.testing.assert_allclose(out, ans, atol=3e-3)
+
+    def test_stream(self):
+        cd = coherent.CoherentDedisperser(332.7, FREQS, INTTIME)
+        rng = np.random.default_rng(1)
+        volt = rng.standard_normal((5000, FREQS.size)) + 1j * rng.standard_normal((5000, FREQS.size))
+        ans = cd(volt)
+        out = [cd.process(volt[i:i + 333]) for i in range(0, volt.shape[0], 333)]
+        out.append(cd.flush(ans.shape[0]))
+        np.testing.assert_allclose(np.concatenate(out), ans, atol=1e-4)
+
+class TestProcessVoltage(object):
+    def test_coherent_power(self, tmp_path):
+        filenames = []
+        t0 = 1700000000.
+        for i, nspec in enumerate([300, 300]):
+            filename = str(tmp_path / f'Voltage_{i}.dat')
+            write_test_file(filename, nspec, nchan=2 * 2048, infochan=24, dtype='>u1',
+                            start_time=t0, seed=i, AccLen=1)
+            filenames.append(filename)
+            t0 += nspec * INTTIME
+        vhdr = io.read_volt_header(filenames[0])
+        pv = processing.ProcessVoltage(0.5, filenames, vhdr, None)
+        t_events = np.array([vhdr['Time'] + 250 * INTTIME])
+        power, window, skip = pv.coherent_power(t_events, pad=100, sum_int=4, block=64)
+        _, data_real, data_imag = io.FileSeries(filenames, volt=True).read(skip=skip, nspec=window)
+        v0, v1 = pv.coherent_dedisperse(data_real, data_imag)
+        ans = pv.sum_down(np.abs(v0)**2 + np.abs(v1)**2, sum_int=4)
+        assert power.shape == ans.shape
+        np.testing.assert_allclose(power, ans, rtol=1e-4, atol=1e-3)
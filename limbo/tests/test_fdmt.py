@@ -1,6 +1,8 @@
 import pytest
+import os
 
-from limbo.fdmt import FDMT
+from limbo.fdmt import FDMT, TimeFDMT, StreamingFDMT, get_fdmt
+from limbo import fdmt as fdmt_mod
 from limbo import sim
 
 import numpy as np
@@ -22,3 +24,131 @@ class TestFDMT(object):
         t0, dm0 = inds = np.unravel_index(np.argmax(data, axis=None), data.shape)
         assert np.abs(times[t0] - 10 * 80e-4) < 1/NTIMES + 0.12e-3
         assert np.abs(DM - np.linspace(0, maxDM, NFREQ)[dm0]) < 2.2 * maxDM / NFREQ
+
+    def test_fdmt_stage(self):
+        times = np.linspace(0, 1, 256)
+        freqs = np.linspace(1.150e9, 1.650e9, 64)
+        rng = np.random.default_rng(0)
+        profile = rng.standard_normal((times.size, freqs.size)).astype('float32')
+        fdmt = FDMT(freqs, times)
+        # reference: recursion over lists of strided views
+        ans = [np.fft.rfft(profile, axis=0).astype('complex64')]
+        for i in range(1, fdmt.stages):
+            ans = sum([fdmt.phs_sum(d, fdmt.cache[i]) for d in ans], [])
+        ans = np.concatenate([np.fft.irfft(d, axis=0) for d in ans], axis=1)
+        np.testing.assert_allclose(fdmt.apply(profile), ans, atol=1e-4)
+
+    def test_plan_cache(self, tmp_path):
+        times = 1.7e9 + np.arange(256) * 1e-3
+        freqs = np.linspace(1.150e9, 1.650e9, 64)
+        fdmt = get_fdmt(freqs, times)
+        assert get_fdmt(freqs, times - 1e-7) is fdmt  # same sampling
+        # cached plans keep no buffers from apply
+        attrs = set(vars(fdmt))
+        fdmt.apply(np.ones((times.size, freqs.size), dtype='float32'))
+        assert set(vars(fdmt)) == attrs
+        assert get_fdmt(freqs, times, maxDM=400) is not fdmt
+        assert get_fdmt(freqs[:32], times) is not fdmt
+        assert get_fdmt(freqs, times, minDM=100) is not fdmt
+        assert get_fdmt(freqs, times, ndm=16) is not fdmt
+        assert isinstance(get_fdmt(freqs, times, engine='time'), TimeFDMT)
+        for i in range(fdmt_mod.MAX_PLANS):
+            get_fdmt(freqs, times, maxDM=i + 1)
+        assert get_fdmt(freqs, times) is not fdmt
+        # plans saved to disk are reloaded
+        cache_dir = str(tmp_path / 'plans')
+        f0 = FDMT(freqs, times, cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == f0.stages - 1
+        f1 = FDMT(freqs, times, cache_dir=cache_dir)
+        with open(os.path.join(cache_dir, f'fdmt_{f0.key}_1.npy'), 'wb') as f:
+            np.save(f, 2 * f0.cache[1])
+        np.testing.assert_array_equal(FDMT(freqs, times, cache_dir=cache_dir).cache[1],
+                                      2 * f0.cache[1])
+        profile = np.random.default_rng(0).standard_normal((256, 64)).astype('float32')
+        np.testing.assert_array_equal(f0.apply(profile), f1.apply(profile))
+
+    def test_phase_mem(self):
+        times = np.arange(256) * 1e-3
+        freqs = np.linspace(1.150e9, 1.650e9, 64)
+        profile = np.random.default_rng(0).standard_normal((256, 64)).astype('float32')
+        ans = FDMT(freqs, times).apply(profile)
+        for mem in (0, 2e5):
+            fdmt = FDMT(freqs, times, max_phase_mem=mem, nrow=16)
+            assert sum(p.nbytes for p in fdmt.cache.values()) <= mem
+            assert len(fdmt.cache) + len(fdmt.rates) == fdmt.stages - 1
+            # stored phases carry float32 rounding of phases of many cycles
+            np.testing.assert_allclose(fdmt.apply(profile), ans, atol=2e-3)
+
+    def test_dm_grid(self):
+        times = np.linspace(0, 1, NTIMES)
+        freqs = np.linspace(1.150e9, 1.650e9, 1000)  # padded to 1024
+        profile = sim.make_frb(times, freqs, DM=DM, pulse_width=0.12e-3,
+                               pulse_amp=4.5, t0=10*80e-4)
+        fdmt = FDMT(freqs, times, minDM=300, maxDM=400, ndm=100)
+        assert fdmt.nfreqs == 1024 and fdmt.nstage == 7
+        np.testing.assert_allclose(fdmt.dms, np.arange(300, 400))
+        data = fdmt.apply(profile)
+        assert data.shape == (NTIMES, 100)
+        t0, dm0 = np.unravel_index(np.argmax(data, axis=None), data.shape)
+        assert np.abs(times[t0] - 10 * 80e-4) < 1/NTIMES + 0.12e-3
+        assert np.abs(DM - fdmt.dms[dm0]) <= 2
+        # a dispersed impulse sums (nearly) all 24 channels at its DM trial
+        freqs = freqs[-24:]
+        fdmt = FDMT(freqs, times, minDM=300, maxDM=400, ndm=4)
+        for i, dm in enumerate(fdmt.dms):
+            delays = np.around((fdmt_mod.DM_delay(dm, freqs) - fdmt_mod.DM_delay(dm, freqs[-1]))
+                               / (times[1] - times[0])).astype(int)
+            profile = np.zeros((NTIMES, freqs.size), dtype='float32')
+            profile[1000 + delays, np.arange(freqs.size)] = 1
+            data = fdmt.apply(profile)
+            assert np.unravel_index(np.argmax(data), data.shape) == (1000, i)
+            assert data[1000, i] > 0.8 * freqs.size
+
+class TestTimeFDMT(object):
+    def test_fdmt(self):
+        times = np.linspace(0, 1, NTIMES)
+        freqs = np.linspace(1.150e9, 1.650e9, NFREQ)
+        profile = sim.make_frb(times, freqs, DM=DM, pulse_width=0.12e-3,
+                               pulse_amp=4.5, t0=10*80e-4)
+        fdmt = TimeFDMT(freqs, times)
+        data = fdmt.apply(profile)
+        assert data.shape == (NTIMES, fdmt.dms.size)
+        assert fdmt.dms[0] == 0 and fdmt.dms[-1] <= 500
+        t0, dm0 = np.unravel_index(np.argmax(data, axis=None), data.shape)
+        assert np.abs(times[t0] - 10 * 80e-4) < 2/NTIMES + 0.12e-3
+        assert np.abs(DM - fdmt.dms[dm0]) < 2 * np.diff(fdmt.dms).max()
+
+    def test_impulse(self):
+        times = np.arange(1024) * 1e-3
+        freqs = np.linspace(1.150e9, 1.650e9, 100)
+        fdmt = TimeFDMT(freqs, times, minDM=100, maxDM=400, ndm=30)
+        np.testing.assert_allclose(fdmt.dms, 100 + 10 * np.arange(30), atol=np.diff(fdmt.dms).max())
+        for i in (0, 17, 29):
+            delays = np.around((fdmt_mod.DM_delay(fdmt.dms[i], freqs)
+                                - fdmt_mod.DM_delay(fdmt.dms[i], freqs[-1])) / 1e-3).astype(int)
+            profile = np.zeros((times.size, freqs.size), dtype='float32')
+            for k in range(5):  # FDMT delays are within 2 samples of exact
+                profile[(500 + k + delays) % times.size, np.arange(freqs.size)] = 1
+            data = fdmt.apply(profile)
+            assert np.argmax(data[:, i]) in range(500, 505)
+            assert data[:, i].max() == freqs.size
+        # more trials than delay samples: repeated trials are dropped
+        fdmt = TimeFDMT(freqs, times, maxDM=400, ndm=1000)
+        assert fdmt.dms.size == fdmt.delays.size < 1000
+        assert np.all(np.diff(fdmt.dms) > 0)
+        assert fdmt.apply(profile).shape == (times.size, fdmt.dms.size)
+
+    def test_stream(self):
+        freqs = np.linspace(1.150e9, 1.650e9, 100)
+        sf = StreamingFDMT(freqs, 1e-3, maxDM=400)
+        assert 0 < sf.overlap <= sf.fdmt.max_delay + 2
+        profile = np.random.default_rng(0).standard_normal((3000, 100)).astype('float32')
+        # the whole stream, taken to be zero after its end
+        ans = sf.fdmt.apply(np.concatenate([profile, np.zeros((sf.overlap, 100))]))[:3000]
+        for block in (3000, 500, 77):
+            out = [sf.process(profile[i:i + block]) for i in range(0, 3000, block)]
+            out.append(sf.flush())
+            np.testing.assert_allclose(np.concatenate(out), ans, atol=1e-4)
+        out = sf.process(profile[:1000])
+        assert out.shape == (1000 - sf.overlap, sf.dms.size)
+        assert sf.nout == out.shape[0] and sf.nin == 1000
@@ -0,0 +1,27 @@
+'''Tests for lazy loading in the limbo package'''
+import subprocess
+import sys
+import json
+
+from test_io import write_test_file
+
+def imported_after(code):
+    '''Run code in a fresh interpreter; return the modules it imported.'''
+    code += '\nimport sys, json; print(json.dumps(sorted(sys.modules)))'
+    out = subprocess.run([sys.executable, '-c', code], check=True,
+                         capture_output=True, text=True).stdout
+    return set(json.loads(out.splitlines()[-1]))
+
+class TestLazyImport(object):
+    def test_read_header(self, tmp_path):
+        filename = str(tmp_path / 'test.dat')
+        write_test_file(filename, 4)
+        mods = imported_after(f'import limbo; limbo.io.read_header({filename!r})')
+        assert 'limbo.io' in mods
+        for mod in ('limbo.processing', 'limbo.telescope', 'redis', 'astropy', 'scipy', 'tqdm'):
+            assert mod not in mods
+
+    def test_tables(self):
+        mods = imported_after('import limbo.processing as p; assert "FMDL" not in vars(p); '
+                              'assert p.FMDL.shape == p.CALGAIN.shape')
+        assert 'limbo.processing' in mods
@@ -1,11 +1,38 @@
 '''Tests for limbo.io'''
 import pytest
 import os
+import json
+import struct
 import numpy as np
 
 from limbo import io
 from limbo.data import DATA_PATH
 
+def write_test_file(filename, nspec, nchan=2048, infochan=12, dtype='>u2',
+                    start_time=1700000000.25, seed=0, spectra=None, **kwargs):
+    '''Write a small LIMBO file with random data (or the provided spectra).
+    Returns data written, including info channels.'''
+    hdr = {'fpg': 'test.fpg', 'Time': start_time, 'SampleFreq': 500,
+           'AccLen': 128}
+    hdr.update(kwargs)
+    header_size = io.HEADER_SIZE
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype(dtype)
+    data = rng.integers(0, 2**(8 * dtype.itemsize), size=(nspec, infochan + nchan))
+    data = data.astype(dtype)
+    if spectra is not None:
+        data[:, infochan:] = spectra
+    # first spectrum carries the start time as <u4 sec, 0, usec
+    sec = int(start_time)
+    usec = int(round((start_time - sec) * 1e6))
+    info = np.array([sec, 0, usec], dtype='<u4').view(dtype)
+    data[0, :info.size] = info
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('I', header_size))
+        f.write(json.dumps(hdr).encode().ljust(header_size, b'\x00'))
+        f.write(data.tobytes())
+    return data
+
 class TestFileIO(object):
     def setup_method(self):
         self.filename = os.path.join(DATA_PATH, 'test.dat')
@@ -36,3 +63,190 @@ class TestFileIO(object):
         assert data.shape == (2, 2048)
         assert hdr['times'].size == 2
         assert hdr['jds'].size == 2
+
+class TestMmap(object):
+    def test_read_raw_data_mmap(self, tmp_path):
+        filename = str(tmp_path / 'Spectra_test.dat')
+        raw = write_test_file(filename, 16)
+        hdr = io.read_header(filename)
+        assert hdr['nspec'] == 16
+        data = io.read_raw_data(filename, hdr, mmap=True)
+        assert isinstance(data, np.memmap)
+        np.testing.assert_equal(data, raw)
+        data = io.read_raw_data(filename, hdr, nspec=4, skip=10, mmap=True)
+        np.testing.assert_equal(data, raw[10:14])
+        data = io.read_raw_data(filename, hdr, nspec=100, skip=10, mmap=True)
+        np.testing.assert_equal(data, raw[10:])
+
+    def test_read_file_mmap(self, tmp_path):
+        filename = str(tmp_path / 'Spectra_test.dat')
+        write_test_file(filename, 16)
+        hdr0, data0 = io.read_file(filename, skip=3, nspec=5)
+        hdr1, data1 = io.read_file(filename, skip=3, nspec=5, mmap=True)
+        assert isinstance(data1.base, np.memmap)
+        np.testing.assert_equal(data0, data1)
+        np.testing.assert_equal(hdr0['times'], hdr1['times'])
+
+    def test_read_volt_file_mmap(self, tmp_path):
+        filename = str(tmp_path / 'Voltage_test.dat')
+        write_test_file(filename, 8, nchan=2 * 2048, infochan=24, dtype='>u1')
+        hdr0, re0, im0 = io.read_volt_file(filename, skip=2)
+        hdr1, re1, im1 = io.read_volt_file(filename, skip=2, mmap=True)
+        assert re1.shape == (6, 2048, 2)
+        np.testing.assert_equal(re0, re1)
+        np.testing.assert_equal(im0, im1)
+
+class TestIterSpectra(object):
+    def test_iter_spectra(self, tmp_path):
+        filename = str(tmp_path / 'Spectra_test.dat')
+        write_test_file(filename, 23)
+        hdr, data = io.read_file(filename)
+        blocks = [(t.copy(), d.copy()) for t, d in io.iter_spectra(filename, 5)]
+        assert len(blocks) == 5
+        assert blocks[-1][1].shape == (3, 2048)
+        np.testing.assert_equal(np.concatenate([d for t, d in blocks]), data)
+        np.testing.assert_allclose(np.concatenate([t for t, d in blocks]), hdr['times'])
+
+    def test_iter_spectra_overlap(self, tmp_path):
+        filename = str(tmp_path / 'Spectra_test.dat')
+        write_test_file(filename, 23)
+        hdr, data = io.read_file(filename)
+        start = 2
+        for times, block in io.iter_spectra(filename, 8, overlap=3, skip=2):
+            assert block.shape[0] <= 8
+            np.testing.assert_equal(block, data[start:start + block.shape[0]])
+            np.testing.assert_allclose(times, hdr['times'][start:start + block.shape[0]])
+            end = start + block.shape[0]
+            start = end - 3
+        assert end == 23
+
+class TestFileSeries(object):
+    def setup_method(self):
+        self.inttime = 2e-9 * 4096 * 128
+
+    def write_files(self, tmp_path, nspecs, gap=0, **kwargs):
+        filenames, data = [], []
+        t0 = 1700000000.
+        for i, nspec in enumerate(nspecs):
+            filename = str(tmp_path / f'Spectra_{i}.dat')
+            data.append(write_test_file(filename, nspec, start_time=t0, seed=i, **kwargs))
+            filenames.append(filename)
+            t0 += nspec * self.inttime
+            if i == 1:
+                t0 += gap
+        return filenames[::-1], data
+
+    def test_read(self, tmp_path):
+        filenames, data = self.write_files(tmp_path, [10, 7, 12], gap=0.5)
+        data = np.concatenate(data)[:, 12:]
+        series = io.FileSeries(filenames)
+        assert series.nspec == 29
+        assert series.filenames[0].endswith('Spectra_0.dat')
+        inds, gaps = series.find_gaps()
+        np.testing.assert_equal(inds, [1])
+        np.testing.assert_allclose(gaps, [0.5], atol=1e-6)
+        times, d = series.read()
+        np.testing.assert_equal(d, data)
+        np.testing.assert_allclose(times, series.times)
+        times, d = series.read(skip=8, nspec=12)
+        np.testing.assert_equal(d, data[8:20])
+        np.testing.assert_allclose(times, series.times[8:20])
+        times, d = series.read(skip=11, nspec=3, mmap=True)
+        assert isinstance(d, np.memmap)
+        np.testing.assert_equal(d, data[11:14])
+
+    def test_read_time(self, tmp_path):
+        filenames, data = self.write_files(tmp_path, [10, 7, 12], gap=0.5)
+        data = np.concatenate(data)[:, 12:]
+        series = io.FileSeries(filenames)
+        t = series.times
+        assert series.time_to_index(t[20] + 0.1 * self.inttime) == 20
+        assert series.time_to_index(t[16] + 0.2) == 17  # in gap
+        times, d = series.read_time(t[5], t[19])
+        np.testing.assert_equal(d, data[5:19])
+
+    def test_read_volt(self, tmp_path):
+        filenames, data = self.write_files(tmp_path, [4, 5], nchan=2 * 2048,
+                                           infochan=24, dtype='>u1', AccLen=1)
+        series = io.FileSeries(filenames, volt=True)
+        times, re, im = series.read(skip=2, nspec=5)
+        _, re0, im0 = io.read_volt_file(series.filenames[0], skip=2)
+        _, re1, im1 = io.read_volt_file(series.filenames[1], nspec=3)
+        np.testing.assert_equal(re, np.concatenate([re0, re1]))
+        np.testing.assert_equal(im, np.concatenate([im0, im1]))
+
+class TestDecodeVolt(object):
+    def test_decode_volt(self):
+        rng = np.random.default_rng(0)
+        raw = rng.integers(0, 256, size=(3, 24 + 2 * 2048), dtype=np.uint8)
+        # reference decode: endian swap 64b words, then split nibbles
+        data = raw.view('>u8')[:, 3:].byteswap().view('>u1')
+        data_real = ((data & 0xf0).view('>i1') >> 4).reshape(3, 2048, 2)
+        data_imag = (((data << 4) & 0xf0).view('>i1') >> 4).reshape(3, 2048, 2)
+        d = io.decode_volt(raw, start=24, dtype='int8')
+        assert d.shape == (3, 2048, 2, 2)
+        np.testing.assert_equal(d[..., 0], data_real)
+        np.testing.assert_equal(d[..., 1], data_imag)
+        out = np.empty((3, 2048, 2), dtype='complex64')
+        v = io.decode_volt(raw, start=24, out=out)
+        assert v is out
+        np.testing.assert_equal(v, data_real + 1j * data_imag)
+        with pytest.raises(AssertionError):
+            io.decode_volt(raw, start=32)  # would read past the end of each spectrum
+
+    def test_read_volt_streams(self, tmp_path):
+        filename = str(tmp_path / 'Voltage_test.dat')
+        write_test_file(filename, 8, nchan=2 * 2048, infochan=24, dtype='>u1')
+        hdr, data_real, data_imag = io.read_volt_file(filename, skip=1, nspec=5)
+        v = io.read_volt_streams(filename, hdr, skip=1, nspec=5)
+        np.testing.assert_equal(v.real, data_real)
+        np.testing.assert_equal(v.imag, data_imag)
+
+class TestDetectVolt(object):
+    def test_detect_volt(self):
+        rng = np.random.default_rng(0)
+        raw = rng.integers(0, 256, size=(10, 24 + 2 * 2048), dtype=np.uint8)
+        v = io.decode_volt(raw, start=24)
+        pwr = v.real**2 + v.imag**2
+        p = io.detect_volt(raw, start=24, sum_pols=False)
+        np.testing.assert_allclose(p, pwr)
+        p = io.detect_volt(raw, start=24, nint=3)
+        assert p.shape == (3, 2048)
+        true_p = pwr.sum(axis=-1)[:9].reshape(3, 3, 2048).mean(axis=1)
+        np.testing.assert_allclose(p, true_p, rtol=1e-6)
+
+    def test_stokes_volt(self):
+        rng = np.random.default_rng(0)
+        raw = rng.integers(0, 256, size=(10, 24 + 2 * 2048), dtype=np.uint8)
+        v = io.decode_volt(raw, start=24)
+        x, y = v[..., 0], v[..., 1]
+        xx, yy, xy = x.real**2 + x.imag**2, y.real**2 + y.imag**2, np.conj(x) * y
+        ans = np.stack([xx + yy, xx - yy, 2 * xy.real, 2 * xy.imag], axis=-1)
+        np.testing.assert_allclose(io.stokes_volt(raw, start=24), ans)
+        s = io.stokes_volt(raw, start=24, nint=3, nfint=4)
+        assert s.shape == (3, 512, 4)
+        np.testing.assert_allclose(s, ans[:9].reshape(3, 3, 512, 4, 4).mean(axis=(1, 3)),
+                                   rtol=1e-5, atol=1e-5)
+
+    def test_read_power(self, tmp_path):
+        filenames = []
+        t0 = 1700000000.
+        inttime = 2e-9 * 4096
+        for i, nspec in enumerate([7, 6]):
+            filename = str(tmp_path / f'Voltage_{i}.dat')
+            write_test_file(filename, nspec, nchan=2 * 2048, infochan=24, dtype='>u1',
+                            start_time=t0, seed=i, AccLen=1)
+            filenames.append(filename)
+            t0 += nspec * inttime
+        series = io.FileSeries(filenames, volt=True)
+        times, re, im = series.read(skip=1)
+        pwr = np.sum(re.astype(float)**2 + im.astype(float)**2, axis=-1)
+        t, p = series.read_power(skip=1, nint=4)
+        assert p.shape == (3, 2048)
+        np.testing.assert_allclose(p, pwr[:12].reshape(3, 4, 2048).mean(axis=1), rtol=1e-6)
+        np.testing.assert_allclose(t, times[:12].reshape(3, 4).mean(axis=1))
+        t, st = series.read_stokes(skip=1, nint=4, nfint=2)
+        assert st.shape == (3, 1024, 4)
+        np.testing.assert_allclose(st[..., 0], pwr[:12].reshape(3, 4, 1024, 2).mean(axis=(1, 3)),
+                                   rtol=1e-6)
+        np.testing.assert_allclose(t, times[:12].reshape(3, 4).mean(axis=1))
@@ -0,0 +1,162 @@
+'''Tests for limbo.pipeline'''
+import pytest
+import os
+import numpy as np
+
+from limbo import pipeline, io, utils, sim
+from test_io import write_test_file
+
+NSPEC = 1024
+
+def frb_spectra(nspec=NSPEC, pulse_amp=0, seed=0, t_pulse=None):
+    '''Return noisy, smooth spectra with an optional FRB at DM 332.7 at
+    t_pulse [s] (default: near the middle).'''
+    rng = np.random.default_rng(seed)
+    freqs = utils.calc_freqs(500e6, 1350e6, 2048)
+    inttime = utils.calc_inttime(500e6, 128, 2048)
+    times = np.arange(nspec) * inttime
+    x = np.linspace(0, 1, freqs.size)
+    spec = 1e4 * (1 + 0.5 * np.sin(3 * x))
+    data = np.outer(np.ones(nspec), spec)
+    data += rng.standard_normal(data.shape) * data / 128**0.5
+    if pulse_amp > 0:
+        t_pulse = times[nspec // 2] if t_pulse is None else t_pulse
+        data += spec * sim.make_frb(times, freqs, DM=332.7, pulse_width=2e-3,
+                                    pulse_amp=pulse_amp, t0=t_pulse)
+    return np.around(data)
+
+def write_frb_file(filename, pulse_amp=0, seed=0):
+    '''Write a file of noisy, smooth spectra with an optional FRB at DM 332.7
+    near the middle of the file.'''
+    write_test_file(filename, NSPEC, spectra=frb_spectra(pulse_amp=pulse_amp, seed=seed),
+                    seed=seed)
+
+class TestPipeline(object):
+    def test_process_file(self, tmp_path):
+        for d in ('save', 'remove', 'db'):
+            os.mkdir(tmp_path / d)
+        config = pipeline.get_config('sgr1935', save_dir=str(tmp_path / 'save'),
+                                     remove_dir=str(tmp_path / 'remove'),
+                                     update_database=True, database_dir=str(tmp_path / 'db'))
+        frb = str(tmp_path / 'frb.dat')
+        write_frb_file(frb, pulse_amp=0.05)
+        rv = pipeline.process_file(frb, config)
+        assert rv['interesting'] and rv['save_file']
+        assert rv['outfile'] == str(tmp_path / 'save' / 'frb.dat')
+        assert os.path.exists(rv['outfile']) and not os.path.exists(frb)
+        db = np.load(str(tmp_path / 'db' / 'frb.dat.npz'))
+        assert db['nevents'] == rv['tind_events'].size
+        assert db['filename'] == frb
+        inttime = rv['hdr']['inttime']
+        assert np.all(np.abs(rv['t_events'] - NSPEC // 2 * inttime) < 0.02)
+        assert rv['pulses']['count'].sum() == rv['tind_events'].size
+        assert rv['pulses']['time'].size == 1
+        assert abs(rv['candidates']['dm'][0] - 332.7) < 20
+        noise = str(tmp_path / 'noise.dat')
+        write_frb_file(noise, seed=1)
+        rv = pipeline.process_file(noise, config)
+        assert not rv['save_file']
+        assert os.path.exists(tmp_path / 'remove' / 'noise.dat')
+
+    def test_process_files(self, tmp_path):
+        # a burst whose sweep (within ch0:ch1) straddles two contiguous files
+        inttime = utils.calc_inttime(500e6, 128, 2048)
+        freqs = utils.calc_freqs(500e6, 1350e6, 2048)
+        t_pulse = (NSPEC - 100) * inttime
+        data = frb_spectra(2 * NSPEC, pulse_amp=0.05, t_pulse=t_pulse)
+        t0 = 1700000000.25
+        filenames = [str(tmp_path / f'spec_{i}.dat') for i in range(3)]
+        for i, filename in enumerate(filenames[:2]):
+            write_test_file(filename, NSPEC, spectra=data[i * NSPEC:(i + 1) * NSPEC],
+                            start_time=t0 + i * NSPEC * inttime, seed=i)
+        # a gap starts a new stream; a burst in the last Stream.fdmt.overlap
+        # samples of a run is found once the stream is flushed
+        t_tail = (NSPEC - 180) * inttime
+        write_test_file(filenames[2], NSPEC, spectra=frb_spectra(pulse_amp=0.05, seed=2,
+                                                                 t_pulse=t_tail),
+                        start_time=t0 + 3 * NSPEC * inttime, seed=2)
+        for d in ('save', 'remove', 'db'):
+            os.mkdir(tmp_path / d)
+        config = pipeline.get_config('sgr1935', save_dir=str(tmp_path / 'save'),
+                                     remove_dir=str(tmp_path / 'remove'),
+                                     update_database=True, database_dir=str(tmp_path / 'db'))
+        rv = pipeline.process_files(filenames, config)
+        assert len(rv) == 3
+        cands = rv[1]['candidates']
+        assert abs(cands['dm'][0] - 332.7) < 20
+        # candidate times are at the top of the DM transform window
+        t_top = t_pulse + utils.DM_delay(332.7, freqs[config['ch1'] - 1]) \
+            - utils.DM_delay(332.7, freqs[-1])
+        assert t_top < NSPEC * inttime
+        assert abs(cands['time'][0] - (t0 + t_top)) < 0.01
+        # the burst (found while processing spec_1) is credited to spec_0
+        assert rv[0]['save_file'] and not rv[1]['save_file'] and rv[2]['save_file']
+        assert np.all(np.abs(rv[0]['t_events'] - t_pulse) < 0.02)
+        assert rv[0]['pulses']['time'].size == 1
+        assert abs(rv[0]['pulses']['tind'][0] / config['resamp'] * inttime - t_pulse) < 0.02
+        assert rv[1]['t_events'].size == 0
+        assert np.all(np.abs(rv[2]['t_events'] - t_tail) < 0.02)
+        assert rv[2]['candidates']['time'].size > 0
+        for i, d in enumerate(('save', 'remove', 'save')):
+            assert os.path.exists(tmp_path / d / f'spec_{i}.dat')
+        db = np.load(str(tmp_path / 'db' / 'spec_0.dat.npz'))
+        assert db['nevents'] == rv[0]['tind_events'].size > 0
+        assert db['zscore'] == rv[0]['zmax'] > config['nsig']
+        assert np.load(str(tmp_path / 'db' / 'spec_1.dat.npz'))['nevents'] == 0
+
+    def test_volt_files(self, tmp_path):
+        os.mkdir(tmp_path / 'volt')
+        t = 1700000000.25
+        vfiles = [str(tmp_path / 'volt' / f'Voltage_{i}.dat') for i in range(4)]
+        for vfile, dt in zip(vfiles, (-3, -0.5, 2, 6)):
+            write_test_file(vfile, 4, nchan=2 * 2048, infochan=24, dtype='>u1',
+                            start_time=t + dt, AccLen=1)
+        config = pipeline.get_config('sgr1935', volt_dir=str(tmp_path / 'volt'))
+        assert pipeline._volt_files(t, config) == vfiles[1:3]
+        config['catalog'] = str(tmp_path / 'cat.sqlite')
+        assert pipeline._volt_files(t, config) == vfiles[1:3]
+        os.remove(vfiles[1])
+        assert pipeline._volt_files(t, config) == vfiles[2:3]
+
+    def test_plot_summary_stream(self, tmp_path):
+        pytest.importorskip('matplotlib')
+        inttime = utils.calc_inttime(500e6, 128, 2048)
+        filenames = [str(tmp_path / f'spec_{i}.dat') for i in range(2)]
+        for i, filename in enumerate(filenames):
+            write_test_file(filename, NSPEC, spectra=frb_spectra(seed=i),
+                            start_time=1700000000.25 + i * NSPEC * inttime, seed=i)
+        os.mkdir(tmp_path / 'plots')
+        config = pipeline.get_config('sgr1935', plot_dir=str(tmp_path / 'plots'))
+        pipeline.process_files(filenames, config)
+        assert len(os.listdir(tmp_path / 'plots')) == 2
+
+    def test_get_config(self):
+        config = pipeline.get_config('crab', nsig=7)
+        assert config['dm'] == 56.7
+        assert config['nsig'] == 7
+        assert pipeline.get_config()['dm'] == 332.7
+        with pytest.raises(ValueError, match="'unknown'"):
+            pipeline.get_config('unknown')
+
+class TestEvents(object):
+    def test_dm_range_max(self):
+        rng = np.random.default_rng(0)
+        dmt = rng.standard_normal((64, 100)).astype('float32')
+        dms = np.linspace(0, 500, 100, endpoint=False)
+        ranges = [(0, 100), (100, 200), (50, 300), (300, 310), (301, 304), (450, 1000), (600, 700)]
+        rv = pipeline.dm_range_max(dmt, dms, ranges)
+        assert (301, 304) not in rv and (600, 700) not in rv
+        for lo, hi in ranges:
+            sel = np.logical_and(hi > dms, dms >= lo)
+            if np.any(sel):
+                np.testing.assert_equal(rv[lo, hi], dmt[:, sel].max(axis=1))
+        rv = pipeline.dm_range_max(dmt, dms, [0, 100, 200])
+        assert list(rv.keys()) == [(0, 100), (100, 200)]
+
+    def test_veto_threshold(self):
+        out = np.zeros(100)
+        out[50] = 10
+        np.testing.assert_equal(pipeline.veto_threshold(out, 5, 4, None), 5)
+        thresh = pipeline.veto_threshold(out, 5, 4, 6)
+        assert thresh.min() == 5
+        np.testing.assert_equal(np.where(thresh > 5)[0], np.arange(43, 53))
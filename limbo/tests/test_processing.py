@@ -0,0 +1,177 @@
+'''Tests for limbo.processing'''
+import pytest
+import numpy as np
+
+from limbo import processing, io, _process
+
+NTIMES = 512
+NFREQ = 2048
+ACCLEN = 128
+
+def make_filter(nfreqs=NFREQ, nmodes=24):
+    '''Return a frequency mask and a smooth (cosine) filter for it.'''
+    fmask = np.ones(nfreqs, dtype=bool)
+    fmask[:100] = fmask[-100:] = False
+    fmask[1200:1210] = False
+    x = np.arange(nfreqs)
+    amat = np.array([np.cos(np.pi * i * x / nfreqs) for i in range(nmodes)]).T
+    fmat = np.linalg.pinv(amat * fmask[:, None])
+    return fmask, amat.astype('float32'), fmat.astype('float32')
+
+def make_data(seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, NFREQ)
+    spec = 1e4 * (1 + 0.5 * np.sin(3 * x))
+    gain = 1 + 0.01 * rng.standard_normal(NTIMES)
+    data = np.outer(gain, spec)
+    data += rng.standard_normal(data.shape) * data / ACCLEN**0.5
+    data[100:104] *= 1.5  # broadband gain glitch
+    data[:, 700] *= 1.2  # persistent bad channel
+    data[300, 1171:1308] *= 1.3  # "hot" zone RFI
+    hdr = {'AccLen': ACCLEN}
+    return hdr, data.astype('>u2')
+
+class TestProcessData(object):
+    def test_blockwise(self):
+        hdr, data = make_data()
+        fmask, amat, fmat = make_filter()
+        kwargs = dict(freq_amat=amat, freq_fmat=fmat, do_dmt=False, inpaint=False)
+        dmt0 = processing.process_data(hdr, data, fmask=fmask.copy(), **kwargs)
+        dmt1 = processing.process_data_blockwise(hdr, data, fmask=fmask, max_mem=2**20, **kwargs)
+        np.testing.assert_equal(fmask, make_filter()[0])  # input not modified
+        assert not dmt0['tmask'][101]
+        assert not dmt0['fmask'][700]
+        np.testing.assert_equal(dmt0['tmask'], dmt1['tmask'])
+        np.testing.assert_equal(dmt0['fmask'], dmt1['fmask'])
+        np.testing.assert_allclose(dmt0['fmdl'], dmt1['fmdl'], rtol=1e-5)
+        np.testing.assert_allclose(dmt0['tmdl'], dmt1['tmdl'], rtol=1e-5)
+        np.testing.assert_equal(dmt0['hmask'], dmt1['hmask'])
+        assert dmt0['hmask'][300]
+        np.testing.assert_allclose(dmt0['diff'], dmt1['diff'], atol=1e-2 * dmt0['diff'].std())
+
+    def test_blockwise_inpaint(self):
+        hdr, data = make_data()
+        fmask, amat, fmat = make_filter()
+        dmt = processing.process_data_blockwise(hdr, data, fmask=fmask, freq_amat=amat,
+                                                freq_fmat=fmat, do_dmt=False, max_mem=2**20)
+        assert np.all(dmt['diff'][:, ~dmt['fmask']] != 0)
+        assert np.all(dmt['diff'][~dmt['tmask']] != 0)
+
+    def test_fused(self):
+        hdr, data = make_data()
+        fmask, amat, fmat = make_filter()
+        kwargs = dict(freq_amat=amat, freq_fmat=fmat, do_dmt=False, inpaint=False,
+                      do_zscore=True)
+        dmt0 = processing.process_data(hdr, data, fmask=fmask, fused=False, **kwargs)
+        dmt1 = processing.process_data(hdr, data, fmask=fmask, fused=True, **kwargs)
+        np.testing.assert_equal(fmask, make_filter()[0])  # input not modified
+        assert not dmt0['fmask'][700]
+        for k in ('tmask', 'fmask', 'hmask'):
+            np.testing.assert_equal(dmt0[k], dmt1[k])
+        for k in ('fmdl', 'tmdl'):
+            np.testing.assert_allclose(dmt0[k], dmt1[k], rtol=1e-5)
+        for k in ('diff', 'zscore'):
+            np.testing.assert_allclose(dmt0[k], dmt1[k], atol=1e-3 * dmt0[k].std())
+
+    def test_default_fmask(self):
+        # flags are not written back into the cached default mask
+        hdr, data = make_data()
+        fmask = processing.FREQ_MASK.copy()
+        for fused in (False, True):
+            dmt = processing.process_data(hdr, data, do_dmt=False, fused=fused)
+            assert not dmt['fmask'][700]
+            np.testing.assert_equal(processing.FREQ_MASK, fmask)
+
+    def test_detrend_flag_hot_zone(self):
+        # the hot zone need not lie within ch0:ch1
+        hdr, data = make_data()
+        data = data.astype('float32')
+        fmask = make_filter()[0]
+        fmdl = data.mean(axis=0)
+        tmdl = (data / fmdl).mean(axis=1).astype('float32')
+        nos = fmdl / ACCLEN**0.5
+        fwgt = fmask.astype('float32')
+        zsq = (data - np.outer(tmdl, fmdl)) / nos
+        zsq *= np.abs(zsq)
+        hch0, hch1 = 1171, 1308
+        hmask = np.mean(zsq[:, hch0:hch1], axis=1) > 3**2
+        assert hmask[300]
+        for ch0, ch1 in ((200, 1000), (1200, 1600), (400, 1424)):
+            w = np.outer(np.ones(NTIMES), fwgt)
+            w[hmask, hch0:hch1] = 0
+            ans = np.sum(w[:, ch0:ch1] * zsq[:, ch0:ch1], axis=1) / np.sum(w[:, ch0:ch1], axis=1)
+            d = data.copy()
+            _hmask = np.empty(NTIMES, dtype=np.uint8)
+            tzsq = np.empty(NTIMES, dtype='float32')
+            _process.detrend_flag(d, tmdl, fmdl, (1 / nos).astype('float32'), fwgt, ch0, ch1,
+                                  hch0, hch1, 3**2, _hmask, tzsq)
+            np.testing.assert_equal(_hmask.astype(bool), hmask)
+            np.testing.assert_allclose(tzsq, ans, rtol=1e-3, atol=1e-4)
+
+    def test_inpaint_seed(self):
+        hdr, data = make_data()
+        fmask, amat, fmat = make_filter()
+        kwargs = dict(freq_amat=amat, freq_fmat=fmat, do_dmt=False)
+        for fused in (True, False):
+            dmt0 = processing.process_data(hdr, data, fmask=fmask.copy(), rng=3,
+                                           fused=fused, **kwargs)
+            dmt1 = processing.process_data(hdr, data, fmask=fmask.copy(), rng=3,
+                                           fused=fused, **kwargs)
+            np.testing.assert_equal(dmt0['diff'], dmt1['diff'])
+            assert 'zscore' not in dmt0
+            mask = np.outer(dmt0['tmask'], dmt0['fmask'])
+            mask[dmt0['hmask'], 1171:1308] = 0
+            assert np.all(dmt0['diff'][~mask] != 0)
+            # only flagged data is inpainted
+            dmt2 = processing.process_data(hdr, data, fmask=fmask.copy(), fused=fused,
+                                           **dict(kwargs, inpaint=False))
+            np.testing.assert_equal(dmt0['diff'][mask], dmt2['diff'][mask])
+            assert np.abs(np.std(dmt0['diff'][:, 700]) / np.std(dmt0['diff'][:, 701]) - 1) < 0.1
+
+class TestDPSSProjector(object):
+    def test_matches_dpss_filter(self, tmp_path):
+        rng = np.random.default_rng(1)
+        amat = rng.standard_normal((256, 8)) + 1j * rng.standard_normal((256, 8))
+        fmat = rng.standard_normal((8, 256)) + 1j * rng.standard_normal((8, 256))
+        y = rng.standard_normal((5, 256))
+        proj = processing.DPSSProjector(amat, fmat, dtype='float64')
+        assert proj.rank == 16
+        ans = np.array([processing.dpss_filter(yi, amat, fmat) for yi in y])
+        np.testing.assert_allclose(proj(y), ans, rtol=1e-10, atol=1e-10)
+        np.testing.assert_allclose(proj(y[0]), ans[0], rtol=1e-10, atol=1e-10)
+        proj.save(tmp_path / 'proj.npz')
+        proj2 = processing.DPSSProjector.load(tmp_path / 'proj.npz')
+        np.testing.assert_equal(proj2(y), proj(y))
+
+    def test_tol(self):
+        fmask, amat, fmat = make_filter()
+        proj = processing.DPSSProjector(amat, fmat, tol=1e-6)
+        assert proj.rank == amat.shape[1]
+        y = make_data()[1].astype('float32')[:4] * fmask
+        np.testing.assert_allclose(proj(y), processing.dpss_filter(y.T, amat, fmat).T,
+                                   rtol=1e-3)
+
+    def test_process_data(self):
+        hdr, data = make_data()
+        fmask, amat, fmat = make_filter()
+        proj = processing.DPSSProjector(amat, fmat)
+        kwargs = dict(do_dmt=False, inpaint=False)
+        dmt0 = processing.process_data(hdr, data, fmask=fmask.copy(), freq_amat=amat,
+                                       freq_fmat=fmat, **kwargs)
+        dmt1 = processing.process_data(hdr, data, fmask=fmask.copy(), projector=proj, **kwargs)
+        np.testing.assert_allclose(dmt0['fmdl'], dmt1['fmdl'], rtol=1e-4)
+        np.testing.assert_equal(dmt0['tmask'], dmt1['tmask'])
+
+class TestProcessVoltage(object):
+    def test_compute_stokes_params(self):
+        rng = np.random.default_rng(0)
+        raw = rng.integers(0, 256, size=(20, 24 + 2 * NFREQ), dtype=np.uint8)
+        d = io.decode_volt(raw, start=24, dtype='int8')
+        pv = processing.ProcessVoltage(0, [], None, None)
+        ans = io.stokes_volt(raw, start=24, nint=4, nfint=8)
+        stokes = pv.compute_stokes_params(d[..., 0], d[..., 1], nint=4, nfint=8, block=6)
+        assert stokes.shape == (5, NFREQ // 8, 4)
+        np.testing.assert_allclose(stokes, ans, rtol=1e-5, atol=1e-5)
+        stokes = pv.compute_stokes_params(d[..., 0].astype(float), d[..., 1].astype(float),
+                                          nint=4, nfint=8, block=6)
+        np.testing.assert_allclose(stokes, ans, rtol=1e-5, atol=1e-5)
@@ -28,3 +28,105 @@ class TestUtils(object):
         ans = utils.dedisperse(profile, DM, times, freqs)
         assert np.sqrt(np.sum(np.abs(ans - ans[:,-1:])**2)) < 2e-2
         
+    def test_dedisperse_shift(self):
+        rng = np.random.default_rng(0)
+        data = rng.standard_normal((256, 64)).astype('float32')
+        freqs = np.linspace(1.35e9, 1.6e9, 64)
+        inttime = 1e-3
+        shifts = (utils.DM_delay(100, freqs) - utils.DM_delay(100, freqs[-1])) / inttime
+        ans = np.array([np.roll(data[:, c], -int(np.floor(s + 0.5)))
+                        for c, s in enumerate(shifts)]).T
+        out = utils.dedisperse(data, 100, freqs, inttime, mode='shift')
+        np.testing.assert_array_equal(out, ans)
+        # smooth signals agree with phase rotation
+        t = np.arange(256)
+        data = np.outer(np.sin(2 * np.pi * t / 256), np.ones(64)).astype('float32')
+        fft = utils.dedisperse(data, 100, freqs, inttime, oversample=2)
+        out = utils.dedisperse(data, 100, freqs, inttime, oversample=2, mode='interp')
+        np.testing.assert_allclose(out, fft, atol=1e-3)
+
+    def test_dedisperse_profile(self):
+        rng = np.random.default_rng(0)
+        data = rng.standard_normal((256, 64)).astype('float32')
+        freqs = np.linspace(1.35e9, 1.6e9, 64)
+        for mode in ('fft', 'shift', 'interp'):
+            ans = utils.dedisperse(data, 100, freqs, 1e-3, 4, mode=mode)[:, 10:50].mean(axis=1)
+            prf = utils.dedisperse_profile(data, 100, freqs, 1e-3, 4, 10, 50, mode=mode)
+            np.testing.assert_allclose(prf, ans, atol=1e-5)
+
+    def test_dedisperse_events(self):
+        rng = np.random.default_rng(0)
+        data = rng.standard_normal((2048, 64)).astype('float32')
+        freqs = np.linspace(1.35e9, 1.6e9, 64)
+        full = utils.dedisperse_profile(data, 300, freqs, 1e-3, 4, 10, 50, mode='shift')
+        windows, prfs, zs = utils.dedisperse_events(data, [1500, 100, 110, 2040], 300, freqs,
+                                                    1e-3, 4, 10, 50, pad=5, mode='shift')
+        # sweep is 78 samples; nearby events are merged
+        np.testing.assert_array_equal(windows // 4, [[0, 116], [1298, 1506], [1838, 2046]])
+        zfull = (full - full.mean()) / full.std()
+        for (t0, t1), prf, z in zip(windows, prfs, zs):
+            np.testing.assert_array_equal(prf, full[t0:t1])
+            # robust noise of the windows is within sampling error of the full std
+            np.testing.assert_allclose(z, zfull[t0:t1], rtol=0.1, atol=0.1)
+        # noise shared between channels (a slow drift) is part of the noise level
+        data += 3 * np.sin(np.arange(2048) / 100)[:, None].astype('float32')
+        windows, prfs, zs = utils.dedisperse_events(data, [100, 1000, 1500], 300, freqs,
+                                                    1e-3, 4, 10, 50, pad=5, mode='shift')
+        assert np.abs(np.concatenate(zs)).max() < 5.5
+
+    def test_choose_mode(self):
+        freqs = np.linspace(1.35e9, 1.6e9, 64)
+        assert utils.choose_mode((256, 64), 100, freqs, 1e-3) == 'fft'
+        assert utils.choose_mode((4096, 64), 100, freqs, 1e-3) == 'interp'
+        assert utils.choose_mode((4096, 64), 1, freqs, 1e-3) == 'fft'
+
+    def test_dm_search(self):
+        inttime = 1e-3
+        times = np.arange(512) * inttime
+        freqs = np.linspace(1350e6, 1600e6, 64, endpoint=False)
+        rng = np.random.default_rng(0)
+        data = sim.make_frb(times, freqs, DM=50, pulse_amp=20, t0=times[100])
+        data += rng.standard_normal(data.shape).astype('float32')
+        dms = np.linspace(30, 70, 40, endpoint=False)
+        ans = []
+        for dm in dms:
+            prf = utils.dedisperse(data, dm, freqs, inttime, 2)[:, 4:60].mean(axis=-1)
+            ans.append(np.max((prf - prf.mean()) / prf.std()))
+        for nthreads, nblock in ((1, 16), (3, 7)):
+            zscore, tind = utils.dm_search(data, dms, freqs, inttime, oversample=2, ch0=4, ch1=60,
+                                           nblock=nblock, nthreads=nthreads)
+            np.testing.assert_allclose(zscore, ans, atol=1e-3)
+            assert dms[np.argmax(zscore)] == 50
+            assert abs(tind[np.argmax(zscore)] - 200) <= 2
+        zscore, tind = utils.dm_search(data, dms[::-3] ** 1.01, freqs, inttime, ch0=4, ch1=60)
+        assert zscore.shape == (14,)
+
+
+class TestGaussianNoise(object):
+    def test_standard_normal(self):
+        for nthreads in (1, 3):
+            noise = utils.GaussianNoise(seed=1, nthreads=nthreads)
+            n = noise.standard_normal((512, 256))
+            assert n.dtype == np.float32
+            assert np.abs(np.mean(n)) < 0.01
+            assert np.abs(np.std(n) - 1) < 0.01
+            with utils.GaussianNoise(seed=1, nthreads=nthreads) as noise2:
+                n2 = noise2.standard_normal((512, 256))
+            np.testing.assert_equal(n, n2)
+            # the pool is reused between draws and shut down on close
+            pool = noise._pool
+            noise.standard_normal((512, 256))
+            assert noise._pool is pool
+            noise.close()
+            assert noise._pool is None and noise2._pool is None
+
+    def test_inpaint(self):
+        data = np.zeros((1000, 8), dtype='float32')
+        mask = np.ones(data.shape, dtype=bool)
+        mask[:, 2] = False
+        mask[5] = False
+        scale = np.arange(8, dtype='float32')
+        utils.GaussianNoise(seed=0).inpaint(data, mask, scale)
+        assert np.all(data[mask] == 0)
+        assert np.all(data[:, 3:][~mask[:, 3:]] != 0)
+        assert np.abs(np.std(data[:, 2]) - 2) < 0.2
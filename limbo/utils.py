@@ -1,7 +1,7 @@
 '''Utility functions for LIMBO'''
 
 import numpy as np
-from scipy.fft import rfft, irfft
+from concurrent.futures import ThreadPoolExecutor
 
 def calc_inttime(sample_freq_hz, acc_len, nchan):
     '''Calculate integration time [s] from sample_freq and acc_len.'''
@@ -30,22 +30,241 @@ def DM_delay(DM, freq):
     """
     return np.float32(DM * DM_CONST) / freq**2
 
-def dedisperse(profile, dm, freqs, inttime, oversample=1, dtype=None):
+# 'auto' de-dispersion uses shift-and-add for arrays at least this large
+# whose dispersion sweep spans at least this many samples
+SHIFT_MIN_SIZE = 2**16
+SHIFT_MIN_SPAN = 16
+
+def choose_mode(shape, dm, freqs, inttime):
+    '''Return the de-dispersion mode 'auto' picks: 'interp' (linearly
+    interpolated shift-and-add) when the array is large and the delays
+    span many samples, so sub-sample accuracy is irrelevant; else 'fft'.'''
+    span = abs(DM_delay(dm, freqs[0]) - DM_delay(dm, freqs[-1])) / inttime
+    if np.prod(shape) >= SHIFT_MIN_SIZE and span >= SHIFT_MIN_SPAN:
+        return 'interp'
+    return 'fft'
+
+def _dedisperse_args(profile, dm, freqs, inttime, dtype, mode):
     if dtype is None:
         dtype = 1
         if profile.dtype.itemsize > 4:
             dtype = 2
     assert dtype in (1, 2)
     if dtype == 1:
-        dtype = 'float32'
-        cdtype = 'complex64'
+        dtype, cdtype = 'float32', 'complex64'
     else:
-        dtype = 'float64'
-        cdtype = 'complex128'
-    _ffreq = np.fft.rfftfreq(profile.shape[0], inttime).astype(dtype)
+        dtype, cdtype = 'float64', 'complex128'
+    if mode == 'auto':
+        mode = choose_mode(profile.shape, dm, freqs, inttime)
+    assert mode in ('fft', 'shift', 'interp')
     delays = DM_delay(dm, freqs) - DM_delay(dm, freqs[-1])
+    return dtype, cdtype, mode, delays
+
+def dedisperse(profile, dm, freqs, inttime, oversample=1, dtype=None, mode='fft'):
+    '''De-disperse (ntimes, nfreqs) profile to dm, aligning channels with the
+    highest frequency and wrapping around in time, over-sampled in time by
+    oversample. Mode is 'fft' (phase rotation), 'shift' (nearest-sample
+    shift-and-add), 'interp' (linearly interpolated shift-and-add), or
+    'auto' (see choose_mode).'''
+    dtype, cdtype, mode, delays = _dedisperse_args(profile, dm, freqs, inttime, dtype, mode)
+    if mode != 'fft':
+        from . import _dedisp
+        data = np.ascontiguousarray(profile, dtype=dtype)
+        out = np.empty((oversample * data.shape[0], data.shape[1]), dtype=dtype)
+        _dedisp.shift(data, delays / inttime, oversample, mode == 'interp', out)
+        return out
+    _ffreq = np.fft.rfftfreq(profile.shape[0], inttime).astype(dtype)
     delays = delays.astype(dtype)
     phs = np.exp(np.asarray(2j * np.pi).astype(cdtype) * np.outer(_ffreq, delays))
+    from scipy.fft import rfft, irfft  # deferred: slow to import
     _profile = rfft(profile, axis=0)
     profile = irfft(_profile * phs, oversample * profile.shape[0], axis=0) * oversample
     return profile
+
+def dedisperse_profile(profile, dm, freqs, inttime, oversample=1, ch0=0, ch1=None,
+                       dtype=None, mode='fft'):
+    '''Return np.mean(dedisperse(profile, ...)[:, ch0:ch1], axis=-1)
+    without forming the de-dispersed array: channels are summed in the
+    Fourier domain before one inverse FFT ('fft'), or while shifting.'''
+    ch1 = freqs.size if ch1 is None else ch1
+    data = profile[:, ch0:ch1]
+    dtype, cdtype, mode, delays = _dedisperse_args(data, dm, freqs, inttime, dtype, mode)
+    delays = delays[ch0:ch1]
+    if mode != 'fft':
+        from . import _dedisp
+        out = np.empty(oversample * data.shape[0], dtype='float64')
+        _dedisp.shift_sum(np.ascontiguousarray(data, dtype=dtype), delays / inttime,
+                          oversample, mode == 'interp', out)
+        return (out / (ch1 - ch0)).astype(dtype)
+    from scipy.fft import rfft, irfft
+    _ffreq = np.fft.rfftfreq(data.shape[0], inttime).astype(dtype)
+    phs = np.exp(np.asarray(2j * np.pi).astype(cdtype) * np.outer(_ffreq, delays.astype(dtype)))
+    _profile = np.sum(rfft(data.astype(dtype, copy=False), axis=0) * phs, axis=1)
+    profile = irfft(_profile, oversample * data.shape[0]) * oversample
+    return profile / (ch1 - ch0)
+
+# samples added to each side of 'fft' event cutouts
+EVENT_GUARD = 64
+
+def dedisperse_events(profile, tinds, dm, freqs, inttime, oversample=1, ch0=0, ch1=None,
+                      pad=0, dtype=None, mode='fft'):
+    '''De-disperse only the parts of profile where events seen at times
+    tinds could appear at dm, instead of the whole file. An event may be
+    referenced to any frequency in the band, so each window spans the
+    dispersion sweep across freqs before the event, plus pad samples on
+    either side; overlapping windows are merged. Each window is cut out
+    with the trailing samples it needs (wrapping around in time), so
+    results match dedisperse_profile of the whole profile (exactly for
+    shift modes; 'fft' cutouts get guard samples to damp edge ringing).
+    Returns:
+        windows: (nwin, 2) start, stop of each window in samples of the
+            over-sampled whole-file profile.
+        profiles: List of the de-dispersed channel-averaged profile in
+            each window.
+        zscores: List of profiles as zscores, using the median and MAD
+            (scaled to a gaussian standard deviation) of all the windowed
+            profiles, so that a pulse, or noise shared between channels,
+            does not bias the noise level.
+    '''
+    ch1 = freqs.size if ch1 is None else ch1
+    ntimes = profile.shape[0]
+    sweep = int(np.ceil((DM_delay(dm, freqs[0]) - DM_delay(dm, freqs[-1])) / inttime))
+    nneed = int(np.ceil((DM_delay(dm, freqs[ch0]) - DM_delay(dm, freqs[-1])) / inttime)) + 2
+    tinds = np.unique(np.asarray(tinds, dtype=np.int64))
+    windows = []
+    for t0, t1 in zip(tinds - sweep - pad, tinds + pad + 1):
+        t0, t1 = max(t0, 0), min(t1, ntimes)
+        if windows and t0 <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], t1)
+        else:
+            windows.append([t0, t1])
+    windows = np.array(windows, dtype=np.int64).reshape(-1, 2)
+    if mode == 'auto':
+        mode = choose_mode((windows[:, 1] - windows[:, 0]).max(initial=0) + nneed, dm,
+                           freqs, inttime)
+    guard = EVENT_GUARD if mode == 'fft' else 0
+    profiles = []
+    for t0, t1 in windows:
+        rows = np.arange(t0 - guard, t1 + nneed + guard) % ntimes
+        prf = dedisperse_profile(profile[rows], dm, freqs, inttime, oversample, ch0, ch1,
+                                 dtype=dtype, mode=mode)
+        profiles.append(prf[oversample * guard:oversample * (t1 - t0 + guard)])
+    zscores = []
+    if profiles:
+        allprf = np.concatenate(profiles)
+        avg = np.median(allprf)
+        sig = 1.4826 * np.median(np.abs(allprf - avg))
+        if not sig > 0:
+            sig = np.std(allprf) or 1.
+        zscores = [((prf - avg) / sig).astype(prf.dtype) for prf in profiles]
+    return windows * oversample, profiles, zscores
+
+def dm_search(profile, dms, freqs, inttime, oversample=1, ch0=0, ch1=None,
+              nblock=16, nthreads=1):
+    '''Search DM trials for the peak zscore of the channel-averaged profile,
+    matching np.mean(dedisperse(profile, dm, ...)[:, ch0:ch1], axis=-1)
+    for each dm in dms. The forward FFT is done once, channels are summed
+    before the inverse FFT, and phases for evenly spaced trials are stepped
+    by multiplication. Blocks of nblock trials run on nthreads threads.
+    Returns:
+        zscore: (ndms,) peak zscore of the de-dispersed profile at each DM.
+        tind: (ndms,) index of the peak in the (over-sampled) profile.
+    '''
+    from scipy.fft import rfft, irfft
+    dtype = 'float64' if profile.dtype.itemsize > 4 else 'float32'
+    cdtype = np.result_type(dtype, np.complex64)
+    dms = np.asarray(dms, dtype='float64')
+    ch1 = freqs.size if ch1 is None else ch1
+    ntimes = profile.shape[0]
+    _ffreq = np.fft.rfftfreq(ntimes, inttime)
+    # delay [s] per unit DM of each channel, relative to the top channel
+    kdelay = DM_delay(1., freqs[ch0:ch1]) - DM_delay(1., freqs[-1])
+    fk = 2 * np.pi * np.outer(_ffreq, kdelay)
+    _profile = rfft(np.asarray(profile[:, ch0:ch1], dtype=dtype), axis=0)
+    ddm = np.diff(dms)
+    even = ddm.size > 0 and np.allclose(ddm, ddm[0])
+    step = np.exp(1j * fk * ddm[0]).astype(cdtype) if even else None
+
+    def _search(i0):
+        i1 = min(i0 + nblock, dms.size)
+        _sum = np.empty((i1 - i0, _ffreq.size), dtype=cdtype)
+        phs = np.exp(1j * fk * dms[i0]).astype(cdtype)
+        for i in range(i0, i1):
+            if i > i0:
+                if even:
+                    phs *= step
+                else:
+                    phs = np.exp(1j * fk * dms[i]).astype(cdtype)
+            np.einsum('ij,ij->i', _profile, phs, out=_sum[i - i0])
+        prf = irfft(_sum, oversample * ntimes, axis=1)
+        zscore = (prf - prf.mean(axis=1, keepdims=True)) / prf.std(axis=1, keepdims=True)
+        return zscore.max(axis=1), zscore.argmax(axis=1)
+
+    blocks = range(0, dms.size, nblock)
+    if nthreads > 1:
+        with ThreadPoolExecutor(nthreads) as pool:
+            rv = list(pool.map(_search, blocks))
+    else:
+        rv = [_search(i0) for i0 in blocks]
+    zscore = np.concatenate([z for z, t in rv])
+    tind = np.concatenate([t for z, t in rv])
+    return zscore, tind
+
+class GaussianNoise:
+    '''Reusable, seedable source of gaussian noise for inpainting flagged data.
+    With nthreads > 1, large draws are split across independent bit
+    generator streams on a thread pool, started on the first such draw and
+    kept until close(); results are reproducible for a given (seed,
+    nthreads).'''
+
+    def __init__(self, seed=None, nthreads=1):
+        self.nthreads = nthreads
+        seeds = np.random.SeedSequence(seed).spawn(nthreads)
+        self.rngs = [np.random.default_rng(s) for s in seeds]
+        self._pool = None
+
+    def close(self):
+        '''Shut down the thread pool, if any. Later draws start a new one.'''
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def standard_normal(self, size, dtype='float32'):
+        '''Draw standard normal noise directly in dtype (float32 or float64).'''
+        out = np.empty(size, dtype=dtype)
+        flat = out.reshape(-1)
+        if self.nthreads == 1 or flat.size < 2**16:
+            self.rngs[0].standard_normal(out=flat, dtype=dtype)
+            return out
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.nthreads)
+        chunks = np.array_split(flat, self.nthreads)
+        list(self._pool.map(lambda rng, chunk: rng.standard_normal(out=chunk, dtype=dtype),
+                            self.rngs, chunks))
+        return out
+
+    def inpaint(self, data, mask, scale):
+        '''Replace data where mask is False with gaussian noise, in place,
+        drawing only for flagged entries. Scale is the noise rms along the
+        last axis of data.'''
+        inds = np.nonzero(~mask)
+        noise = self.standard_normal(inds[-1].size, dtype=data.dtype)
+        noise *= np.asarray(scale, dtype=data.dtype)[inds[-1]]
+        data[inds] = noise
+        return data
+
+def get_noise(rng=None, nthreads=1):
+    '''Return a GaussianNoise from a GaussianNoise, seed, or None. For None,
+    the seed is drawn from the legacy global RNG so that np.random.seed
+    still gives reproducible results.'''
+    if isinstance(rng, GaussianNoise):
+        return rng
+    if rng is None:
+        rng = np.random.randint(2**31)
+    return GaussianNoise(rng, nthreads=nthreads)
@@ -6,6 +6,7 @@ import os
 import time
 import numpy as np
 import subprocess
+import argparse
 
 REDISHOST = 'localhost'
 REDIS_RAW_PSPEC_FILES = 'limbo:raw_pspec_files'
@@ -57,29 +58,81 @@ def process_next(f):
     notebook_out = os.path.join(NOTEBOOK_PATH, os.path.basename(filename)+'.ipynb')
     print(f'Processing {filename} -> {notebook_out}')
     # Processing dependency based on the source observed in the file
-    try:
-        src = limbo.io.read_header(filename)['Source']
-    except(KeyError):
-        ra, dec = limbo.io.read_header(filename)['Target_RA_Deg'], limbo.io.read_header(filename)['Target_DEC_Deg']
-        if ra == limbo.telescope.SGR_RA and dec == limbo.telescope.SGR_DEC:
-            src = 'sgr1935'
-        elif ra == limbo.telescope.CRAB_RA and dec == limbo.telescope.CRAB_DEC:
-            src = 'crab'
-    print(f"jupyter nbconvert --to notebook --execute {os.path.join(os.path.dirname(limbo.__file__), 'data', 'limbo_{src}_processing_template.ipynb')} --output {notebook_out}")
-    p = subprocess.call([f"jupyter nbconvert --to notebook --execute {os.path.join(os.path.dirname(limbo.__file__), 'data', 'limbo_'+src+'_processing_template.ipynb')} --output {notebook_out}"], env=context, shell=True)
+    hdr = limbo.io.read_header(filename)
+    src = limbo.pipeline.get_source(hdr)
+    template = os.path.join(os.path.dirname(limbo.__file__), 'data', f'limbo_{src}_processing_template.ipynb')
+    if src is None or not os.path.exists(template):
+        print(f"No processing template for {filename} (Source={hdr.get('Source')!r}); skipping.")
+        r.hdel(PURGATORY_KEY, f)
+        return
+    print(f"jupyter nbconvert --to notebook --execute {template} --output {notebook_out}")
+    p = subprocess.call([f"jupyter nbconvert --to notebook --execute {template} --output {notebook_out}"], env=context, shell=True)
     r.hdel(PURGATORY_KEY, f)
     print(f'Finished')
 
+def process_next_pipeline(f, plot_dir=None):
+    filename = os.path.join(DATA_PATH, f)
+    if not os.path.exists(filename):
+        print(f'Did not find {filename}.')
+        return
+    hdr = limbo.io.read_header(filename)
+    config = limbo.pipeline.get_config(limbo.pipeline.get_source(hdr),
+                exclude_s=float(os_env['LIMBO_EXCLUDE_S']),
+                remove_dir=REMOVE_PATH, save_dir=SAVE_PATH,
+                volt_dir=VOLT_DIR, volt_save_dir=VOLT_SAVE_PATH,
+                catalog=limbo.catalog.CATALOG_FILE,
+                update_database=(UPDATE_DATABASE == 'True'),
+                plot_dir=plot_dir)
+    t0 = time.time()
+    rv = limbo.pipeline.process_file(filename, config)
+    print(f"Finished {filename} in {time.time() - t0:.1f} s: "
+          f"interesting={rv['interesting']}, save={rv['save_file']}")
+
+def pipeline_worker(plot_dir=None):
+    '''Long-lived worker: process files from the queue with limbo.pipeline.'''
+    r = redis.Redis(REDISHOST, decode_responses=True)
+    while True:
+        f = r.rpop(REDIS_RAW_PSPEC_FILES)
+        if f is None:
+            time.sleep(1)
+            continue
+        r.hset(PURGATORY_KEY, f, 0)
+        try:
+            process_next_pipeline(f, plot_dir=plot_dir)
+        except Exception as e:
+            print(f'Failed on {f}: {e!r}')
+        r.hdel(PURGATORY_KEY, f)
+
 
 
 if __name__ == '__main__':
     import multiprocessing as mp
 
+    parser = argparse.ArgumentParser(description='Process limbo spectra files from the redis queue.')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Process with limbo.pipeline in long-lived workers instead of notebooks.')
+    parser.add_argument('--nworkers', type=int, default=8, help='Number of worker processes.')
+    parser.add_argument('--plot', action='store_true',
+                        help=f'With --pipeline, save summary plots to {NOTEBOOK_PATH}.')
+    args = parser.parse_args()
+
     qlen = r.llen(REDIS_RAW_PSPEC_FILES)
     print(f'Starting LIMBO processing. Queue length={qlen}')
     children = {}
-    nworkers = 8
+    workers = []
+    nworkers = args.nworkers
     try:
+        if args.pipeline:
+            plot_dir = NOTEBOOK_PATH if args.plot else None
+            while True:
+                workers = [thd for thd in workers if thd.is_alive()]
+                while len(workers) < nworkers:
+                    thd = mp.Process(target=pipeline_worker, args=(plot_dir,))
+                    thd.start()
+                    workers.append(thd)
+                qlen = r.llen(REDIS_RAW_PSPEC_FILES)
+                print(f'Queue length={qlen}, N workers={len(workers)}/{nworkers}')
+                time.sleep(10)
         while True:
             qlen = r.llen(REDIS_RAW_PSPEC_FILES)
             children = {f: thd for f, thd in children.items()
@@ -95,10 +148,10 @@ if __name__ == '__main__':
             else:
                 time.sleep(1)
     except Exception as e:
-        print(f'Closing down {len(children)} threads')
-        for f, thd in children.items():
+        print(f'Closing down {len(children) + len(workers)} threads')
+        for thd in list(children.values()) + workers:
             thd.terminate()
-        for thd in children.values():
+        for thd in list(children.values()) + workers:
             thd.join()
     finally:
         print('Cleanup')
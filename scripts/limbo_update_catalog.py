@@ -0,0 +1,18 @@
+#! /usr/bin/env python
+
+import limbo
+import argparse
+
+parser = argparse.ArgumentParser(description='Add new or modified limbo files to the header catalog.')
+parser.add_argument('dirs', nargs='+', help='Directories containing limbo .dat files.')
+parser.add_argument('--catalog', default=limbo.catalog.CATALOG_FILE, help='SQLite catalog file.')
+parser.add_argument('--prune', action='store_true', help='Remove entries for deleted files.')
+args = parser.parse_args()
+
+with limbo.catalog.HeaderCatalog(args.catalog) as cat:
+    for d in args.dirs:
+        n = cat.update_dir(d)
+        print(f'{d}: {n} file(s) added/updated')
+    if args.prune:
+        print(f'Pruned {cat.prune()} file(s)')
+    print(f'{len(cat)} file(s) in {args.catalog}')
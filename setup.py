@@ -41,7 +41,16 @@ setup(name='limbo',
 
     ext_modules = [
         Extension(name='limbo._fdmt', sources=['limbo/_fdmt.pyx'], 
+                  include_dirs=[numpy.get_include()],
+                  extra_compile_args=['-fopenmp'], extra_link_args=['-fopenmp']),
+        Extension(name='limbo._volt', sources=['limbo/_volt.pyx'], 
                   include_dirs=[numpy.get_include()]),
+        Extension(name='limbo._process', sources=['limbo/_process.pyx'], 
+                  include_dirs=[numpy.get_include()],
+                  extra_compile_args=['-fopenmp'], extra_link_args=['-fopenmp']),
+        Extension(name='limbo._dedisp', sources=['limbo/_dedisp.pyx'], 
+                  include_dirs=[numpy.get_include()],
+                  extra_compile_args=['-fopenmp'], extra_link_args=['-fopenmp']),
     ],
 
     package_dir = {'limbo':'limbo'},